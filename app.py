@@ -1,17 +1,26 @@
-from flask import Flask, request, abort
-from linebot import LineBotApi, WebhookHandler
+from flask import Flask, Response, request, abort, stream_with_context
+from linebot import WebhookHandler
 from linebot.exceptions import InvalidSignatureError
 from linebot.models import MessageEvent, TextMessage, TextSendMessage
 from dotenv import load_dotenv
 import os
-import json
+import atexit
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
 import logging
-from logging import Formatter
 from pythonjsonlogger import jsonlogger
 
-from utils.command_handler import handle_command
-from utils.user_state import UserState
-from utils.auth import is_admin
+from utils.user_state import user_state
+from utils.event_queue import EventQueue
+from utils.line_client import ReplyBatch, create_line_bot_api, send_replies
+from utils.rate_limit import create_rate_limiter
+from utils.dedup import create_deduplicator
+from utils.menu import menu_manager
+from utils.order import order_manager
+from utils.storage import get_data_dir, unit_of_work
+from utils.export import EXPORT_FORMATS, date_range, export_orders, verify_export_request
+from utils import lazy, metrics, webhook
 
 # 載入環境變數
 load_dotenv()
@@ -19,7 +28,7 @@ load_dotenv()
 app = Flask(__name__)
 
 # LINE Bot 設定
-line_bot_api = LineBotApi(os.getenv('LINE_CHANNEL_ACCESS_TOKEN'))
+line_bot_api = create_line_bot_api(os.getenv('LINE_CHANNEL_ACCESS_TOKEN'))
 handler = WebhookHandler(os.getenv('LINE_CHANNEL_SECRET'))
 
 # 設定日誌
@@ -31,52 +40,171 @@ logger.addHandler(logHandler)
 logger.setLevel(logging.INFO)
 
 # 確保資料目錄存在
-os.makedirs('data', exist_ok=True)
+os.makedirs(get_data_dir(), exist_ok=True)
+
+def warm_up():
+    """載入資料並建立各管理器（未呼叫時於第一次使用時才載入）"""
+    lazy.warm_up(user_state, menu_manager, order_manager)
+
+def start_warm_up(mode: Optional[str] = None):
+    """依 WARM_UP 設定預先載入資料：background（背景執行緒，預設）、eager（立即）、lazy（不預先載入）"""
+    mode = (mode or os.getenv('WARM_UP', 'background')).lower()
+    if mode == "eager":
+        warm_up()
+    elif mode == "background":
+        threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+    elif mode != "lazy":
+        raise ValueError(f"不支援的 WARM_UP 設定：{mode}（可用：background, eager, lazy）")
+
+# 批次處理：同一個 webhook 的所有事件共用一次寫入，回覆在寫入完成後同時送出
+WEBHOOK_BATCH = os.getenv('WEBHOOK_BATCH', 'true').lower() == 'true'
+reply_executor = ThreadPoolExecutor(int(os.getenv('REPLY_CONCURRENCY', '4')), thread_name_prefix="reply")
+_pending_replies = threading.local()
+
+def process_webhook(job):
+    """處理一個 webhook 請求中的所有事件"""
+    body, signature = job
+    if not WEBHOOK_BATCH:
+        handler.handle(body, signature)
+        return
+    
+    batches = []
+    _pending_replies.batches = batches
+    try:
+        with unit_of_work(user_state, order_manager.repository, menu_manager.repository):
+            handler.handle(body, signature)
+    finally:
+        _pending_replies.batches = None
+    send_replies(batches, reply_executor)
+
+def dispatch_reply(replies: ReplyBatch):
+    """批次處理中先保留回覆，否則立即送出"""
+    pending = getattr(_pending_replies, "batches", None)
+    if pending is None:
+        replies.send()
+    else:
+        pending.append(replies)
+
+# 每位使用者與全域的限流（RATE_LIMIT_ENABLED=false 時為 None）
+rate_limiter = create_rate_limiter()
+
+# 排除 LINE 重送的事件（WEBHOOK_DEDUP_ENABLED=false 時為 None）
+deduplicator = create_deduplicator()
+
+# 非同步處理 webhook：驗證簽章後立即回應，事件交給背景執行緒處理
+event_queue = None
+if os.getenv('WEBHOOK_ASYNC', 'true').lower() == 'true':
+    event_queue = EventQueue(
+        process_webhook,
+        workers=int(os.getenv('WEBHOOK_WORKERS', '4')),
+        maxsize=int(os.getenv('WEBHOOK_QUEUE_SIZE', '1000'))
+    )
+    event_queue.start()
+    # 結束前處理完佇列中剩餘的事件
+    atexit.register(event_queue.shutdown)
+
+def create_app(warm: Optional[str] = None) -> Flask:
+    """WSGI app factory（gunicorn.conf.py 以 app:create_app(...) 載入）"""
+    start_warm_up(warm)
+    return app
+
+def stop_background():
+    """停止本行程的背景執行緒（gunicorn preload 時，master 在 fork 前呼叫）"""
+    if event_queue is not None:
+        event_queue.shutdown()
+    if lazy.is_initialized(user_state):
+        user_state.stop_sweeper()
+
+def init_worker():
+    """fork 後重建本 worker 專屬的狀態（gunicorn post_fork 呼叫）
+    
+    已載入的商品與訂單資料沿用 master 的記憶體（copy-on-write），
+    連線池、執行緒、鎖與計時器則各 worker 重新建立。
+    """
+    global reply_executor
+    line_bot_api.http_client.reset()
+    reply_executor = ThreadPoolExecutor(int(os.getenv('REPLY_CONCURRENCY', '4')), thread_name_prefix="reply")
+    if lazy.is_initialized(user_state):
+        user_state.after_fork()
+    if lazy.is_initialized(order_manager):
+        order_manager.repository.after_fork()
+    if event_queue is not None:
+        event_queue.start()
+
+# 抓取時才讀取的即時指標
+metrics.gauge("linebot_orders", "各狀態的訂單數量",
+              lambda: {(status,): count for status, count in order_manager.status_counts().items()},
+              ["status"])
+if rate_limiter is not None:
+    metrics.gauge("linebot_rate_limit_events", "限流放行與拒絕的訊息數",
+                  lambda: {(result,): count for result, count in rate_limiter.stats().items()},
+                  ["result"])
+if deduplicator is not None:
+    metrics.gauge("linebot_webhook_events", "webhook 事件去重統計",
+                  lambda: {(result,): count for result, count in deduplicator.stats().items()},
+                  ["result"])
+if event_queue is not None:
+    metrics.gauge("linebot_event_queue", "webhook 事件佇列統計",
+                  lambda: {(key,): value for key, value in event_queue.stats().items()},
+                  ["stat"])
+
+@app.route("/metrics", methods=['GET'])
+def metrics_endpoint():
+    """Prometheus 指標（每個 worker 各自統計）"""
+    return Response(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route("/export/orders", methods=['GET'])
+def export_orders_endpoint():
+    """串流匯出訂單（CSV / JSONL），需 EXPORT_TOKEN 或管理員取得的簽章連結"""
+    if not verify_export_request(request.args, request.headers.get('Authorization', '')):
+        abort(403)
+    fmt = request.args.get('format', 'csv')
+    status = request.args.get('status') or None
+    if fmt not in EXPORT_FORMATS:
+        abort(400)
+    try:
+        since, until = date_range(request.args.get('from'), request.args.get('to'))
+    except ValueError:
+        abort(400)
+    
+    logger.info('匯出訂單', extra={'format': fmt, 'status': status,
+                                    'from': request.args.get('from'), 'to': request.args.get('to')})
+    orders = order_manager.repository.iter_orders(status, since, until)
+    response = Response(stream_with_context(export_orders(orders, fmt)), content_type=EXPORT_FORMATS[fmt])
+    response.headers['Content-Disposition'] = f'attachment; filename="orders.{fmt}"'
+    return response
 
 @app.route("/callback", methods=['POST'])
 def callback():
-    signature = request.headers['X-Line-Signature']
+    signature = request.headers.get('X-Line-Signature', '')
     body = request.get_data(as_text=True)
     
-    try:
-        handler.handle(body, signature)
-    except InvalidSignatureError:
+    if event_queue is None:
+        try:
+            process_webhook((body, signature))
+        except InvalidSignatureError:
+            abort(400)
+        return 'OK'
+    
+    if not handler.parser.signature_validator.validate(body, signature):
         abort(400)
+    if not event_queue.submit((body, signature)):
+        logger.warning('事件佇列已滿，改為同步處理', extra=event_queue.stats())
     
     return 'OK'
 
 @handler.add(MessageEvent, message=TextMessage)
 def handle_message(event):
-    user_id = event.source.user_id
-    text = event.message.text.strip()
-    
-    # 記錄收到的訊息
-    logger.info('收到訊息', extra={
-        'user_id': user_id,
-        'user_message': text
-    })
-    
-    try:
-        # 處理命令並取得回應
-        response = handle_command(text, user_id)
-        
-        # 發送回應
-        if response:
-            line_bot_api.reply_message(
-                event.reply_token,
-                TextSendMessage(text=response)
-            )
+    redelivery = bool(event.delivery_context and event.delivery_context.is_redelivery)
+    texts = webhook.respond(event.source.user_id, event.message.text.strip(), event.webhook_event_id,
+                            redelivery, deduplicator, rate_limiter)
+    if not texts:
+        return
     
-    except Exception as e:
-        logger.error('處理訊息時發生錯誤', extra={
-            'error': str(e),
-            'user_id': user_id,
-            'user_message': text
-        })
-        line_bot_api.reply_message(
-            event.reply_token,
-            TextSendMessage(text="抱歉，處理您的請求時發生錯誤。請稍後再試。")
-        )
+    # 同一個 reply token 的訊息合併成一次 API 呼叫
+    replies = ReplyBatch(line_bot_api, event.reply_token)
+    replies.add(*[TextSendMessage(text=chunk) for chunk in texts])
+    dispatch_reply(replies)
 
 if __name__ == "__main__":
     app.run(debug=os.getenv('DEBUG', 'False').lower() == 'true') 
\ No newline at end of file
@@ -0,0 +1,157 @@
+"""asyncio 入口：以 line-bot-sdk v3 的非同步 webhook 解析與 messaging API 處理訊息
+
+與 app.py（Flask）共用同一套命令處理、商品、訂單與使用者狀態。命令處理
+（含檔案 / SQLite 寫入）在執行緒池中進行，回覆則以 aiohttp 非同步送出，
+單一行程即可同時有數百個回覆在等待 LINE API 回應。
+
+執行：python async_app.py
+或：gunicorn async_app:app -k aiohttp.GunicornWebWorker -w 4 -b 0.0.0.0:5000
+"""
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from typing import List, Optional, Tuple
+
+from aiohttp import web
+from dotenv import load_dotenv
+from linebot.v3.exceptions import InvalidSignatureError
+from linebot.v3.webhook import WebhookParser
+from linebot.v3.webhooks import MessageEvent, TextMessageContent
+from pythonjsonlogger import jsonlogger
+
+from utils.user_state import user_state
+from utils.line_client import AsyncReplyClient
+from utils.rate_limit import create_rate_limiter
+from utils.dedup import create_deduplicator
+from utils.menu import menu_manager
+from utils.order import order_manager
+from utils.storage import get_data_dir, unit_of_work
+from utils import lazy, metrics, webhook
+
+# 載入環境變數
+load_dotenv()
+
+parser = WebhookParser(os.getenv('LINE_CHANNEL_SECRET'))
+
+# 設定日誌
+logger = logging.getLogger()
+if not any(isinstance(h.formatter, jsonlogger.JsonFormatter) for h in logger.handlers):
+    logHandler = logging.StreamHandler()
+    logHandler.setFormatter(jsonlogger.JsonFormatter())
+    logger.addHandler(logHandler)
+logger.setLevel(logging.INFO)
+
+# 確保資料目錄存在
+os.makedirs(get_data_dir(), exist_ok=True)
+
+WEBHOOK_ASYNC = os.getenv('WEBHOOK_ASYNC', 'true').lower() == 'true'
+WEBHOOK_BATCH = os.getenv('WEBHOOK_BATCH', 'true').lower() == 'true'
+
+# 命令處理會讀寫檔案與取得鎖，交給執行緒池以免阻塞事件迴圈
+command_executor = ThreadPoolExecutor(int(os.getenv('WEBHOOK_WORKERS', '4')), thread_name_prefix="command")
+
+# 每位使用者與全域的限流（RATE_LIMIT_ENABLED=false 時為 None）
+rate_limiter = create_rate_limiter()
+
+# 排除 LINE 重送的事件（WEBHOOK_DEDUP_ENABLED=false 時為 None）
+deduplicator = create_deduplicator()
+
+# aiohttp 應用程式的共用狀態
+REPLY_CLIENT = web.AppKey("reply_client", AsyncReplyClient)
+PENDING = web.AppKey("pending", set)  # 背景處理中的 webhook
+
+def respond(event: MessageEvent) -> Optional[List[str]]:
+    """處理一則文字訊息，返回要回覆的文字（None 表示不回覆）"""
+    redelivery = bool(event.delivery_context and event.delivery_context.is_redelivery)
+    return webhook.respond(event.source.user_id, event.message.text.strip(), event.webhook_event_id,
+                           redelivery, deduplicator, rate_limiter)
+
+def handle_events(events: list) -> List[Tuple[str, List[str]]]:
+    """處理一個 webhook 中的所有文字訊息（共用一次寫入），返回 (reply token, 回覆文字)"""
+    replies = []
+    batch = unit_of_work(user_state, order_manager.repository, menu_manager.repository) if WEBHOOK_BATCH else nullcontext()
+    with batch:
+        for event in events:
+            if isinstance(event, MessageEvent) and isinstance(event.message, TextMessageContent):
+                texts = respond(event)
+                if texts:
+                    replies.append((event.reply_token, texts))
+    return replies
+
+async def process_webhook(app: web.Application, events: list):
+    """在執行緒池處理事件，寫入完成後同時送出所有回覆"""
+    loop = asyncio.get_running_loop()
+    replies = await loop.run_in_executor(command_executor, handle_events, events)
+    client = app[REPLY_CLIENT]
+    await asyncio.gather(*(client.reply(token, texts) for token, texts in replies))
+
+def log_failure(task: asyncio.Task):
+    """記錄背景處理失敗的 webhook（與 Flask 版事件佇列相同的日誌與指標）"""
+    if task.cancelled():
+        return
+    error = task.exception()
+    if error is not None:
+        logger.error('背景處理事件時發生錯誤', extra={'error': str(error)})
+        metrics.WEBHOOK_ERRORS.inc()
+
+async def callback(request: web.Request) -> web.Response:
+    signature = request.headers.get('X-Line-Signature', '')
+    body = await request.text()
+    try:
+        events = parser.parse(body, signature)
+    except InvalidSignatureError:
+        raise web.HTTPBadRequest()
+    except ValueError as e:
+        # v3 解析器會驗證事件欄位，格式不符的內容不處理
+        logger.warning('無法解析 webhook 內容', extra={'error': str(e)})
+        raise web.HTTPBadRequest()
+
+    if not WEBHOOK_ASYNC:
+        await process_webhook(request.app, events)
+        return web.Response(text='OK')
+
+    # 驗證簽章後立即回應，事件在背景處理
+    task = asyncio.create_task(process_webhook(request.app, events))
+    pending = request.app[PENDING]
+    pending.add(task)
+    task.add_done_callback(pending.discard)
+    task.add_done_callback(log_failure)
+    return web.Response(text='OK')
+
+async def metrics_endpoint(request: web.Request) -> web.Response:
+    """Prometheus 指標（每個 worker 各自統計）"""
+    return web.Response(body=metrics.registry.render().encode('utf-8'),
+                        headers={'Content-Type': metrics.CONTENT_TYPE})
+
+async def on_startup(app: web.Application):
+    # aiohttp 連線池必須在事件迴圈中建立
+    app[REPLY_CLIENT] = AsyncReplyClient(os.getenv('LINE_CHANNEL_ACCESS_TOKEN'))
+    mode = os.getenv('WARM_UP', 'background').lower()
+    if mode == "eager":
+        await asyncio.get_running_loop().run_in_executor(command_executor, lazy.warm_up,
+                                                         user_state, menu_manager, order_manager)
+    elif mode == "background":
+        command_executor.submit(lazy.warm_up, user_state, menu_manager, order_manager)
+
+async def on_cleanup(app: web.Application):
+    # 結束前處理完尚未送出的回覆
+    if app[PENDING]:
+        await asyncio.gather(*app[PENDING], return_exceptions=True)
+    await app[REPLY_CLIENT].close()
+
+def create_app() -> web.Application:
+    """建立 aiohttp 應用程式"""
+    app = web.Application()
+    app[PENDING] = set()
+    app.router.add_post("/callback", callback)
+    app.router.add_get("/metrics", metrics_endpoint)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+app = create_app()
+
+if __name__ == "__main__":
+    web.run_app(app, port=5000)
@@ -0,0 +1,68 @@
+"""命令分派微基準測試
+
+量測每則訊息的分派成本（查表 + 參數解析），以及含管理器處理的完整 handle_command。
+使用暫存資料目錄，不會動到 data/。
+
+執行：python benchmarks/bench_dispatch.py [--number 20000]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import timeit
+
+# 必須在匯入 utils 之前設定資料目錄
+os.environ['DATA_DIR'] = tempfile.mkdtemp(prefix="bench_dispatch_")
+os.environ.setdefault('STORAGE_BACKEND', 'json')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.command_handler import COMMANDS, handle_command, resolve_command  # noqa: E402
+
+# 涵蓋所有命令的訊息樣本
+MESSAGES = [
+    "menu",
+    "order 商品A 2 商品B 1",
+    "myorders",
+    "myorders more",
+    "help",
+    "!admin 123456",
+    "edit menu add 商品C 100 50 商品描述",
+    "edit menu edit 商品C 120 45 新描述",
+    "edit menu delete 商品C",
+    "view orders pending page 2",
+    "update order 12 confirmed",
+    "logout",
+    "不存在的命令",
+]
+
+def dispatch_only(text: str):
+    tokens = text.split()
+    command = resolve_command(tokens)
+    if command is not None:
+        try:
+            command.parse(tokens[len(command.words):])
+        except ValueError:
+            pass
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=20000, help="每則訊息重複次數")
+    args = parser.parse_args()
+
+    print(f"命令數：{len(COMMANDS)}，訊息樣本：{len(MESSAGES)}，每則重複 {args.number} 次\n")
+    print(f"{'訊息':<36}{'分派 (µs)':>12}{'完整處理 (µs)':>16}")
+    total_dispatch = total_full = 0.0
+    for text in MESSAGES:
+        dispatch = min(timeit.repeat(lambda: dispatch_only(text), number=args.number, repeat=3))
+        # 完整處理會寫檔，次數較少
+        full_number = max(args.number // 100, 10)
+        full = min(timeit.repeat(lambda: handle_command(text, "bench_user"), number=full_number, repeat=3))
+        dispatch_us = dispatch / args.number * 1e6
+        full_us = full / full_number * 1e6
+        total_dispatch += dispatch_us
+        total_full += full_us
+        print(f"{text:<36}{dispatch_us:>12.2f}{full_us:>16.2f}")
+    print(f"\n{'平均':<36}{total_dispatch / len(MESSAGES):>12.2f}{total_full / len(MESSAGES):>16.2f}")
+
+if __name__ == "__main__":
+    main()
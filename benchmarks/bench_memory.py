@@ -0,0 +1,97 @@
+"""記憶體基準測試：dict 與 __slots__ 紀錄
+
+以相同的訂單與使用者狀態資料分別建立 dict 與 utils.records 的紀錄，
+用 tracemalloc 量測每筆紀錄佔用的記憶體，並比較 JSON 載入與輸出的速度。
+不會讀寫 data/。
+
+執行：python benchmarks/bench_memory.py [--orders 100000] [--users 100000]
+"""
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.records import Order, UserRecord, encode_record  # noqa: E402
+
+def make_orders(count: int, rng: random.Random) -> list:
+    """產生 JSON 格式的訂單資料"""
+    start = datetime(2024, 1, 1)
+    orders = []
+    for order_id in range(1, count + 1):
+        items = []
+        for n in range(rng.randint(1, 3)):
+            quantity, price = rng.randint(1, 5), rng.choice([50, 80, 120])
+            items.append({"name": f"商品{n}", "quantity": quantity, "price": price, "subtotal": quantity * price})
+        created = (start + timedelta(seconds=order_id * 7)).isoformat()
+        orders.append({
+            "id": order_id, "user_id": f"U{rng.randrange(count // 10 + 1):032x}", "items": items,
+            "total": sum(i["subtotal"] for i in items), "status": rng.choice(["pending", "confirmed", "completed"]),
+            "created_at": created, "updated_at": created
+        })
+    return orders
+
+def make_users(count: int, rng: random.Random) -> dict:
+    """產生 JSON 格式的使用者狀態資料"""
+    now = time.time()
+    users = {}
+    for n in range(count):
+        logged_in = rng.random() < 0.1
+        users[f"U{n:032x}"] = {
+            "is_admin": logged_in, "is_logged_in": logged_in, "login_attempts": rng.randint(0, 2),
+            "last_attempt_time": now if rng.random() < 0.3 else None, "blocked_until": None,
+            "session_token": f"{n:064x}" if logged_in else None, "session_created": now if logged_in else None
+        }
+    return users
+
+def measure(build):
+    """返回 (建立的物件, 佔用位元組, 耗時秒)"""
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = build()
+    elapsed = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, size, elapsed
+
+def dump_time(data) -> float:
+    start = time.perf_counter()
+    json.dumps(data, ensure_ascii=False, default=encode_record)
+    return time.perf_counter() - start
+
+def report(name: str, count: int, raw: str, from_dict):
+    """比較同一份 JSON 以 dict 與紀錄類別載入的記憶體與速度"""
+    dicts, dict_bytes, dict_load = measure(lambda: json.loads(raw))
+    records, record_bytes, record_load = measure(lambda: from_dict(json.loads(raw)))
+    dict_dump, record_dump = dump_time(dicts), dump_time(records)
+    del dicts, records
+    print(f"{name}（{count} 筆）")
+    print(f"  {'':<10}{'bytes/筆':>12}{'載入 (s)':>12}{'輸出 (s)':>12}")
+    print(f"  {'dict':<10}{dict_bytes / count:>12.0f}{dict_load:>12.3f}{dict_dump:>12.3f}")
+    print(f"  {'slots':<10}{record_bytes / count:>12.0f}{record_load:>12.3f}{record_dump:>12.3f}")
+    print(f"  記憶體節省 {1 - record_bytes / dict_bytes:.0%}\n")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--orders", type=int, default=100000, help="訂單筆數")
+    parser.add_argument("--users", type=int, default=100000, help="使用者筆數")
+    parser.add_argument("--seed", type=int, default=42, help="亂數種子")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    orders_raw = json.dumps(make_orders(args.orders, rng), ensure_ascii=False)
+    users_raw = json.dumps(make_users(args.users, rng), ensure_ascii=False)
+
+    report("訂單", args.orders, orders_raw, lambda data: [Order.from_dict(o) for o in data])
+    report("使用者狀態", args.users, users_raw,
+           lambda data: {uid: UserRecord.from_dict(s) for uid, s in data.items()})
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""訂單快照基準測試：舊格式（indent=2）與緊湊 / gzip 快照
+
+以 10k / 100k / 1M 筆訂單比較寫入與載入時間、檔案大小。
+使用暫存目錄，不會動到 data/。
+
+執行：python benchmarks/bench_snapshot.py [--sizes 10000,100000,1000000] [--fsync]
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench_memory import make_orders  # noqa: E402
+from utils.records import Order, encode_record  # noqa: E402
+from utils.snapshot import read_snapshot, write_snapshot  # noqa: E402
+
+def legacy_save(path: str, data):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2, default=encode_record)
+
+def legacy_load(path: str):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def timed(func) -> float:
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="訂單筆數（以逗號分隔）")
+    parser.add_argument("--fsync", action="store_true", help="快照寫入時 fsync（與正式環境相同）")
+    parser.add_argument("--seed", type=int, default=42, help="亂數種子")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="bench_snapshot_")
+    try:
+        print(f"{'筆數':>9}  {'格式':<10}{'寫入 (s)':>10}{'載入 (s)':>10}{'大小 (MB)':>11}")
+        for size in (int(s) for s in args.sizes.split(",")):
+            orders = {}
+            for data in make_orders(size, random.Random(args.seed)):
+                order = Order.from_dict(data)
+                orders.setdefault(order.user_id, []).append(order)
+
+            variants = [
+                ("indent=2", legacy_save, legacy_load),
+                ("compact", lambda p, d: write_snapshot(p, d, compress=False, fsync=args.fsync, default=encode_record),
+                 lambda p: read_snapshot(p, {})),
+                ("gzip", lambda p, d: write_snapshot(p, d, compress=True, fsync=args.fsync, default=encode_record),
+                 lambda p: read_snapshot(p, {})),
+            ]
+            for name, save, load in variants:
+                path = os.path.join(work_dir, f"orders-{name}.json")
+                save_time = timed(lambda: save(path, orders))
+                load_time = timed(lambda: load(path))
+                size_mb = os.path.getsize(path) / 1e6
+                print(f"{size:>9}  {name:<10}{save_time:>10.2f}{load_time:>10.2f}{size_mb:>11.1f}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
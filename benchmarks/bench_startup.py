@@ -0,0 +1,81 @@
+"""啟動時間基準測試：匯入 app 與預先載入資料（warm_up）的耗時
+
+在暫存資料目錄產生指定筆數的訂單與使用者狀態，以新的 Python 行程量測：
+- 匯入 app（worker 可開始接受請求的時間）
+- warm_up()（載入商品、訂單與使用者狀態）
+每種設定重複數次取中位數。
+
+執行：python benchmarks/bench_startup.py [--orders 100000] [--users 10000] [--repeat 5]
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench_memory import make_orders, make_users  # noqa: E402
+from utils.snapshot import write_snapshot  # noqa: E402
+
+# 子行程：分別量測匯入與 warm_up
+CHILD = """
+import json, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.warm_up()
+warmed = time.perf_counter()
+print(json.dumps({"import": imported - start, "warm_up": warmed - imported}))
+"""
+
+def populate(data_dir: str, orders: int, users: int, seed: int):
+    """寫入測試用的商品、訂單快照與使用者狀態"""
+    rng = random.Random(seed)
+    by_user = {}
+    for order in make_orders(orders, rng):
+        by_user.setdefault(order["user_id"], []).append(order)
+    write_snapshot(os.path.join(data_dir, "orders.json"), by_user, fsync=False)
+    write_snapshot(os.path.join(data_dir, "user_state.json"), make_users(users, rng), fsync=False)
+    menu = {f"商品{n}": {"price": 100, "stock": 10 ** 6, "description": ""} for n in range(3)}
+    write_snapshot(os.path.join(data_dir, "menu.json"), menu, fsync=False)
+
+def measure(data_dir: str, repeat: int) -> dict:
+    env = dict(os.environ, DATA_DIR=data_dir, STORAGE_BACKEND="json", WEBHOOK_ASYNC="false",
+               USER_STATE_SWEEP_INTERVAL="0",
+               LINE_CHANNEL_ACCESS_TOKEN="bench", LINE_CHANNEL_SECRET="bench")
+    runs = []
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, "-c", CHILD], env=env, cwd=ROOT,
+                                capture_output=True, text=True, check=True)
+        runs.append(json.loads(result.stdout.strip().splitlines()[-1]))
+    return {key: statistics.median(run[key] for run in runs) for key in ("import", "warm_up")}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--orders", type=int, default=100000, help="訂單筆數")
+    parser.add_argument("--users", type=int, default=10000, help="使用者筆數")
+    parser.add_argument("--repeat", type=int, default=5, help="每種設定的重複次數")
+    parser.add_argument("--seed", type=int, default=42, help="亂數種子")
+    args = parser.parse_args()
+
+    print(f"{'資料量':<24}{'匯入 app (ms)':>16}{'warm_up (ms)':>16}")
+    for label, orders, users in [("空資料", 0, 0), (f"{args.orders} 訂單 / {args.users} 使用者", args.orders, args.users)]:
+        data_dir = tempfile.mkdtemp(prefix="bench_startup_")
+        try:
+            if orders or users:
+                populate(data_dir, orders, users, args.seed)
+            result = measure(data_dir, args.repeat)
+        finally:
+            shutil.rmtree(data_dir, ignore_errors=True)
+        print(f"{label:<24}{result['import'] * 1000:>16.0f}{result['warm_up'] * 1000:>16.0f}")
+    print("\n匯入時間即 worker 可開始接受請求的時間；warm_up 在背景執行緒進行（WARM_UP=background）")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,356 @@
+"""Webhook 負載測試
+
+產生已簽章的 LINE webhook 請求（N 位模擬使用者的 menu / order / myorders / 管理員命令），
+透過 Flask test client、實際的 gunicorn 行程或 asyncio 入口（async_app.py）送到 /callback，
+回覆訊息送往本機 LINE API stub（--reply-delay 模擬 LINE API 的回應時間）。
+報告吞吐量、p50/p99 延遲與資料檔成長量。使用暫存資料目錄，不會動到 data/。
+
+執行：
+    python benchmarks/bench_webhook.py --mode client --users 50 --requests 2000
+    python benchmarks/bench_webhook.py --mode gunicorn --workers 4 --concurrency 16
+    python benchmarks/bench_webhook.py --mode both --output result.json
+    python benchmarks/bench_webhook.py --mode aiohttp --workers 1 --async-webhook --reply-delay 0.2
+"""
+import argparse
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "tests"))
+
+from line_api_stub import LineApiStub  # noqa: E402
+
+CHANNEL_SECRET = "bench-channel-secret"
+ADMIN_PASSWORD = "bench-admin"
+PRODUCTS = {"咖啡": 80, "紅茶": 60, "蛋糕": 120, "餅乾": 45, "三明治": 90}
+
+# 一般使用者的命令比例
+USER_MIX = [("menu", 30), ("order", 40), ("myorders", 25), ("help", 5)]
+# 管理員的命令比例
+ADMIN_MIX = [("view orders", 40), ("view orders pending", 20), ("update order", 30), ("menu", 10)]
+
+def sign(body: str, secret: str = CHANNEL_SECRET) -> str:
+    """產生 X-Line-Signature"""
+    digest = hmac.new(secret.encode(), body.encode(), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode()
+
+def make_body(text: str, user_id: str, seq: int) -> str:
+    """產生單一文字訊息事件的 webhook 內容（每個事件的 ID 與 reply token 皆不同）"""
+    return json.dumps({
+        "destination": "bench-bot",
+        "events": [{
+            "type": "message",
+            "mode": "active",
+            "timestamp": int(time.time() * 1000),
+            "webhookEventId": f"bench-event-{seq}",
+            "deliveryContext": {"isRedelivery": False},
+            "replyToken": f"bench-reply-{seq}",
+            "source": {"type": "user", "userId": user_id},
+            "message": {"id": str(seq), "type": "text", "text": text, "quoteToken": f"bench-quote-{seq}"}
+        }]
+    }, ensure_ascii=False)
+
+def _pick(rng: random.Random, mix: List[Tuple[str, int]]) -> str:
+    return rng.choices([name for name, _ in mix], weights=[weight for _, weight in mix])[0]
+
+def build_workload(users: int, requests: int, admin_ratio: float, seed: int) -> List[Tuple[str, str]]:
+    """產生可重現的 (user_id, 訊息) 序列，管理員先登入"""
+    rng = random.Random(seed)
+    admins = [f"bench_admin_{i}" for i in range(max(1, int(users * admin_ratio)))]
+    members = [f"bench_user_{i}" for i in range(users)]
+    workload = [(admin, f"!admin {ADMIN_PASSWORD}") for admin in admins]
+    order_count = 0
+
+    while len(workload) < requests:
+        if rng.random() < admin_ratio:
+            user_id = rng.choice(admins)
+            kind = _pick(rng, ADMIN_MIX)
+            if kind == "update order":
+                if order_count == 0:
+                    continue
+                order_id = rng.randint(1, order_count)
+                text = f"update order {order_id} {rng.choice(['confirmed', 'cancelled', 'completed'])}"
+            elif kind.startswith("view orders") and rng.random() < 0.3:
+                text = kind + " more"
+            else:
+                text = kind
+        else:
+            user_id = rng.choice(members)
+            kind = _pick(rng, USER_MIX)
+            if kind == "order":
+                names = rng.sample(sorted(PRODUCTS), rng.randint(1, 3))
+                text = "order " + " ".join(f"{name} {rng.randint(1, 3)}" for name in names)
+                order_count += 1
+            elif kind == "myorders" and rng.random() < 0.3:
+                text = "myorders more"
+            else:
+                text = kind
+        workload.append((user_id, text))
+    return workload
+
+def seed_data(data_dir: str):
+    """建立商品目錄（庫存充足，避免庫存不足的短路徑影響量測）"""
+    from utils.storage import create_menu_repository
+    repository = create_menu_repository()
+    now = time.strftime("%Y-%m-%dT%H:%M:%S")
+    for name, price in PRODUCTS.items():
+        repository.upsert(name, {
+            "price": price, "stock": 10 ** 9, "description": "", "created_at": now,
+            "updated_at": now, "created_by": "bench"
+        })
+    repository.close()
+
+def data_sizes(data_dir: str) -> Dict[str, int]:
+    """資料目錄中各檔案大小（位元組）"""
+    sizes = {}
+    for name in sorted(os.listdir(data_dir)):
+        path = os.path.join(data_dir, name)
+        if os.path.isfile(path):
+            sizes[name] = os.path.getsize(path)
+    return sizes
+
+def percentile(values: List[float], p: float) -> float:
+    """取得百分位數（最近排名法）"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered) + 0.5)) - 1))]
+
+def drive(send: Callable[[str, str], int], workload: List[Tuple[str, str]],
+          concurrency: int) -> Tuple[float, List[float], Dict[int, int]]:
+    """以多個執行緒送出請求；同一使用者的訊息依序送出，維持命令的先後關係
+
+    返回：(總耗時, 各請求延遲, 狀態碼統計)
+    """
+    per_user: Dict[str, List[Tuple[int, str]]] = {}
+    for seq, (user_id, text) in enumerate(workload):
+        per_user.setdefault(user_id, []).append((seq, text))
+    lanes: List[List[Tuple[int, str, str]]] = [[] for _ in range(concurrency)]
+    for i, (user_id, messages) in enumerate(per_user.items()):
+        lanes[i % concurrency].extend((seq, user_id, text) for seq, text in messages)
+    for lane in lanes:
+        lane.sort()
+
+    latencies: List[float] = []
+    statuses: Dict[int, int] = {}
+    lock = threading.Lock()
+
+    def run_lane(lane):
+        local_latencies = []
+        local_statuses: Dict[int, int] = {}
+        for seq, user_id, text in lane:
+            body = make_body(text, user_id, seq)
+            start = time.perf_counter()
+            status = send(body, sign(body))
+            local_latencies.append(time.perf_counter() - start)
+            local_statuses[status] = local_statuses.get(status, 0) + 1
+        with lock:
+            latencies.extend(local_latencies)
+            for status, count in local_statuses.items():
+                statuses[status] = statuses.get(status, 0) + count
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(run_lane, [lane for lane in lanes if lane]))
+    return time.perf_counter() - start, latencies, statuses
+
+def run_client(workload: List[Tuple[str, str]], concurrency: int) -> Dict[str, Any]:
+    """以 Flask test client 在本行程內送出請求"""
+    import app as app_module
+    app_module.app.config['TESTING'] = True
+    # 每則訊息的 INFO 日誌會干擾量測
+    logging.getLogger().setLevel(logging.WARNING)
+    local = threading.local()
+
+    def send(body: str, signature: str) -> int:
+        client = getattr(local, "client", None)
+        if client is None:
+            client = local.client = app_module.app.test_client()
+        response = client.post('/callback', data=body, headers={'X-Line-Signature': signature})
+        return response.status_code
+
+    elapsed, latencies, statuses = drive(send, workload, concurrency)
+    # 非同步模式下等待背景執行緒處理完畢，吞吐量以處理完成時間計算
+    if app_module.event_queue is not None:
+        start = time.perf_counter()
+        app_module.event_queue.drain()
+        elapsed += time.perf_counter() - start
+    from utils.user_state import user_state
+    user_state.flush()
+    return {"elapsed": elapsed, "latencies": latencies, "statuses": statuses}
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def run_gunicorn(workload: List[Tuple[str, str]], concurrency: int, workers: int,
+                 env: Dict[str, str], log_path: str, stub: LineApiStub, asyncio_app: bool = False) -> Dict[str, Any]:
+    """啟動 gunicorn 並以 HTTP keep-alive 連線送出請求，伺服器輸出寫入 log_path
+
+    asyncio_app 為 True 時以 aiohttp worker 執行 async_app.py，否則依 gunicorn.conf.py 執行 Flask app。
+    """
+    import requests
+
+    port = _free_port()
+    log_file = open(log_path, "w")
+    if asyncio_app:
+        app_args = ["async_app:app", "-k", "aiohttp.GunicornWebWorker"]
+    else:
+        app_args = ["-c", "gunicorn.conf.py"]
+    process = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", *app_args, "-w", str(workers),
+         "-b", f"127.0.0.1:{port}", "--log-level", "warning"],
+        cwd=ROOT, env=env, stdout=log_file, stderr=subprocess.STDOUT
+    )
+    url = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.time() + 30
+        while True:
+            try:
+                requests.get(url + "/metrics", timeout=1)
+                break
+            except requests.ConnectionError:
+                if process.poll() is not None or time.time() > deadline:
+                    raise RuntimeError("gunicorn 啟動失敗")
+                time.sleep(0.2)
+
+        local = threading.local()
+
+        def send(body: str, signature: str) -> int:
+            session = getattr(local, "session", None)
+            if session is None:
+                session = local.session = requests.Session()
+            response = session.post(url + "/callback", data=body.encode(), headers={
+                'X-Line-Signature': signature, 'Content-Type': 'application/json'
+            })
+            return response.status_code
+
+        elapsed, latencies, statuses = drive(send, workload, concurrency)
+        # 非同步模式下等待所有回覆送出，吞吐量以處理完成時間計算
+        start = time.perf_counter()
+        while len(stub.requests) < len(workload) and time.perf_counter() - start < 120:
+            time.sleep(0.05)
+        elapsed += time.perf_counter() - start
+    finally:
+        # SIGTERM 讓 worker 處理完佇列並執行 atexit 寫入
+        process.terminate()
+        process.wait(60)
+        log_file.close()
+    return {"elapsed": elapsed, "latencies": latencies, "statuses": statuses}
+
+def summarize(name: str, result: Dict[str, Any], before: Dict[str, int], after: Dict[str, int],
+              replies: int) -> Dict[str, Any]:
+    latencies = result["latencies"]
+    growth = {path: after.get(path, 0) - before.get(path, 0) for path in sorted(set(before) | set(after))}
+    return {
+        "mode": name,
+        "requests": len(latencies),
+        "elapsed_seconds": round(result["elapsed"], 3),
+        "throughput_rps": round(len(latencies) / result["elapsed"], 1) if result["elapsed"] else 0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 2),
+            "p90": round(percentile(latencies, 90) * 1000, 2),
+            "p99": round(percentile(latencies, 99) * 1000, 2),
+            "max": round(max(latencies) * 1000, 2) if latencies else 0
+        },
+        "statuses": {str(status): count for status, count in sorted(result["statuses"].items())},
+        "replies": replies,
+        "data_growth_bytes": growth,
+        "data_growth_per_request": round(sum(growth.values()) / max(len(latencies), 1), 1)
+    }
+
+def print_summary(summary: Dict[str, Any]):
+    latency = summary["latency_ms"]
+    print(f"\n== {summary['mode']} ==")
+    print(f"請求數：{summary['requests']}，耗時：{summary['elapsed_seconds']} 秒，"
+          f"吞吐量：{summary['throughput_rps']} req/s")
+    print(f"延遲 (ms)：p50 {latency['p50']}  p90 {latency['p90']}  p99 {latency['p99']}  max {latency['max']}")
+    print(f"狀態碼：{summary['statuses']}，LINE API 回覆數：{summary['replies']}")
+    print("資料檔成長：")
+    for path, growth in summary["data_growth_bytes"].items():
+        print(f"  {path:<24}{growth:>+12,d} B")
+    print(f"  {'每個請求':<20}{summary['data_growth_per_request']:>12} B")
+
+def _prepare_env(data_dir: str, stub: LineApiStub, args) -> Dict[str, str]:
+    env = dict(os.environ)
+    env.update({
+        "DATA_DIR": data_dir,
+        "SQLITE_PATH": os.path.join(data_dir, "store.db"),
+        "STORAGE_BACKEND": args.backend,
+        "LINE_CHANNEL_SECRET": CHANNEL_SECRET,
+        "LINE_CHANNEL_ACCESS_TOKEN": "bench-access-token",
+        "LINE_API_ENDPOINT": stub.endpoint,
+        "ADMIN_PASSWORD": ADMIN_PASSWORD,
+        "WEBHOOK_ASYNC": "true" if args.async_webhook else "false",
+        # 量測持久化路徑，不讓限流擋下請求
+        "RATE_LIMIT_ENABLED": "false",
+    })
+    env.pop("ADMIN_PASSWORD_HASH", None)
+    return env
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mode", choices=["client", "gunicorn", "aiohttp", "both"], default="client")
+    parser.add_argument("--users", type=int, default=50, help="模擬使用者數")
+    parser.add_argument("--requests", type=int, default=2000, help="請求總數")
+    parser.add_argument("--admin-ratio", type=float, default=0.1, help="管理員命令比例")
+    parser.add_argument("--concurrency", type=int, default=8, help="同時送出請求的執行緒數")
+    parser.add_argument("--workers", type=int, default=4, help="gunicorn worker 數")
+    parser.add_argument("--backend", choices=["json", "sqlite"], default="json")
+    parser.add_argument("--async-webhook", action="store_true", help="啟用 WEBHOOK_ASYNC（延遲只含簽章驗證與入列）")
+    parser.add_argument("--reply-delay", type=float, default=0, help="LINE API stub 每個回覆的延遲（秒）")
+    parser.add_argument("--seed", type=int, default=1, help="亂數種子")
+    parser.add_argument("--output", help="將結果寫入 JSON 檔")
+    args = parser.parse_args()
+
+    workload = build_workload(args.users, args.requests, args.admin_ratio, args.seed)
+    modes = ["client", "gunicorn"] if args.mode == "both" else [args.mode]
+    summaries = []
+    for mode in modes:
+        data_dir = tempfile.mkdtemp(prefix=f"bench_webhook_{mode}_")
+        stub = LineApiStub(delay=args.reply_delay).start()
+        env = _prepare_env(data_dir, stub, args)
+        try:
+            if mode == "client":
+                # test client 在本行程內執行，必須在匯入 app 之前設定環境變數
+                os.environ.update(env)
+                os.environ.pop("ADMIN_PASSWORD_HASH", None)
+            os.environ["DATA_DIR"] = data_dir
+            os.environ["SQLITE_PATH"] = env["SQLITE_PATH"]
+            os.environ["STORAGE_BACKEND"] = args.backend
+            seed_data(data_dir)
+            before = data_sizes(data_dir)
+            if mode == "client":
+                result = run_client(workload, args.concurrency)
+            else:
+                log_path = data_dir.rstrip(os.sep) + ".log"
+                print(f"gunicorn 輸出：{log_path}")
+                result = run_gunicorn(workload, args.concurrency, args.workers, env, log_path, stub,
+                                      asyncio_app=mode == "aiohttp")
+            summary = summarize(mode, result, before, data_sizes(data_dir), len(stub.requests))
+        finally:
+            stub.stop()
+        print_summary(summary)
+        summaries.append(summary)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": summaries}, f, ensure_ascii=False, indent=2)
+
+if __name__ == "__main__":
+    main()
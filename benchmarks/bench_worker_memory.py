@@ -0,0 +1,127 @@
+"""gunicorn worker 記憶體量測：preload_app（copy-on-write 共用）與各 worker 自行載入
+
+以 gunicorn.conf.py 啟動實際的 gunicorn 行程，載入相同的訂單與使用者資料後，
+讀取各 worker 的 /proc/<pid>/smaps_rollup：
+- RSS：worker 看到的常駐記憶體（含與 master 共用的頁面）
+- PSS：共用頁面依共用行程數均分後的記憶體
+- USS：worker 獨占的頁面（Private_Clean + Private_Dirty）
+僅支援 Linux。
+
+執行：python benchmarks/bench_worker_memory.py [--orders 100000] [--users 10000] [--workers 4]
+"""
+import argparse
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench_startup import populate  # noqa: E402
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def children(pid: int) -> list:
+    """以 /proc/*/stat 找出子行程"""
+    result = []
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            result.append(int(entry))
+    return result
+
+def memory(pid: int) -> dict:
+    """讀取 smaps_rollup，返回 rss / pss / uss（KB）"""
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2 and parts[0].endswith(":"):
+                values[parts[0][:-1]] = int(parts[1])
+    return {
+        "rss": values.get("Rss", 0),
+        "pss": values.get("Pss", 0),
+        "uss": values.get("Private_Clean", 0) + values.get("Private_Dirty", 0),
+    }
+
+def run(data_dir: str, preload: bool, workers: int, requests: int, timeout: float) -> dict:
+    port = _free_port()
+    env = dict(os.environ, DATA_DIR=data_dir, STORAGE_BACKEND="json", GUNICORN_PRELOAD=str(preload).lower(),
+               GUNICORN_WORKERS=str(workers), GUNICORN_BIND=f"127.0.0.1:{port}", WARM_UP="eager",
+               LINE_CHANNEL_ACCESS_TOKEN="bench", LINE_CHANNEL_SECRET="bench")
+    log = open(os.path.join(data_dir, f"gunicorn-{preload}.log"), "w")
+    master = subprocess.Popen([sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py"],
+                              cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+    try:
+        # 等待所有 worker 載入完成並開始接受請求
+        deadline = time.monotonic() + timeout
+        pids = []
+        while time.monotonic() < deadline:
+            pids = children(master.pid)
+            try:
+                urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5).read()
+            except OSError:
+                time.sleep(0.2)
+                continue
+            if len(pids) == workers:
+                break
+        else:
+            raise RuntimeError(f"gunicorn 未在 {timeout} 秒內啟動，請查看 {log.name}")
+        # 模擬一般流量（讀取訂單統計會存取已載入的資料）
+        for _ in range(requests):
+            urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=5).read()
+        time.sleep(1)
+        workers_memory = [memory(pid) for pid in pids]
+        return {"master": memory(master.pid), "workers": workers_memory}
+    finally:
+        master.send_signal(signal.SIGTERM)
+        master.wait(30)
+        log.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--orders", type=int, default=100000, help="訂單筆數")
+    parser.add_argument("--users", type=int, default=10000, help="使用者筆數")
+    parser.add_argument("--workers", type=int, default=4, help="gunicorn worker 數")
+    parser.add_argument("--requests", type=int, default=200, help="量測前送出的請求數")
+    parser.add_argument("--timeout", type=float, default=120, help="等待啟動的秒數")
+    parser.add_argument("--seed", type=int, default=42, help="亂數種子")
+    args = parser.parse_args()
+
+    if not os.path.exists("/proc/self/smaps_rollup"):
+        sys.exit("需要 Linux 的 /proc/<pid>/smaps_rollup")
+
+    data_dir = tempfile.mkdtemp(prefix="bench_worker_memory_")
+    try:
+        populate(data_dir, args.orders, args.users, args.seed)
+        print(f"{args.orders} 訂單 / {args.users} 使用者，{args.workers} 個 worker（單位 MB）\n")
+        print(f"{'模式':<12}{'worker RSS':>12}{'worker PSS':>12}{'worker USS':>12}{'總 PSS':>10}")
+        for preload in (False, True):
+            result = run(data_dir, preload, args.workers, args.requests, args.timeout)
+            per_worker = {key: sum(w[key] for w in result["workers"]) / len(result["workers"]) / 1024
+                          for key in ("rss", "pss", "uss")}
+            total_pss = (sum(w["pss"] for w in result["workers"]) + result["master"]["pss"]) / 1024
+            label = "preload" if preload else "各自載入"
+            print(f"{label:<12}{per_worker['rss']:>12.1f}{per_worker['pss']:>12.1f}"
+                  f"{per_worker['uss']:>12.1f}{total_pss:>10.1f}")
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""gunicorn 設定
+
+執行：gunicorn -c gunicorn.conf.py
+
+preload_app 模式下 master 只載入一次商品、訂單與使用者狀態，fork 出的 worker
+以 copy-on-write 共用這些記憶體頁面：
+- 載入期間停用 gc，fork 前以 gc.freeze() 把既有物件移到永久世代，
+  worker 的 gc 不會掃描（寫入）這些物件，頁面得以保持共用
+- master 在 fork 前停止背景執行緒，worker 在 post_fork 重建連線池、
+  執行緒、鎖與計時器（SQLite 連線在 fork 後會自動重新建立）
+
+GUNICORN_THREADS 大於 1 時 gunicorn 改用 gthread worker，同一個 worker 內的
+執行緒共用已載入的資料（管理器以讀寫鎖與 copy-on-write 紀錄保護）。
+"""
+import gc
+import os
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.getenv('GUNICORN_WORKERS', '4'))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '30'))
+threads = int(os.getenv('GUNICORN_THREADS', '1'))
+preload_app = os.getenv('GUNICORN_PRELOAD', 'true').lower() == 'true'
+
+# preload 時 master 先載入完成；否則各 worker 依 WARM_UP 設定載入
+wsgi_app = "app:create_app('eager')" if preload_app else "app:create_app()"
+
+if preload_app:
+    # 避免載入大量資料時反覆觸發 gc（也避免 gc 標記寫入即將共用的頁面）
+    gc.disable()
+
+def when_ready(server):
+    """master 載入完成、開始 fork worker 之前"""
+    if not preload_app:
+        return
+    from app import stop_background
+    stop_background()
+    gc.collect()
+    gc.freeze()
+    server.log.info("已預先載入資料，gc 凍結 %d 個物件", gc.get_freeze_count())
+
+def post_fork(server, worker):
+    """worker fork 後：重建行程專屬的狀態並恢復 gc"""
+    gc.enable()
+    if preload_app:
+        from app import init_worker
+        init_worker()
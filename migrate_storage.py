@@ -0,0 +1,50 @@
+import argparse
+import os
+from dotenv import load_dotenv
+from utils.storage import (
+    JsonMenuRepository, JsonOrderRepository, JsonStateRepository,
+    SqliteDatabase, SqliteMenuRepository, SqliteOrderRepository, SqliteStateRepository,
+    get_data_dir
+)
+
+# 載入環境變數
+load_dotenv()
+
+def migrate(data_dir: str, db_path: str) -> dict:
+    """將 data/*.json 的資料一次搬移到 SQLite"""
+    db = SqliteDatabase(db_path)
+    
+    menu = JsonMenuRepository(os.path.join(data_dir, "menu.json")).load()
+    SqliteMenuRepository(db).save_all(menu)
+    
+    order_repo = JsonOrderRepository(os.path.join(data_dir, "orders.json"))
+    orders = order_repo.load()  # 包含日誌重播
+    SqliteOrderRepository(db).save_all(orders)
+    
+    states = JsonStateRepository(os.path.join(data_dir, "user_state.json")).load()
+    SqliteStateRepository(db).save_all(states)
+    
+    db.close()
+    return {
+        "menu": len(menu),
+        "orders": sum(len(o) for o in orders.values()),
+        "user_state": len(states)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="將 JSON 資料檔搬移到 SQLite 儲存後端")
+    parser.add_argument("--data-dir", default=get_data_dir(), help="JSON 資料目錄（預設：DATA_DIR 或 data）")
+    parser.add_argument("--db", default=None, help="SQLite 檔案路徑（預設：SQLITE_PATH 或 <data-dir>/store.db）")
+    args = parser.parse_args()
+    
+    db_path = args.db or os.getenv('SQLITE_PATH', os.path.join(args.data_dir, "store.db"))
+    counts = migrate(args.data_dir, db_path)
+    
+    print(f"已搬移至 {db_path}：")
+    print(f"- 商品：{counts['menu']} 筆")
+    print(f"- 訂單：{counts['orders']} 筆")
+    print(f"- 使用者狀態：{counts['user_state']} 筆")
+    print("\n請設定 STORAGE_BACKEND=sqlite 後重新啟動服務")
+
+if __name__ == '__main__':
+    main()
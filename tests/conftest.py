@@ -0,0 +1,11 @@
+import atexit
+import os
+import shutil
+import tempfile
+
+# 必須在測試匯入 app / utils 之前設定：測試使用暫存資料目錄，不會讀寫 data/
+DATA_DIR = tempfile.mkdtemp(prefix="linebot_test_")
+os.environ['DATA_DIR'] = DATA_DIR
+os.environ.setdefault('LINE_CHANNEL_ACCESS_TOKEN', 'test_access_token')
+os.environ.setdefault('LINE_CHANNEL_SECRET', 'test_channel_secret')
+atexit.register(shutil.rmtree, DATA_DIR, ignore_errors=True)
@@ -0,0 +1,77 @@
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Optional
+
+class LineApiStub:
+    """本機 LINE Messaging API stub server
+
+    記錄收到的請求；可預先排入要回傳的狀態碼以模擬 429/5xx，delay 模擬 API 回應時間。
+    """
+
+    def __init__(self, port: int = 0, delay: float = 0):
+        self.delay = delay
+        self.requests: List[dict] = []
+        self.connections = set()  # 用戶端連線（host, port），用來確認 keep-alive
+        self.statuses: List[int] = []
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # 標頭與內容分開寫出，避免 Nagle 演算法與延遲 ACK 造成每個請求約 40ms 的延遲
+            disable_nagle_algorithm = True
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                body = self.rfile.read(length)
+                data = json.loads(body or b"{}")
+                if stub.delay:
+                    time.sleep(stub.delay)
+                with stub._lock:
+                    stub.connections.add(self.client_address)
+                    status = stub.statuses.pop(0) if stub.statuses else 200
+                    if status == 200:
+                        stub.requests.append({"path": self.path, "body": data})
+                if status == 200:
+                    # 與 reply API 相同的回應格式（v3 SDK 會驗證 sentMessages）
+                    sent = [{"id": str(i)} for i, _ in enumerate(data.get("messages", []))]
+                    payload = json.dumps({"sentMessages": sent}).encode()
+                else:
+                    payload = b'{"message":"error"}'
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.server.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def endpoint(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="本機 LINE Messaging API stub server")
+    parser.add_argument("--port", type=int, default=8081)
+    args = parser.parse_args()
+    stub = LineApiStub(args.port)
+    print(f"LINE API stub 已啟動：{stub.endpoint}")
+    stub.server.serve_forever()
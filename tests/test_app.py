@@ -1,8 +1,41 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import os
+import subprocess
+import sys
+import threading
+from urllib.parse import parse_qsl, urlsplit
 import pytest
+import requests
+import urllib3
+from aiohttp.test_utils import TestClient, TestServer
+import app as app_module
+import async_app as async_app_module
 from app import app
-from utils.menu import menu_manager
-from utils.order import order_manager
-from utils.user_state import user_state
+from linebot.models import TextSendMessage
+from line_api_stub import LineApiStub
+from utils.menu import menu_manager, MenuManager
+from utils.order import order_manager, OrderManager
+from utils.user_state import user_state, UserState
+from utils.line_client import PooledHttpClient, ReplyBatch, connect_failed, create_line_bot_api, split_text
+from utils.command_handler import handle_command
+import utils.command_handler as command_handler_module
+from utils.dedup import EventDeduplicator, MemoryDedupStore, SqliteDedupStore
+from utils.metrics import WEBHOOK_ERRORS, Counter, Histogram, Registry
+from utils.records import Order, OrderItem, UserRecord
+from utils.export import export_orders, verify_export_request
+from utils.lazy import LazyInstance, is_initialized
+from utils.snapshot import SnapshotError, backup_path, read_snapshot, write_snapshot
+from utils.rate_limit import BUSY_MESSAGE, GLOBAL_KEY, THROTTLED_MESSAGE, MemoryBucketStore, RateLimiter, SqliteBucketStore
+import utils.storage as storage_module
+import utils.webhook as webhook_module
+from utils.storage import (
+    JsonMenuRepository, JsonOrderRepository, JsonStateRepository, SqliteDatabase, SqliteMenuRepository, SqliteOrderRepository,
+    unit_of_work
+)
 
 @pytest.fixture
 def client():
@@ -15,6 +48,47 @@ def test_callback_endpoint(client):
     response = client.post('/callback')
     assert response.status_code in [200, 400]  # 400 是因為沒有有效的 LINE 簽章
 
+def sign(body: str) -> str:
+    """產生 LINE webhook 簽章"""
+    secret = os.getenv('LINE_CHANNEL_SECRET', '')
+    digest = hmac.new(secret.encode(), body.encode(), hashlib.sha256).digest()
+    return base64.b64encode(digest).decode()
+
+def make_webhook_body(text: str, user_id: str = "webhook_user", event_id: str = None,
+                      redelivery: bool = False) -> str:
+    """產生文字訊息的 webhook 內容"""
+    event = {
+        "type": "message",
+        "mode": "active",
+        "timestamp": 0,
+        "replyToken": "reply-token",
+        "source": {"type": "user", "userId": user_id},
+        "message": {"id": "1", "type": "text", "text": text}
+    }
+    if event_id:
+        event["webhookEventId"] = event_id
+        event["deliveryContext"] = {"isRedelivery": redelivery}
+    return json.dumps({"destination": "bot", "events": [event]})
+
+def test_callback_async(client, monkeypatch):
+    """測試 webhook 立即回應並在背景處理事件"""
+    replies = []
+    monkeypatch.setattr(app_module.line_bot_api, "reply_message",
+                        lambda token, messages: replies.append((token, messages[0].text)))
+    
+    body = make_webhook_body("help")
+    response = client.post('/callback', data=body, headers={'X-Line-Signature': sign(body)})
+    assert response.status_code == 200
+    
+    if app_module.event_queue is not None:
+        app_module.event_queue.drain()
+    assert replies and replies[0][0] == "reply-token"
+    assert "使用說明" in replies[0][1]
+    
+    # 簽章錯誤時不放入佇列
+    response = client.post('/callback', data=body, headers={'X-Line-Signature': 'invalid'})
+    assert response.status_code == 400
+
 def test_menu_manager():
     """測試商品管理功能"""
     # 測試新增商品
@@ -64,4 +138,798 @@ def test_user_state():
     
     # 測試管理員狀態
     user_state.set_admin_status("test_user", True)
-    assert user_state.is_admin("test_user") is True 
\ No newline at end of file
+    assert user_state.is_admin("test_user") is True
+
+def test_order_journal_replay(tmp_path):
+    """測試訂單日誌重播與快照壓縮"""
+    menu_manager.add_item("test_admin", "日誌商品", 50, 10)
+    orders_file = str(tmp_path / "orders.json")
+    
+    repository = JsonOrderRepository(orders_file)
+    repository.compact_threshold = 3
+    manager = OrderManager(repository)
+    manager.create_order("journal_user", [{"name": "日誌商品", "quantity": 1}])
+    manager.create_order("journal_user", [{"name": "日誌商品", "quantity": 2}])
+    manager.update_order_status("test_admin", 1, "confirmed")
+    # 第三筆紀錄觸發壓縮：快照包含全部訂單且日誌已清空
+    assert repository.journal.records == 0
+    manager.update_order_status("test_admin", 2, "cancelled")
+    assert repository.journal.records == 1
+    repository.close()
+    
+    # 重新載入：快照 + 日誌重播
+    reloaded = OrderManager(JsonOrderRepository(orders_file))
+    orders = reloaded.orders["journal_user"]
+    assert [o["status"] for o in orders] == ["confirmed", "cancelled"]
+    reloaded.repository.close()
+    
+    menu_manager.delete_item("test_admin", "日誌商品")
+
+def test_order_journal_compaction_across_workers(tmp_path):
+    """測試壓縮日誌時保留其他 worker 寫入的訂單"""
+    orders_file = str(tmp_path / "orders.json")
+    first, second = JsonOrderRepository(orders_file), JsonOrderRepository(orders_file)
+    for repository in (first, second):
+        repository.load()
+        repository.compact_threshold = 3
+    
+    def make_order(order_id):
+        return Order(order_id, "worker_user", [OrderItem("商品", 1, 10, 10)], 10, "pending", 1.0, 1.0)
+    
+    first.add(make_order(1))
+    # 第二個 worker 的第三筆紀錄觸發壓縮，記憶體中沒有第一個 worker 的訂單
+    for order_id in (2, 3, 4):
+        second.add(make_order(order_id))
+    assert second.journal.records == 0
+    cancelled = make_order(1)
+    cancelled.status = "cancelled"
+    first.update(cancelled)
+    first.add(make_order(5))
+    first.close()
+    second.close()
+    
+    reloaded = JsonOrderRepository(orders_file)
+    orders = reloaded.load()["worker_user"]
+    assert [o.id for o in orders] == [1, 2, 3, 4, 5]
+    assert orders[0].status == "cancelled"
+    reloaded.close()
+
+def test_sqlite_storage(tmp_path):
+    """測試 SQLite 儲存後端"""
+    db = SqliteDatabase(str(tmp_path / "store.db"))
+    menu_repo = SqliteMenuRepository(db)
+    menu_repo.upsert("商品A", {"price": 10, "stock": 3, "description": ""})
+    menu_repo.upsert("商品B", {"price": 20, "stock": 1, "description": ""})
+    
+    # 任一商品庫存不足時整筆交易不生效
+    with pytest.raises(ValueError):
+        menu_repo.adjust_stock({"商品A": -1, "商品B": -2}, "2024-01-01T00:00:00")
+    assert menu_repo.load()["商品A"]["stock"] == 3
+    assert menu_repo.adjust_stock({"商品A": -3}, "2024-01-01T00:00:00") == {"商品A": 0}
+    
+    order_repo = SqliteOrderRepository(db)
+    for order_id, (uid, status) in enumerate([("u1", "pending"), ("u2", "pending"), ("u1", "confirmed")], 1):
+        order_repo.add({
+            "id": order_id, "user_id": uid, "items": [], "total": 0, "status": status,
+            "created_at": "2024-01-01T00:00:00", "updated_at": "2024-01-01T00:00:00"
+        })
+    assert [o["id"] for o in order_repo.find(user_id="u1")] == [1, 3]
+    assert [o["id"] for o in order_repo.find(status="pending")] == [1, 2]
+    order = order_repo.get(2)
+    order["status"] = "cancelled"
+    order_repo.update(order)
+    assert order_repo.get(2)["status"] == "cancelled"
+    assert list(order_repo.load()) == ["u1", "u2"]
+    
+    # 批次中途失敗時仍提交已套用的寫入（記憶體已變更，與 JSON 後端相同）
+    with pytest.raises(RuntimeError):
+        with db.batch():
+            order["status"] = "pending"
+            order_repo.update(order)
+            menu_repo.adjust_stock({"商品B": -1}, "2024-01-02T00:00:00")
+            raise RuntimeError("處理失敗")
+    assert order_repo.get(2)["status"] == "pending"
+    assert menu_repo.load()["商品B"]["stock"] == 0
+    db.close()
+
+def test_order_id_sequence(tmp_path):
+    """測試訂單編號索引與單調遞增序號"""
+    menu_manager.add_item("test_admin", "序號商品", 10, 10)
+    orders_file = str(tmp_path / "orders.json")
+    
+    manager = OrderManager(JsonOrderRepository(orders_file))
+    manager.create_order("seq_user", [{"name": "序號商品", "quantity": 1}])
+    manager.create_order("seq_user", [{"name": "序號商品", "quantity": 1}])
+    assert manager.orders_by_id[2]["user_id"] == "seq_user"
+    
+    # 刪除最後一筆訂單後，新訂單編號仍不可重複使用
+    manager.orders["seq_user"].pop()
+    manager.save_orders()
+    manager.repository.close()
+    reloaded = OrderManager(JsonOrderRepository(orders_file))
+    reloaded.create_order("seq_user", [{"name": "序號商品", "quantity": 1}])
+    assert sorted(reloaded.orders_by_id) == [1, 3]
+    reloaded.repository.close()
+    
+    menu_manager.delete_item("test_admin", "序號商品")
+
+def test_user_state_write_behind(tmp_path):
+    """測試使用者狀態延遲合併寫入"""
+    state_file = tmp_path / "user_state.json"
+    states = UserState(JsonStateRepository(str(state_file)), write_behind=True, flush_delay=60)
+    
+    # 唯讀查詢不會建立紀錄或寫入磁碟
+    assert states.is_admin("new_user") is False
+    assert "new_user" not in states.states
+    assert not state_file.exists()
+    
+    # 多次變更只在 flush 時合併寫入一次
+    states.set_admin_status("new_user", True)
+    states.increment_login_attempts("new_user")
+    assert not state_file.exists()
+    states.flush()
+    
+    reloaded = UserState(JsonStateRepository(str(state_file)))
+    assert reloaded.is_admin("new_user") is True
+    assert reloaded.get_login_attempts("new_user") == 1
+    # 檔案中的時間欄位維持 ISO 字串格式
+    saved = read_snapshot(str(state_file), {})["new_user"]
+    assert isinstance(saved["last_attempt_time"], str) and saved["blocked_until"] is None
+    
+    # 寫入失敗時變更留在 dirty set，下次 flush 重試
+    def fail(batch):
+        raise OSError("磁碟已滿")
+    
+    original, states.repository.upsert_many = states.repository.upsert_many, fail
+    states.increment_login_attempts("new_user")
+    with pytest.raises(OSError):
+        states.flush()
+    states.repository.upsert_many = original
+    states.flush()
+    assert UserState(JsonStateRepository(str(state_file))).get_login_attempts("new_user") == 2
+
+def test_line_client_pooling_and_retry(monkeypatch):
+    """測試共用連線池、429/5xx 重試與訊息合併"""
+    stub = LineApiStub().start()
+    try:
+        monkeypatch.setenv('LINE_API_ENDPOINT', stub.endpoint)
+        monkeypatch.setenv('LINE_HTTP_BACKOFF', '0')
+        api = create_line_bot_api("test-token")
+        assert isinstance(api.http_client, PooledHttpClient)
+        
+        # 前兩次回傳 429，第三次才成功
+        stub.statuses = [429, 429]
+        replies = ReplyBatch(api, "token-1")
+        replies.add(*[TextSendMessage(text=f"訊息 {i}") for i in range(7)])
+        assert replies.send() is True
+        assert len(stub.requests) == 1
+        assert len(stub.requests[0]["body"]["messages"]) == ReplyBatch.MAX_MESSAGES
+        
+        # 同一個 reply token 不會重複送出
+        assert replies.send() is False
+        
+        second = ReplyBatch(api, "token-2")
+        second.add(TextSendMessage(text="再一次"))
+        second.send()
+        # 所有請求都使用同一條 keep-alive 連線
+        assert len(stub.connections) == 1
+        
+        # POST 遇到 5xx 時 LINE 可能已處理請求，不重試（reply token 只能使用一次）
+        stub.statuses = [503, 503]
+        third = ReplyBatch(api, "token-3")
+        third.add(TextSendMessage(text="不重送"))
+        assert third.send() is False
+        assert stub.statuses == [503]
+        
+        # 連線建立失敗時請求未送出，可以重試
+        assert connect_failed(requests.ConnectionError(urllib3.exceptions.MaxRetryError(
+            None, "/", urllib3.exceptions.NewConnectionError(None, "refused"))))
+        assert not connect_failed(requests.ReadTimeout())
+    finally:
+        stub.stop()
+
+def test_menu_render_cache(tmp_path):
+    """測試商品目錄渲染快取與單項區塊更新"""
+    menu = MenuManager(JsonMenuRepository(str(tmp_path / "menu.json")))
+    assert menu.get_menu() == "目前沒有任何商品"
+    menu.add_item("test_admin", "蘋果", 30, 10, "新鮮")
+    menu.add_item("test_admin", "香蕉", 20, 3)
+    
+    first = menu.get_menu()
+    assert first == (
+        "🛍️ 商品目錄：\n\n"
+        "📦 蘋果\n💰 價格：$30\n📊 庫存：✅ 10\n📝 說明：新鮮\n\n"
+        "📦 香蕉\n💰 價格：$20\n📊 庫存：⚠️ 3"
+    )
+    # 沒有異動時直接返回快取
+    assert menu.get_menu() is first
+    
+    banana_block = menu._fragments["香蕉"][1]
+    menu.update_stock("蘋果", -10)
+    second = menu.get_menu()
+    assert "📊 庫存：❌ 0" in second
+    assert menu._fragments["香蕉"][1] is banana_block
+    
+    menu.delete_item("test_admin", "香蕉")
+    assert "香蕉" not in menu.get_menu()
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_menu_hot_reload(tmp_path, backend):
+    """測試其他 worker 變更商品目錄後不需重啟即可看到"""
+    def open_repository():
+        if backend == "sqlite":
+            return SqliteMenuRepository(SqliteDatabase(str(tmp_path / "store.db")))
+        return JsonMenuRepository(str(tmp_path / "menu.json"))
+    
+    worker_a, worker_b = MenuManager(open_repository()), MenuManager(open_repository())
+    worker_a.add_item("test_admin", "熱更新商品", 30, 10)
+    # 新增與編輯前強制檢查，不會以過期的目錄判斷商品是否存在
+    assert "已更新" in worker_b.edit_item("test_admin", "熱更新商品", price=35)
+    
+    # 檢查間隔內沿用記憶體中的目錄，到期後才重新載入
+    worker_a.reload_interval = 60
+    worker_a.refresh(force=True)
+    worker_b.edit_item("test_admin", "熱更新商品", stock=7)
+    assert "10" in worker_a.get_menu()
+    worker_a._next_check = 0
+    assert "📊 庫存：✅ 7" in worker_a.get_menu()
+    assert worker_a.get_item("熱更新商品").price == 35
+    
+    # 沒有變更時只做低成本檢查，不使快取失效
+    version = worker_a.version
+    assert not worker_a.refresh(force=True)
+    assert worker_a.version == version
+    
+    worker_b.delete_item("test_admin", "熱更新商品")
+    worker_a.reload_interval = worker_a._next_check = 0
+    assert worker_a.get_item("熱更新商品") is None
+    assert worker_a.get_menu() == "目前沒有任何商品"
+
+def test_menu_reload_during_stock_adjustment(tmp_path, monkeypatch):
+    """測試扣除庫存與重新載入交錯時不會重複套用增減量"""
+    repository = JsonMenuRepository(str(tmp_path / "menu.json"))
+    menu = MenuManager(repository)
+    menu.add_item("test_admin", "交錯商品", 10, 10)
+    original = repository.adjust_stock
+    
+    def adjust_then_reload(changes, updated_at):
+        result = original(changes, updated_at)
+        # 儲存已扣除、記憶體尚未套用時，其他執行緒重新載入目錄
+        menu.refresh(force=True)
+        return result
+    
+    monkeypatch.setattr(repository, "adjust_stock", adjust_then_reload)
+    assert menu.adjust_stock({"交錯商品": -1}) == {"交錯商品": 9}
+    menu.refresh()
+    assert menu.get_item("交錯商品").stock == 9
+
+def test_order_pagination(tmp_path):
+    """測試訂單分頁與游標"""
+    menu = MenuManager(JsonMenuRepository(str(tmp_path / "menu.json")))
+    menu.add_item("test_admin", "分頁商品", 10, 100)
+    manager = OrderManager(JsonOrderRepository(str(tmp_path / "orders.json")), menu)
+    manager.page_size = 2
+    for _ in range(5):
+        manager.create_order("page_user", [{"name": "分頁商品", "quantity": 1}])
+    manager.update_order_status("test_admin", 2, "confirmed")
+    
+    first = manager.get_user_orders("page_user")
+    assert "訂單 #5" in first and "訂單 #4" in first and "訂單 #3" not in first
+    assert "myorders more" in first
+    second = manager.get_user_orders("page_user", more=True)
+    assert "（第 2 頁）" in second and "訂單 #3" in second and "訂單 #2" in second
+    last = manager.get_user_orders("page_user", more=True)
+    assert "訂單 #1" in last and "more" not in last
+    
+    pending = manager.view_orders("test_admin", "pending", page=2)
+    assert "訂單 #3" in pending and "訂單 #1" in pending and "訂單 #2" not in pending
+    assert manager.view_orders("test_admin", "pending", page=3) == "沒有更多訂單了"
+    
+    # 狀態索引隨建立與狀態變更即時維護
+    assert manager.status_index["pending"] == [1, 3, 4, 5]
+    assert manager.status_counts()["confirmed"] == 1
+    manager.update_order_status("test_admin", 4, "cancelled")
+    assert manager.count_orders("pending") == 3
+    assert manager.count_orders("cancelled") == 1
+    assert manager.count_orders() == 5
+    
+    # 游標數量有上限，移除最久未使用的
+    manager.max_cursors = 2
+    for viewer in ("viewer_1", "viewer_2", "viewer_3"):
+        manager.view_orders(viewer)
+        manager.view_orders(viewer, "pending")
+    assert list(manager._cursors) == [("viewer_3", "view:"), ("viewer_3", "view:pending")]
+    manager.repository.close()
+
+def test_split_text():
+    """測試過長訊息拆成多則"""
+    blocks = [f"📦 訂單 #{i}\n" + "x" * 90 for i in range(100)]
+    chunks = split_text("\n\n".join(blocks), limit=1000)
+    assert all(len(chunk) <= 1000 for chunk in chunks)
+    assert "\n\n".join(chunks) == "\n\n".join(blocks)
+
+@pytest.mark.parametrize("backend", ["memory", "sqlite"])
+def test_rate_limiter(tmp_path, backend):
+    """測試每位使用者與全域限流"""
+    if backend == "sqlite":
+        store = SqliteBucketStore(str(tmp_path / "ratelimit.db"))
+    else:
+        store = MemoryBucketStore()
+    limiter = RateLimiter(store, user_rate=0.001, user_burst=3, global_rate=0.001, global_burst=5)
+    
+    assert [limiter.check("flood_user") for _ in range(3)] == [None, None, None]
+    assert limiter.check("flood_user") == THROTTLED_MESSAGE
+    # 其他使用者不受影響，直到全域額度用完
+    assert limiter.check("other_user") is None
+    assert limiter.check("another_user") is None
+    assert limiter.check("third_user") == BUSY_MESSAGE
+    assert limiter.stats() == {"allowed": 5, "rejected_user": 1, "rejected_global": 1}
+
+def test_rate_limiter_eviction():
+    """測試超過上限時移除最久未使用的使用者 bucket，全域限制不受影響"""
+    store = MemoryBucketStore(max_keys=3)
+    limiter = RateLimiter(store, user_rate=0.001, user_burst=1, global_rate=0.001, global_burst=10)
+    for user_id in ("evict_a", "evict_b", "evict_c"):
+        assert limiter.check(user_id) is None
+    assert list(store._buckets) == ["user:evict_b", "user:evict_c", GLOBAL_KEY]
+    assert store._buckets[GLOBAL_KEY][0] == pytest.approx(7, abs=0.01)
+    # 仍在保留中的使用者維持限流
+    assert limiter.check("evict_c") == THROTTLED_MESSAGE
+
+def test_rate_limited_reply(client, monkeypatch):
+    """測試被限流的訊息直接回覆，不進入命令處理"""
+    replies = []
+    monkeypatch.setattr(app_module.line_bot_api, "reply_message",
+                        lambda token, messages: replies.append(messages[0].text))
+    monkeypatch.setattr(app_module, "rate_limiter",
+                        RateLimiter(MemoryBucketStore(), user_rate=0.001, user_burst=1))
+    monkeypatch.setattr(webhook_module, "handle_command", lambda text, user_id: "handled")
+    
+    for _ in range(2):
+        body = make_webhook_body("menu", user_id="throttled_user")
+        client.post('/callback', data=body, headers={'X-Line-Signature': sign(body)})
+    if app_module.event_queue is not None:
+        app_module.event_queue.drain()
+    assert replies == ["handled", THROTTLED_MESSAGE]
+    assert app_module.rate_limiter.stats()["rejected_user"] == 1
+
+def test_metrics_aggregation():
+    """測試各執行緒的指標在抓取時合併"""
+    registry = Registry()
+    requests_total = registry.register(Counter("test_requests_total", "測試計數", ["path"]))
+    latency = registry.register(Histogram("test_latency_seconds", "測試延遲", buckets=(0.1, 1.0)))
+    
+    def work():
+        for _ in range(100):
+            requests_total.inc("/callback")
+            latency.observe(0.5)
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    latency.observe(0.05)
+    
+    text = registry.render()
+    assert 'test_requests_total{path="/callback"} 400' in text
+    assert 'test_latency_seconds_bucket{le="0.1"} 1' in text
+    assert 'test_latency_seconds_bucket{le="1"} 401' in text
+    assert 'test_latency_seconds_bucket{le="+Inf"} 401' in text
+    assert "test_latency_seconds_count 401" in text
+    # 已結束執行緒的分片併入累計值
+    assert len(requests_total._shards) == 0
+
+def test_metrics_endpoint(client):
+    """測試 /metrics 輸出命令延遲與訂單數量"""
+    handle_command("help", "metrics_user")
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.content_type.startswith("text/plain")
+    text = response.get_data(as_text=True)
+    assert "# TYPE linebot_command_duration_seconds histogram" in text
+    assert 'linebot_command_duration_seconds_count{command="help"}' in text
+    assert 'linebot_orders{status="pending"}' in text
+
+@pytest.mark.parametrize("shared", [False, True])
+def test_event_deduplicator(tmp_path, shared):
+    """測試以事件 ID 排除重送事件"""
+    store = SqliteDedupStore(str(tmp_path / "dedup.db"), ttl=60) if shared else None
+    dedup = EventDeduplicator(MemoryDedupStore(ttl=60, max_size=2), store)
+    assert dedup.is_duplicate("event-1") is False
+    assert dedup.is_duplicate("event-1", redelivery=True) is True
+    assert dedup.is_duplicate("event-2", redelivery=True) is False
+    assert dedup.is_duplicate(None, redelivery=True) is False
+    # 重送的事件比原本的事件先處理時，原本的事件視為重複
+    assert dedup.is_duplicate("event-0", redelivery=True) is False
+    assert dedup.is_duplicate("event-0") is True
+    
+    # 快取容量只有 2 筆：event-1 被擠出後只有共用儲存記得
+    dedup.is_duplicate("event-3")
+    assert dedup.is_duplicate("event-1", redelivery=True) is shared
+    
+    # 其他 worker（各自的快取）共用同一份儲存
+    if shared:
+        other = EventDeduplicator(MemoryDedupStore(ttl=60), SqliteDedupStore(str(tmp_path / "dedup.db"), ttl=60))
+        assert other.is_duplicate("event-3", redelivery=True) is True
+    assert dedup.stats()["redeliveries"] == 4
+
+def test_redelivered_order_not_duplicated(client, monkeypatch):
+    """測試 LINE 重送的下單事件不會重複建立訂單"""
+    monkeypatch.setattr(app_module.line_bot_api, "reply_message", lambda token, messages: None)
+    monkeypatch.setattr(app_module, "rate_limiter", None)
+    monkeypatch.setattr(app_module, "deduplicator", EventDeduplicator(MemoryDedupStore(ttl=60)))
+    menu_manager.add_item("test_admin", "重送商品", 10, 10)
+    before = order_manager.count_orders()
+    try:
+        for redelivery in (False, True, True):
+            body = make_webhook_body("order 重送商品 1", user_id="redelivery_user",
+                                     event_id="event-order", redelivery=redelivery)
+            client.post('/callback', data=body, headers={'X-Line-Signature': sign(body)})
+        if app_module.event_queue is not None:
+            app_module.event_queue.drain()
+        assert order_manager.count_orders() == before + 1
+        assert menu_manager.get_item("重送商品")["stock"] == 9
+        assert app_module.deduplicator.stats()["duplicates"] == 2
+    finally:
+        menu_manager.delete_item("test_admin", "重送商品")
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_unit_of_work(tmp_path, monkeypatch, backend):
+    """測試批次中的多筆變更只寫入一次，且庫存不足的操作不影響其他操作"""
+    if backend == "sqlite":
+        db = SqliteDatabase(str(tmp_path / "store.db"))
+        menu_repository, order_repository = SqliteMenuRepository(db), SqliteOrderRepository(db)
+    else:
+        menu_repository = JsonMenuRepository(str(tmp_path / "menu.json"))
+        order_repository = JsonOrderRepository(str(tmp_path / "orders.json"))
+    menu = MenuManager(menu_repository)
+    orders = OrderManager(order_repository, menu)
+    menu.add_item("test_admin", "批次商品", 10, 3)
+    
+    dumps = []
+    original_dump = storage_module._dump_json
+    monkeypatch.setattr(storage_module, "_dump_json", lambda path, data: (dumps.append(path), original_dump(path, data)))
+    with unit_of_work(orders.repository, menu.repository):
+        assert "訂單已建立" in orders.create_order("batch_user", [{"name": "批次商品", "quantity": 2}])
+        assert "庫存不足" in orders.create_order("batch_user", [{"name": "批次商品", "quantity": 2}])
+        assert "訂單已建立" in orders.create_order("batch_user", [{"name": "批次商品", "quantity": 1}])
+        assert dumps == []
+    if backend == "json":
+        assert dumps == [str(tmp_path / "menu.json")]
+    
+    assert MenuManager(menu_repository).get_item("批次商品")["stock"] == 0
+    
+    # 只有讀取的批次不取得鎖（交易），其他執行緒可同時寫入
+    with unit_of_work(orders.repository, menu.repository):
+        assert "批次商品" in menu.get_menu()
+        orders.get_user_orders("batch_user")
+        writer = threading.Thread(target=menu.edit_item, args=("test_admin", "批次商品"),
+                                  kwargs={"description": "並行寫入"})
+        writer.start()
+        writer.join(timeout=5)
+        assert not writer.is_alive()
+    orders.repository.close()
+    reloaded = OrderManager(order_repository, menu)
+    assert [o["id"] for o in reloaded.orders["batch_user"]] == [1, 2]
+    reloaded.repository.close()
+
+def test_failed_webhook_batch_keeps_applied_writes(tmp_path, monkeypatch):
+    """測試 webhook 批次中途失敗時，已套用的變更仍寫入 SQLite，與記憶體及已記錄的事件 ID 一致"""
+    path = str(tmp_path / "store.db")
+    menu = MenuManager(SqliteMenuRepository(SqliteDatabase(path)))
+    orders = OrderManager(SqliteOrderRepository(menu.repository.db), menu)
+    menu.add_item("test_admin", "失敗商品", 10, 5)
+    for module in (app_module, command_handler_module):
+        monkeypatch.setattr(module, "menu_manager", menu)
+        monkeypatch.setattr(module, "order_manager", orders)
+    monkeypatch.setattr(app_module, "WEBHOOK_BATCH", True)
+    monkeypatch.setattr(app_module, "rate_limiter", None)
+    monkeypatch.setattr(app_module, "deduplicator", EventDeduplicator(MemoryDedupStore(ttl=60)))
+    
+    def fail(replies):
+        raise RuntimeError("回覆失敗")
+    monkeypatch.setattr(app_module, "dispatch_reply", fail)
+    body = make_webhook_body("order 失敗商品 2", user_id="failed_batch_user", event_id="event-failed-batch")
+    with pytest.raises(RuntimeError):
+        app_module.process_webhook((body, sign(body)))
+    assert menu.get_item("失敗商品")["stock"] == 3
+    
+    db = SqliteDatabase(path)
+    assert SqliteMenuRepository(db).load()["失敗商品"]["stock"] == 3
+    assert [o["id"] for o in SqliteOrderRepository(db).load()["failed_batch_user"]] == [1]
+    db.close()
+    
+    # 重送的事件被略過：訂單已寫入，不會遺失也不會重複建立
+    monkeypatch.setattr(app_module, "dispatch_reply", lambda replies: None)
+    body = make_webhook_body("order 失敗商品 2", user_id="failed_batch_user", event_id="event-failed-batch",
+                             redelivery=True)
+    app_module.process_webhook((body, sign(body)))
+    assert orders.count_orders() == 1 and menu.get_item("失敗商品")["stock"] == 3
+    menu.repository.db.close()
+
+def test_multi_event_payload(client, monkeypatch):
+    """測試同一個 webhook 的多個事件一起處理並各自回覆"""
+    replies = []
+    monkeypatch.setattr(app_module.line_bot_api, "reply_message",
+                        lambda token, messages: replies.append(token))
+    monkeypatch.setattr(app_module, "rate_limiter", None)
+    events = [json.loads(make_webhook_body(text, user_id=f"multi_user_{i}"))["events"][0]
+              for i, text in enumerate(["help", "menu", "myorders"])]
+    for i, event in enumerate(events):
+        event["replyToken"] = f"reply-token-{i}"
+    body = json.dumps({"destination": "bot", "events": events})
+    
+    response = client.post('/callback', data=body, headers={'X-Line-Signature': sign(body)})
+    assert response.status_code == 200
+    if app_module.event_queue is not None:
+        app_module.event_queue.drain()
+    assert sorted(replies) == ["reply-token-0", "reply-token-1", "reply-token-2"]
+
+def test_user_state_sweep(tmp_path):
+    """測試舊版 ISO 時間轉換與過期 session、封鎖的清理"""
+    path = str(tmp_path / "user_state.json")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({
+            "expired_admin": dict(UserRecord().to_dict(), is_admin=True, is_logged_in=True, session_token="t",
+                                              session_created="2020-01-01T00:00:00"),
+            "blocked_user": dict(UserRecord().to_dict(), login_attempts=3, blocked_until="2999-01-01T00:00:00"),
+            "idle_user": UserRecord().to_dict(),
+        }, f)
+    state = UserState(JsonStateRepository(path), write_behind=False)
+    assert isinstance(state.states["blocked_user"]["blocked_until"], float)
+    assert state.is_blocked("blocked_user")
+    assert not state.has_valid_session("expired_admin")
+    
+    result = state.sweep()
+    assert result == {"sessions": 1, "blocks": 0, "evicted": 1}
+    assert "idle_user" not in state.states
+    assert state.states["expired_admin"]["session_token"] is None
+    
+    # 封鎖到期後清除，使用者回到預設狀態並被移除
+    result = state.sweep(now=state.states["blocked_user"]["blocked_until"])
+    assert result == {"sessions": 0, "blocks": 1, "evicted": 1}
+    with open(path, encoding="utf-8") as f:
+        assert sorted(json.load(f)) == ["expired_admin"]
+
+def test_records(tmp_path):
+    """測試 __slots__ 紀錄的 dict 式存取與 JSON 格式互轉"""
+    order = Order(1, "u1", [OrderItem("商品A", 2, 50, 100)], 100, "pending", 1700000000.0, 1700000000.0)
+    assert not hasattr(order, "__dict__")
+    assert order["status"] == order.status == "pending"
+    assert "items" in order and "missing" not in order
+    with pytest.raises(KeyError):
+        order["missing"] = 1
+    
+    data = json.loads(json.dumps(order.to_dict()))
+    assert isinstance(data["created_at"], str)
+    assert Order.from_dict(data) == order
+    
+    # 舊版使用者狀態的 ISO 時間字串載入後轉為 epoch 秒
+    states_file = str(tmp_path / "user_state.json")
+    with open(states_file, "w", encoding="utf-8") as f:
+        json.dump({"u1": dict(UserRecord().to_dict(), blocked_until="2999-01-01T00:00:00")}, f)
+    repository = JsonStateRepository(states_file)
+    record = repository.load()["u1"]
+    assert isinstance(record, UserRecord) and isinstance(record.blocked_until, float)
+    repository.save_all({"u1": record, "u2": UserRecord()})
+    reloaded = repository.load()
+    assert reloaded["u1"] == record and reloaded["u2"].is_default()
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_export_orders(tmp_path, backend):
+    """測試依狀態與建立時間篩選並逐批輸出訂單"""
+    if backend == "sqlite":
+        repository = SqliteOrderRepository(SqliteDatabase(str(tmp_path / "store.db")))
+    else:
+        repository = JsonOrderRepository(str(tmp_path / "orders.json"))
+    repository.load()
+    day = 86400.0
+    for order_id in range(1, 8):
+        status = "cancelled" if order_id % 3 == 0 else "pending"
+        created = 1700000000.0 + order_id * day
+        order = Order(order_id, f"u{order_id % 2}", [OrderItem("商品,A", 2, 50, 100)], 100, status, created, created)
+        if backend == "json":
+            # JSON 後端與管理器共用記憶體中的訂單
+            repository.orders.setdefault(order.user_id, []).append(order)
+        repository.add(order)
+    
+    kwargs = {"chunk_size": 2} if backend == "sqlite" else {}
+    orders = list(repository.iter_orders("pending", 1700000000.0 + 2 * day, 1700000000.0 + 7 * day, **kwargs))
+    assert [o.id for o in orders] == [2, 4, 5]
+    
+    chunks = list(export_orders(repository.iter_orders(**kwargs), "csv", chunk_size=64))
+    assert len(chunks) > 1
+    lines = "".join(chunks).lstrip("\ufeff").splitlines()
+    assert lines[0] == "id,user_id,status,total,created_at,updated_at,items"
+    assert len(lines) == 8 and '"商品,A x 2"' in lines[1]
+    
+    records = [json.loads(line) for line in "".join(export_orders(repository.iter_orders("cancelled"), "jsonl")).splitlines()]
+    assert [r["id"] for r in records] == [3, 6]
+    repository.close()
+
+def test_export_endpoint(client, monkeypatch):
+    """測試管理員取得的簽章連結與 EXPORT_TOKEN 才能串流匯出訂單"""
+    admin_id = "export_admin"
+    assert handle_command("export orders", admin_id) == "此功能需要管理員權限"
+    user_state.set_admin_status(admin_id, True)
+    user_state.set_login_status(admin_id, True)
+    user_state.set_session_token(admin_id, "token")
+    menu_manager.add_item("test_admin", "匯出商品", 10, 10)
+    order_manager.create_order("export_user", [{"name": "匯出商品", "quantity": 1}])
+    order_id = order_manager.orders["export_user"][-1].id
+    
+    assert "日期格式" in handle_command("export orders from 2024/01/01", admin_id)
+    reply = handle_command("export orders jsonl pending", admin_id)
+    link = reply.splitlines()[-1]
+    assert link.startswith("/export/orders?")
+    
+    response = client.get(link)
+    assert response.status_code == 200
+    assert response.content_type.startswith("application/x-ndjson")
+    exported = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert order_id in [o["id"] for o in exported]
+    assert {o["status"] for o in exported} == {"pending"}
+    
+    # 竄改參數、過期連結與未授權的請求一律拒絕
+    assert client.get(link.replace("pending", "cancelled")).status_code == 403
+    params = dict(parse_qsl(urlsplit(link).query))
+    assert verify_export_request(params, now=int(params["expires"]))
+    assert not verify_export_request(params, now=int(params["expires"]) + 1)
+    assert client.get("/export/orders").status_code == 403
+    monkeypatch.setenv("EXPORT_TOKEN", "report-token")
+    response = client.get("/export/orders?format=csv", headers={"Authorization": "Bearer report-token"})
+    assert response.status_code == 200 and response.content_type.startswith("text/csv")
+    
+    menu_manager.delete_item("test_admin", "匯出商品")
+    user_state.set_login_status(admin_id, False)
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_snapshot_fallback(tmp_path, compress):
+    """測試快照緊湊寫入、gzip 自動辨識與損毀時改用上一份快照"""
+    path = str(tmp_path / "menu.json")
+    assert read_snapshot(path, {}) == {}
+    write_snapshot(path, {"商品A": {"price": 10, "stock": 1}}, compress=compress)
+    write_snapshot(path, {"商品A": {"price": 20, "stock": 1}}, compress=compress)
+    with open(path, "rb") as f:
+        assert f.read(2) == b"\x1f\x8b" if compress else f.read() == '{"商品A":{"price":20,"stock":1}}'.encode()
+    assert read_snapshot(path, {}) == {"商品A": {"price": 20, "stock": 1}}
+    
+    # 寫到一半當機：主檔截斷時載入上一份快照
+    with open(path, "r+b") as f:
+        f.truncate(5)
+    assert read_snapshot(path, {}) == {"商品A": {"price": 10, "stock": 1}}
+    assert JsonMenuRepository(path).load()["商品A"].price == 10
+    
+    with open(backup_path(path), "wb") as f:
+        f.write(b"[]")
+    with pytest.raises(SnapshotError):
+        read_snapshot(path, {})
+
+def test_lazy_startup(tmp_path):
+    """測試匯入 app 時不讀取資料檔，warm_up 後才建立管理器"""
+    created = []
+    instance = LazyInstance(lambda: created.append(1) or UserState(JsonStateRepository(str(tmp_path / "s.json"))))
+    assert not is_initialized(instance) and created == []
+    threads = [threading.Thread(target=lambda: instance.is_admin("u")) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert created == [1] and is_initialized(instance)
+    instance.flush_delay = 5
+    assert instance._get().flush_delay == 5
+    
+    code = (
+        "import json, app\n"
+        "managers = (app.user_state, app.menu_manager, app.order_manager)\n"
+        "from utils.lazy import is_initialized\n"
+        "print(json.dumps([is_initialized(m) for m in managers]))\n"
+        "app.warm_up()\n"
+        "print(json.dumps([is_initialized(m) for m in managers]))\n"
+    )
+    env = dict(os.environ, DATA_DIR=str(tmp_path / "data"), WEBHOOK_ASYNC="false")
+    result = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True, timeout=60,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    assert result.returncode == 0, result.stderr
+    before, after = [json.loads(line) for line in result.stdout.splitlines()[-2:]]
+    assert before == [False, False, False] and after == [True, True, True]
+
+def test_exit_drains_queue_before_flush(tmp_path):
+    """測試結束時先處理完事件佇列，再寫入使用者狀態"""
+    code = (
+        "import time, app\n"
+        "from utils.user_state import user_state\n"
+        "app.warm_up()\n"
+        "app.event_queue.handler = lambda job: (time.sleep(0.2), user_state.increment_login_attempts('exit_user'))\n"
+        "app.event_queue.submit(None)\n"
+    )
+    data_dir = tmp_path / "data"
+    env = dict(os.environ, DATA_DIR=str(data_dir), WEBHOOK_ASYNC="true", USER_STATE_WRITE_BEHIND="true",
+               USER_STATE_FLUSH_DELAY="60")
+    result = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True, timeout=60,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    assert result.returncode == 0, result.stderr
+    state = UserState(JsonStateRepository(str(data_dir / "user_state.json")), write_behind=False)
+    assert state.states["exit_user"]["login_attempts"] == 1
+
+def test_after_fork_reinitializes(tmp_path):
+    """測試 fork 後重建鎖、計時器、清理執行緒與日誌檔"""
+    state = UserState(JsonStateRepository(str(tmp_path / "user_state.json")), write_behind=True, flush_delay=60)
+    state.set_admin_status("fork_user", True)
+    old_lock, old_timer = state._lock, state._flush_timer
+    assert old_timer is not None
+    state.after_fork()
+    old_timer.cancel()
+    assert state._lock is not old_lock and state._flush_timer is None
+    assert state._sweeper is not None and state._sweeper.is_alive()
+    state.stop_sweeper()
+    state.flush()
+    assert UserState(JsonStateRepository(str(tmp_path / "user_state.json"))).is_admin("fork_user")
+    
+    repository = JsonOrderRepository(str(tmp_path / "orders.json"))
+    repository.load()
+    for order_id in (1, 2):
+        repository.add(Order(order_id, "fork_user", [], 0, "pending", 1700000000.0, 1700000000.0))
+        assert repository.journal._file is not None
+        repository.after_fork()
+        assert repository.journal._file is None
+    assert sum(1 for _ in repository.journal.replay()) == 2
+
+def test_async_callback(monkeypatch):
+    """測試 asyncio 入口：同一個 webhook 的多個事件以非同步 API 同時回覆"""
+    stub = LineApiStub().start()
+    monkeypatch.setenv('LINE_API_ENDPOINT', stub.endpoint)
+    monkeypatch.setenv('LINE_HTTP_BACKOFF', '0')
+    monkeypatch.setattr(async_app_module, "rate_limiter", None)
+    events = [json.loads(make_webhook_body(text, user_id=f"async_user_{i}"))["events"][0]
+              for i, text in enumerate(["help", "menu", "myorders"])]
+    for i, event in enumerate(events):
+        # v3 解析器要求完整的事件欄位
+        event.update(replyToken=f"async-token-{i}", webhookEventId=f"async-event-{i}",
+                     deliveryContext={"isRedelivery": False})
+        event["message"]["quoteToken"] = f"quote-{i}"
+    body = json.dumps({"destination": "bot", "events": events})
+    
+    async def run():
+        web_app = async_app_module.create_app()
+        async with TestClient(TestServer(web_app)) as client:
+            response = await client.post('/callback', data=body, headers={'X-Line-Signature': 'invalid'})
+            assert response.status == 400
+            # 第一次回覆遇到 429 時重試
+            stub.statuses = [429]
+            response = await client.post('/callback', data=body, headers={'X-Line-Signature': sign(body)})
+            assert response.status == 200
+            await asyncio.gather(*web_app[async_app_module.PENDING])
+    
+    try:
+        asyncio.run(run())
+        replies = sorted((r["body"]["replyToken"], r["body"]["messages"][0]["text"]) for r in stub.requests)
+        assert [token for token, _ in replies] == ["async-token-0", "async-token-1", "async-token-2"]
+        assert "使用說明" in replies[0][1]
+    finally:
+        stub.stop()
+
+def test_async_callback_failure(monkeypatch):
+    """測試 asyncio 入口背景處理失敗時記錄錯誤並計入指標"""
+    monkeypatch.setenv('LINE_API_ENDPOINT', 'http://127.0.0.1:1')
+    monkeypatch.setattr(async_app_module, "WEBHOOK_ASYNC", True)
+    
+    def fail(events):
+        raise RuntimeError("提交失敗")
+    monkeypatch.setattr(async_app_module, "handle_events", fail)
+    event = json.loads(make_webhook_body("help", user_id="async_failure_user"))["events"][0]
+    event.update(webhookEventId="async-failure-event", deliveryContext={"isRedelivery": False})
+    event["message"]["quoteToken"] = "quote-failure"
+    body = json.dumps({"destination": "bot", "events": [event]})
+    before = WEBHOOK_ERRORS.collect().get((), 0)
+    
+    async def run():
+        web_app = async_app_module.create_app()
+        async with TestClient(TestServer(web_app)) as client:
+            response = await client.post('/callback', data=body, headers={'X-Line-Signature': sign(body)})
+            assert response.status == 200
+            results = await asyncio.gather(*web_app[async_app_module.PENDING], return_exceptions=True)
+            assert [type(result) for result in results] == [RuntimeError]
+    
+    asyncio.run(run())
+    assert WEBHOOK_ERRORS.collect().get((), 0) == before + 1
@@ -0,0 +1,161 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import pytest
+
+from utils.menu import MenuManager
+from utils.order import OrderManager
+from utils.user_state import UserState
+from utils.storage import (
+    JsonMenuRepository, JsonOrderRepository, JsonStateRepository, SqliteDatabase,
+    SqliteMenuRepository, SqliteOrderRepository, SqliteStateRepository, unit_of_work
+)
+
+INITIAL_STOCK = 100
+ORDERS = 300
+PROCESSES = 8
+THREADS = 8
+
+def _create_managers(backend, data_dir):
+    if backend == "sqlite":
+        db = SqliteDatabase(os.path.join(data_dir, "store.db"))
+        menu = MenuManager(SqliteMenuRepository(db))
+        return menu, OrderManager(SqliteOrderRepository(db), menu)
+    menu = MenuManager(JsonMenuRepository(os.path.join(data_dir, "menu.json")))
+    return menu, OrderManager(JsonOrderRepository(os.path.join(data_dir, "orders.json")), menu)
+
+def _place_orders(backend, data_dir, start_event, count):
+    """在子行程中連續下單，返回成功扣除的件數與訂單編號"""
+    menu, orders = _create_managers(backend, data_dir)
+    start_event.wait()
+    sold = 0
+    order_ids = []
+    for i in range(count):
+        quantity = 1 + i % 2
+        result = orders.create_order(f"user_{os.getpid()}", [
+            {"name": "限量商品", "quantity": quantity},
+            {"name": "贈品", "quantity": 1}
+        ])
+        if "訂單已建立" in result:
+            sold += quantity
+            order_ids.append(max(orders.orders_by_id))
+        else:
+            assert "庫存不足" in result, result
+    orders.repository.close()
+    return sold, order_ids
+
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_parallel_orders_do_not_oversell(tmp_path, backend):
+    """多個行程同時下單時不可超賣"""
+    data_dir = str(tmp_path)
+    menu, _ = _create_managers(backend, data_dir)
+    menu.add_item("test_admin", "限量商品", 10, INITIAL_STOCK)
+    menu.add_item("test_admin", "贈品", 1, INITIAL_STOCK)
+    
+    ctx = multiprocessing.get_context("fork")
+    start_event = ctx.Manager().Event()
+    with ProcessPoolExecutor(PROCESSES, mp_context=ctx) as pool:
+        futures = [
+            pool.submit(_place_orders, backend, data_dir, start_event, ORDERS // PROCESSES)
+            for _ in range(PROCESSES)
+        ]
+        start_event.set()
+        results = [f.result() for f in futures]
+    sold = sum(r[0] for r in results)
+    order_ids = [order_id for r in results for order_id in r[1]]
+    
+    menu.load_menu()
+    remaining = menu.get_item("限量商品")["stock"]
+    assert remaining >= 0
+    assert sold + remaining == INITIAL_STOCK
+    # 需求遠大於庫存，應恰好售完或只剩不足一筆訂單的數量
+    assert remaining <= 1
+    # 兩項商品在同一交易中扣除，贈品數量必須與成功訂單數一致
+    assert menu.get_item("贈品")["stock"] == INITIAL_STOCK - len(order_ids)
+    # 各 worker 配置的訂單編號不可重複
+    assert len(set(order_ids)) == len(order_ids)
+
+def _create_repositories(backend, data_dir):
+    """建立新的儲存實例（用來從磁碟重新載入）"""
+    if backend == "sqlite":
+        db = SqliteDatabase(os.path.join(data_dir, "store.db"))
+        return SqliteMenuRepository(db), SqliteOrderRepository(db), SqliteStateRepository(db)
+    orders = JsonOrderRepository(os.path.join(data_dir, "orders.json"))
+    orders.compact_threshold = 20  # 讓快照壓縮與其他執行緒的寫入交錯
+    return (JsonMenuRepository(os.path.join(data_dir, "menu.json")), orders,
+            JsonStateRepository(os.path.join(data_dir, "user_state.json")))
+
+@pytest.mark.parametrize("write_behind", [False, True])
+@pytest.mark.parametrize("backend", ["json", "sqlite"])
+def test_threaded_managers(tmp_path, backend, write_behind):
+    """同一行程內多個執行緒（gthread worker）同時讀寫商品、訂單與使用者狀態"""
+    data_dir = str(tmp_path)
+    menu_repo, order_repo, state_repo = _create_repositories(backend, data_dir)
+    menu = MenuManager(menu_repo)
+    orders = OrderManager(order_repo, menu)
+    users = UserState(state_repo, write_behind=write_behind, flush_delay=0.01)
+    menu.add_item("test_admin", "限量商品", 10, INITIAL_STOCK)
+    
+    rounds = ORDERS // THREADS
+    start = threading.Barrier(THREADS + 2)
+    stop = threading.Event()
+    
+    def worker(n):
+        start.wait()
+        for i in range(rounds):
+            # 一半的執行緒以批次處理，與其他執行緒交錯取得儲存的鎖
+            batch = unit_of_work(users, order_repo, menu_repo) if n % 2 else unit_of_work()
+            with batch:
+                result = orders.create_order(f"user_{n}", [{"name": "限量商品", "quantity": 1}])
+                assert "訂單已建立" in result or "庫存不足" in result, result
+                users.increment_login_attempts("shared")
+                users.set_session_token(f"user_{n}", "token")
+                users.clear_session_token(f"user_{n}")
+                assert "限量商品" in menu.get_menu()
+                orders.get_user_orders(f"user_{n}")
+                orders.view_orders("test_admin", "pending")
+            if i % 3 == 0 and orders.get_all_orders():
+                orders.update_order_status("test_admin", orders.get_all_orders()[-1].id, "cancelled")
+    
+    def sweeper():
+        start.wait()
+        while not stop.is_set():
+            users.sweep()
+            orders.status_counts()
+    
+    with ThreadPoolExecutor(THREADS + 1) as pool:
+        sweeping = pool.submit(sweeper)
+        futures = [pool.submit(worker, n) for n in range(THREADS)]
+        start.wait()
+        for future in futures:
+            future.result(timeout=120)  # 逾時表示 deadlock
+        stop.set()
+        sweeping.result(timeout=120)
+    users.flush()
+    
+    # 不可超賣：剩餘庫存加上未取消訂單的數量等於初始庫存
+    active = [o for o in orders.get_all_orders() if o.status != "cancelled"]
+    stock = menu.get_item("限量商品")["stock"]
+    assert stock >= 0
+    assert stock + len(active) == INITIAL_STOCK
+    # 索引與各使用者的訂單串列維持一致且依編號排序
+    assert orders.count_orders() == len(orders.orders_by_id)
+    assert sum(orders.status_counts().values()) == orders.count_orders()
+    for user_orders in orders.orders.values():
+        assert [o.id for o in user_orders] == sorted(o.id for o in user_orders)
+    # 同一位使用者的遞增不可遺失
+    assert users.get_login_attempts("shared") == THREADS * rounds
+    
+    # 重新載入後與記憶體中一致（壓縮快照期間的寫入不可遺失）
+    menu_repo, order_repo, state_repo = _create_repositories(backend, data_dir)
+    reloaded = OrderManager(order_repo, MenuManager(menu_repo))
+    assert {o.id: o.status for o in reloaded.get_all_orders()} == \
+        {o.id: o.status for o in orders.get_all_orders()}
+    assert reloaded.menu_manager.get_item("限量商品")["stock"] == stock
+    states = state_repo.load()
+    assert states["shared"]["login_attempts"] == THREADS * rounds
+    # 清除 session 後回到預設狀態的使用者會被清理並自儲存刪除
+    users.sweep()
+    assert not any(f"user_{n}" in state_repo.load() for n in range(THREADS))
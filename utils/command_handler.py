@@ -1,18 +1,84 @@
-from typing import List, Dict
-import re
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+import os
+import time
 from .auth import login, logout, is_admin
 from .menu import menu_manager
-from .order import order_manager
+from .order import VALID_STATUSES, order_manager
+from .export import EXPORT_FORMATS, create_export_link, date_range
 from .user_state import user_state
+from .metrics import COMMAND_DURATION, COMMAND_ERRORS
 
-def parse_order_command(command: str) -> List[Dict[str, int]]:
-    """解析訂單命令
-    格式：order 商品名稱1 數量1 商品名稱2 數量2 ...
-    """
-    parts = command.split()[1:]  # 移除 "order" 命令
-    if len(parts) % 2 != 0:
+INVALID_COMMAND = "無效的命令。輸入 help 查看使用說明。"
+ADMIN_REQUIRED = "此功能需要管理員權限"
+
+class Arg:
+    """命令參數定義"""
+
+    def __init__(self, name: str, type: Callable[[str], Any] = str, required: bool = True,
+                 rest: bool = False, check: Optional[Callable[[Any], bool]] = None,
+                 missing: Optional[str] = None, error: Optional[str] = None):
+        self.name = name
+        self.type = type
+        self.required = required
+        self.rest = rest  # 吃掉其餘所有參數（以空白接回）
+        self.check = check
+        self.missing = missing  # 缺少參數時的訊息
+        self.error = error  # 型別或檢查失敗時的訊息
+
+class Command:
+    """命令定義：關鍵字、參數格式、權限與說明"""
+
+    def __init__(self, words: str, handler: Callable[[str, Dict[str, Any]], str],
+                 args: Sequence[Arg] = (), parser: Optional[Callable[[List[str]], Dict[str, Any]]] = None,
+                 admin: bool = False, denied: str = ADMIN_REQUIRED,
+                 usage: str = "", description: str = "", section: Optional[str] = None):
+        self.words = tuple(words.split())
+        self.handler = handler
+        self.args = tuple(args)
+        self.parser = parser  # 自訂解析函式，取代 args
+        self.admin = admin
+        self.denied = denied
+        self.usage = usage
+        self.description = description
+        self.section = section  # 說明文件分類：general / admin / None（不列出）
+        self.label = " ".join(self.words)  # 指標標籤
+
+    def parse(self, tokens: List[str]) -> Dict[str, Any]:
+        """依參數格式解析命令參數"""
+        if self.parser is not None:
+            return self.parser(tokens)
+
+        values: Dict[str, Any] = {}
+        index = 0
+        for arg in self.args:
+            if arg.rest:
+                values[arg.name] = " ".join(tokens[index:]) if index < len(tokens) else None
+                index = len(tokens)
+                continue
+            if index >= len(tokens):
+                if arg.required:
+                    raise ValueError(arg.missing or f"命令格式：{self.usage}")
+                values[arg.name] = None
+                continue
+            raw = tokens[index]
+            index += 1
+            try:
+                value = arg.type(raw)
+                if arg.check is not None and not arg.check(value):
+                    raise ValueError
+            except ValueError:
+                raise ValueError(arg.error or f"參數 {arg.name} 格式錯誤：{raw}")
+            values[arg.name] = value
+
+        if index < len(tokens):
+            raise ValueError(f"命令格式：{self.usage}")
+        return values
+
+def parse_order_args(parts: List[str]) -> List[Dict[str, int]]:
+    """解析訂單參數：商品名稱1 數量1 商品名稱2 數量2 ..."""
+    if not parts or len(parts) % 2 != 0:
         raise ValueError("訂單格式錯誤，請使用：order 商品名稱 數量 [商品名稱 數量 ...]")
-    
+
     items = []
     for i in range(0, len(parts), 2):
         try:
@@ -21,162 +87,221 @@ def parse_order_command(command: str) -> List[Dict[str, int]]:
                 raise ValueError
         except ValueError:
             raise ValueError(f"商品數量必須為正整數：{parts[i + 1]}")
-        
+
         items.append({
             "name": parts[i],
             "quantity": quantity
         })
-    
+
     return items
 
-def parse_edit_menu_command(command: str) -> tuple[str, str, List[str]]:
-    """解析編輯商品命令
-    格式：
-    - edit menu add 商品名稱 價格 庫存 [描述]
-    - edit menu edit 商品名稱 [價格 庫存 描述]
-    - edit menu delete 商品名稱
+def parse_order_command(command: str) -> List[Dict[str, int]]:
+    """解析訂單命令
+    格式：order 商品名稱1 數量1 商品名稱2 數量2 ...
     """
-    parts = command.split()
-    if len(parts) < 4:
-        raise ValueError("命令格式錯誤")
-    
-    action = parts[2]
-    name = parts[3]
-    
-    if action == "add":
-        if len(parts) < 6:
-            raise ValueError("新增商品需要指定價格和庫存")
-        try:
-            price = int(parts[4])
-            stock = int(parts[5])
-            if price <= 0 or stock < 0:
-                raise ValueError
-        except ValueError:
-            raise ValueError("價格必須為正整數，庫存必須為非負整數")
-        
-        description = " ".join(parts[6:]) if len(parts) > 6 else ""
-        return action, name, [price, stock, description]
-    
-    elif action == "edit":
-        if len(parts) < 5:
-            raise ValueError("編輯商品需要至少一個參數")
+    return parse_order_args(command.split()[1:])  # 移除 "order" 命令
+
+def parse_page_args(args: List[str]) -> Tuple[List[str], Optional[int], bool]:
+    """解析分頁參數
+    格式：... [page 頁碼] 或 ... more
+    返回：(其餘參數, 頁碼, 是否接續上次查詢)
+    """
+    if args and args[-1] == "more":
+        return args[:-1], None, True
+    if len(args) >= 2 and args[-2] == "page":
         try:
-            price = int(parts[4]) if len(parts) > 4 else None
-            stock = int(parts[5]) if len(parts) > 5 else None
-            if (price is not None and price <= 0) or (stock is not None and stock < 0):
+            page = int(args[-1])
+            if page <= 0:
                 raise ValueError
         except ValueError:
-            raise ValueError("價格必須為正整數，庫存必須為非負整數")
-        
-        description = " ".join(parts[6:]) if len(parts) > 6 else None
-        return action, name, [price, stock, description]
-    
-    elif action == "delete":
-        return action, name, []
-    
-    else:
-        raise ValueError("無效的操作：" + action)
+            raise ValueError(f"頁碼必須為正整數：{args[-1]}")
+        return args[:-2], page, False
+    return args, None, False
+
+def _parse_myorders(tokens: List[str]) -> Dict[str, Any]:
+    args, page, more = parse_page_args(tokens)
+    if args:
+        raise ValueError("命令格式：myorders [page 頁碼|more]")
+    return {"page": page, "more": more}
+
+def _parse_view_orders(tokens: List[str]) -> Dict[str, Any]:
+    args, page, more = parse_page_args(tokens)
+    if len(args) > 1:
+        raise ValueError("命令格式：view orders [status] [page 頁碼|more]")
+    return {"status": args[0] if args else None, "page": page, "more": more}
+
+def _parse_export_orders(tokens: List[str]) -> Dict[str, Any]:
+    """解析匯出參數：[csv|jsonl] [status] [from 日期] [to 日期]"""
+    usage = "命令格式：export orders [csv|jsonl] [status] [from YYYY-MM-DD] [to YYYY-MM-DD]"
+    args: Dict[str, Any] = {"format": "csv", "status": None, "from": None, "to": None}
+    index = 0
+    while index < len(tokens):
+        token = tokens[index]
+        if token in ("from", "to"):
+            if index + 1 >= len(tokens):
+                raise ValueError(usage)
+            args[token] = tokens[index + 1]
+            index += 2
+            continue
+        if token in EXPORT_FORMATS:
+            args["format"] = token
+        elif token in VALID_STATUSES:
+            args["status"] = token
+        else:
+            raise ValueError(usage)
+        index += 1
+    date_range(args["from"], args["to"])  # 檢查日期格式
+    return args
+
+def _parse_edit_menu_fallback(tokens: List[str]) -> Dict[str, Any]:
+    """edit menu 後接未知操作或缺少商品名稱"""
+    if len(tokens) < 2:
+        raise ValueError("命令格式錯誤")
+    raise ValueError("無效的操作：" + tokens[0])
+
+# ---------------------------------------------------------------------------
+# 命令處理函式
+# ---------------------------------------------------------------------------
+
+def _admin_login(user_id: str, args: Dict[str, Any]) -> str:
+    success, message = login(user_id, args["password"])
+    return message
+
+def _help(user_id: str, args: Dict[str, Any]) -> str:
+    return ADMIN_HELP_TEXT if is_admin(user_id) else HELP_TEXT
+
+def _add_item(user_id: str, args: Dict[str, Any]) -> str:
+    return menu_manager.add_item(user_id, args["name"], args["price"], args["stock"],
+                                 args["description"] or "")
+
+def _export_orders(user_id: str, args: Dict[str, Any]) -> str:
+    link = create_export_link(args["format"], args["status"], args["from"], args["to"])
+    minutes = int(os.getenv('EXPORT_LINK_TTL', '600')) // 60
+    return f"📤 訂單匯出連結（{minutes} 分鐘內有效）：\n{link}"
+
+def _edit_item(user_id: str, args: Dict[str, Any]) -> str:
+    return menu_manager.edit_item(user_id, args["name"], args["price"], args["stock"],
+                                  args["description"])
+
+PRICE_STOCK_ERROR = "價格必須為正整數，庫存必須為非負整數"
+
+# 命令表：依說明文件的顯示順序排列
+COMMANDS: List[Command] = [
+    Command("menu", lambda uid, a: menu_manager.get_menu(),
+            usage="menu", description="查看商品目錄", section="general"),
+    Command("order", lambda uid, a: order_manager.create_order(uid, a["items"]),
+            parser=lambda tokens: {"items": parse_order_args(tokens)},
+            usage="order 商品名稱 數量 [商品名稱 數量 ...]", description="下訂單", section="general"),
+    Command("myorders", lambda uid, a: order_manager.get_user_orders(uid, a["page"], a["more"]),
+            parser=_parse_myorders,
+            usage="myorders [more]", description="查看我的訂單（more 查看下一頁）", section="general"),
+    Command("help", _help, usage="help", description="顯示此說明", section="general"),
+    Command("!admin", _admin_login,
+            args=[Arg("password", missing="請輸入管理員密碼"), Arg("_", rest=True, required=False)],
+            usage="!admin 密碼", description="登入管理員模式", section="admin"),
+    Command("edit menu add", _add_item, admin=True,
+            args=[
+                Arg("name", missing="命令格式錯誤"),
+                Arg("price", int, check=lambda v: v > 0,
+                    missing="新增商品需要指定價格和庫存", error=PRICE_STOCK_ERROR),
+                Arg("stock", int, check=lambda v: v >= 0,
+                    missing="新增商品需要指定價格和庫存", error=PRICE_STOCK_ERROR),
+                Arg("description", rest=True, required=False)
+            ],
+            usage="edit menu add 商品名稱 價格 庫存 [描述]", description="新增商品", section="admin"),
+    Command("edit menu edit", _edit_item, admin=True,
+            args=[
+                Arg("name", missing="命令格式錯誤"),
+                Arg("price", int, check=lambda v: v > 0,
+                    missing="編輯商品需要至少一個參數", error=PRICE_STOCK_ERROR),
+                Arg("stock", int, required=False, check=lambda v: v >= 0, error=PRICE_STOCK_ERROR),
+                Arg("description", rest=True, required=False)
+            ],
+            usage="edit menu edit 商品名稱 [價格 庫存 描述]", description="編輯商品", section="admin"),
+    Command("edit menu delete", lambda uid, a: menu_manager.delete_item(uid, a["name"]), admin=True,
+            args=[Arg("name", missing="命令格式錯誤")],
+            usage="edit menu delete 商品名稱", description="刪除商品", section="admin"),
+    Command("edit menu", lambda uid, a: "", admin=True, parser=_parse_edit_menu_fallback),
+    Command("view orders",
+            lambda uid, a: order_manager.view_orders(uid, a["status"], a["page"], a["more"]),
+            admin=True, parser=_parse_view_orders,
+            usage="view orders [status] [page 頁碼|more]", description="查看訂單", section="admin"),
+    Command("update order",
+            lambda uid, a: order_manager.update_order_status(uid, a["order_id"], a["status"]),
+            admin=True,
+            args=[
+                Arg("order_id", int, missing="命令格式：update order 訂單編號 狀態",
+                    error="訂單編號必須為數字"),
+                Arg("status", missing="命令格式：update order 訂單編號 狀態")
+            ],
+            usage="update order 訂單編號 狀態", description="更新訂單狀態", section="admin"),
+    Command("export orders", _export_orders, admin=True, parser=_parse_export_orders,
+            usage="export orders [csv|jsonl] [status] [from 日期] [to 日期]",
+            description="產生訂單匯出連結", section="admin"),
+    Command("logout", lambda uid, a: logout(uid), admin=True, denied="您不是管理員",
+            usage="logout", description="登出管理員模式", section="admin"),
+]
+
+def _build_dispatch_table(commands: List[Command]) -> Dict[str, List[Command]]:
+    """以第一個關鍵字建立查詢表，同一關鍵字下較長的命令優先比對"""
+    table: Dict[str, List[Command]] = {}
+    for command in commands:
+        table.setdefault(command.words[0], []).append(command)
+    for candidates in table.values():
+        candidates.sort(key=lambda c: len(c.words), reverse=True)
+    return table
+
+def _build_help_text(title: str, sections: List[Tuple[str, str]], footer: str = "") -> str:
+    parts = [title]
+    for section, heading in sections:
+        lines = [f"- {c.usage}：{c.description}" for c in COMMANDS if c.section == section]
+        parts.append(heading + "\n" + "\n".join(lines))
+    if footer:
+        parts.append(footer)
+    return "\n\n".join(parts)
+
+DISPATCH_TABLE = _build_dispatch_table(COMMANDS)
+
+# 說明文字在載入時組好，不在每次查詢時重建
+HELP_TEXT = _build_help_text(
+    "🤖 商品販售小幫手使用說明",
+    [("general", "一般指令：")],
+    "如需協助，請聯繫管理員。"
+)
+ADMIN_HELP_TEXT = _build_help_text(
+    "🤖 商品販售小幫手使用說明 (管理員模式)",
+    [("general", "一般指令："), ("admin", "管理員指令：")]
+)
+
+def resolve_command(tokens: List[str]) -> Optional[Command]:
+    """依關鍵字找出對應的命令"""
+    if not tokens:
+        return None
+    for command in DISPATCH_TABLE.get(tokens[0], ()):
+        size = len(command.words)
+        if tuple(tokens[:size]) == command.words:
+            return command
+    return None
 
 def handle_command(text: str, user_id: str) -> str:
     """處理使用者命令"""
-    text = text.strip()
-    
-    # 處理管理員登入
-    if text.startswith("!admin"):
-        parts = text.split()
-        if len(parts) == 1:
-            return "請輸入管理員密碼"
-        success, message = login(user_id, parts[1])
-        return message
-    
-    # 處理登出
-    if text == "logout":
-        if not is_admin(user_id):
-            return "您不是管理員"
-        return logout(user_id)
-    
-    # 處理一般命令
+    start = time.perf_counter()
+    tokens = text.split()
+    command = resolve_command(tokens)
+    if command is None:
+        COMMAND_DURATION.observe(time.perf_counter() - start, "invalid")
+        return INVALID_COMMAND
+
     try:
-        if text == "menu":
-            return menu_manager.get_menu()
-        
-        elif text == "help":
-            if not is_admin(user_id):
-                help_text = (
-                    "🤖 商品販售小幫手使用說明\n\n"
-                    "一般指令：\n"
-                    "- menu：查看商品目錄\n"
-                    "- order 商品名稱 數量 [商品名稱 數量 ...]：下訂單\n"
-                    "- myorders：查看我的訂單\n"
-                    "- help：顯示此說明\n\n"
-                    "如需協助，請聯繫管理員。"
-                )
-                return help_text
-            else:
-                help_text = (
-                    "🤖 商品販售小幫手使用說明 (管理員模式)\n\n"
-                    "一般指令：\n"
-                    "- menu：查看商品目錄\n"
-                    "- order 商品名稱 數量 [商品名稱 數量 ...]：下訂單\n"
-                    "- myorders：查看我的訂單\n"
-                    "- help：顯示此說明\n\n"
-                    "管理員指令：\n"
-                    "- !admin 密碼：登入管理員模式\n"
-                    "- edit menu add 商品名稱 價格 庫存 [描述]：新增商品\n"
-                    "- edit menu edit 商品名稱 [價格 庫存 描述]：編輯商品\n"
-                    "- edit menu delete 商品名稱：刪除商品\n"
-                    "- view orders [status]：查看訂單\n"
-                    "- update order 訂單編號 狀態：更新訂單狀態\n"
-                    "- logout：登出管理員模式"
-                )
-                return help_text
-        
-        elif text.startswith("order "):
-            items = parse_order_command(text)
-            return order_manager.create_order(user_id, items)
-        
-        elif text == "myorders":
-            return order_manager.get_user_orders(user_id)
-        
-        elif text.startswith("edit menu "):
-            if not is_admin(user_id):
-                return "此功能需要管理員權限"
-            
-            action, name, params = parse_edit_menu_command(text)
-            if action == "add":
-                return menu_manager.add_item(user_id, name, params[0], params[1], params[2])
-            elif action == "edit":
-                return menu_manager.edit_item(user_id, name, params[0], params[1], params[2])
-            else:  # delete
-                return menu_manager.delete_item(user_id, name)
-        
-        elif text.startswith("view orders"):
-            if not is_admin(user_id):
-                return "此功能需要管理員權限"
-            
-            parts = text.split()
-            status = parts[2] if len(parts) > 2 else None
-            return order_manager.view_orders(user_id, status)
-        
-        elif text.startswith("update order "):
-            if not is_admin(user_id):
-                return "此功能需要管理員權限"
-            
-            parts = text.split()
-            if len(parts) != 4:
-                return "命令格式：update order 訂單編號 狀態"
-            
-            try:
-                order_id = int(parts[2])
-            except ValueError:
-                return "訂單編號必須為數字"
-            
-            return order_manager.update_order_status(user_id, order_id, parts[3])
-        
-        else:
-            return "無效的命令。輸入 help 查看使用說明。"
-    
+        if command.admin and not is_admin(user_id):
+            return command.denied
+        args = command.parse(tokens[len(command.words):])
+        return command.handler(user_id, args)
+
     except ValueError as e:
         return str(e)
     except Exception as e:
-        return f"處理命令時發生錯誤：{str(e)}" 
\ No newline at end of file
+        COMMAND_ERRORS.inc(command.label)
+        return f"處理命令時發生錯誤：{str(e)}"
+    finally:
+        COMMAND_DURATION.observe(time.perf_counter() - start, command.label)
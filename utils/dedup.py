@@ -0,0 +1,129 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional
+from .storage import SqliteDatabase, get_data_dir
+
+class DedupStore:
+    """已處理事件 ID 的儲存介面"""
+
+    def add(self, event_id: str, now: float) -> bool:
+        """記錄事件 ID，返回是否為新事件（TTL 內已記錄過則返回 False）"""
+        raise NotImplementedError
+
+class MemoryDedupStore(DedupStore):
+    """行程內的 TTL + LRU 快取（單一 worker 使用）"""
+
+    def __init__(self, ttl: float, max_size: int = 100000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._seen: "OrderedDict[str, float]" = OrderedDict()  # event_id -> 記錄時間（由舊到新）
+        self._lock = threading.Lock()
+
+    def add(self, event_id, now):
+        with self._lock:
+            seen_at = self._seen.get(event_id)
+            if seen_at is not None and now - seen_at < self.ttl:
+                return False
+            self._put(event_id, now)
+        return True
+
+    def _put(self, event_id: str, now: float):
+        self._seen[event_id] = now
+        self._seen.move_to_end(event_id)
+        # 移除過期與超過容量的最舊紀錄
+        while self._seen:
+            oldest_id, oldest_at = next(iter(self._seen.items()))
+            if len(self._seen) <= self.max_size and now - oldest_at < self.ttl:
+                break
+            del self._seen[oldest_id]
+
+DEDUP_SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    event_id TEXT PRIMARY KEY,
+    seen_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_events_seen_at ON events (seen_at);
+"""
+
+class SqliteDedupStore(DedupStore):
+    """以 SQLite 檔案共用已處理事件（多個 worker 共用）"""
+
+    def __init__(self, path: str, ttl: float, purge_every: int = 1000):
+        self.db = SqliteDatabase(path, schema=DEDUP_SCHEMA)
+        self.ttl = ttl
+        self.purge_every = purge_every
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    def add(self, event_id, now):
+        with self.db.transaction() as conn:
+            cursor = conn.execute(
+                "INSERT INTO events (event_id, seen_at) VALUES (?, ?) "
+                "ON CONFLICT(event_id) DO UPDATE SET seen_at=excluded.seen_at "
+                "WHERE events.seen_at <= ?",
+                (event_id, now, now - self.ttl)
+            )
+            added = cursor.rowcount > 0
+        self._maybe_purge(now)
+        return added
+
+    def _maybe_purge(self, now: float):
+        """每寫入 purge_every 筆清除一次過期紀錄"""
+        with self._lock:
+            self._writes += 1
+            if self._writes < self.purge_every:
+                return
+            self._writes = 0
+        self.db.connection().execute("DELETE FROM events WHERE seen_at <= ?", (now - self.ttl,))
+
+class EventDeduplicator:
+    """以 webhook 事件 ID 排除 LINE 重送的事件
+
+    每個事件在處理前都以原子性的「檢查並記錄」登記：重送的事件可能比原本的
+    事件先被處理（例如原事件仍在佇列中），因此不能只檢查 isRedelivery 的事件。
+    有共用儲存時先查本行程的快取，再查共用儲存。
+    """
+
+    def __init__(self, cache: MemoryDedupStore, shared: Optional[DedupStore] = None):
+        self.cache = cache
+        self.shared = shared
+        self._lock = threading.Lock()
+        self._counters = {"accepted": 0, "duplicates": 0, "redeliveries": 0}
+
+    def is_duplicate(self, event_id: Optional[str], redelivery: bool = False) -> bool:
+        """記錄事件並返回是否已處理過（沒有事件 ID 時一律視為新事件）"""
+        if not event_id:
+            return False
+        now = time.time()
+        duplicate = not self.cache.add(event_id, now)
+        if not duplicate and self.shared is not None:
+            duplicate = not self.shared.add(event_id, now)
+        with self._lock:
+            if redelivery:
+                self._counters["redeliveries"] += 1
+            self._counters["duplicates" if duplicate else "accepted"] += 1
+        return duplicate
+
+    def stats(self) -> Dict[str, int]:
+        """取得事件統計"""
+        with self._lock:
+            return dict(self._counters)
+
+def create_deduplicator() -> Optional[EventDeduplicator]:
+    """依環境變數建立事件去重，WEBHOOK_DEDUP_ENABLED=false 時返回 None"""
+    if os.getenv('WEBHOOK_DEDUP_ENABLED', 'true').lower() != 'true':
+        return None
+    ttl = float(os.getenv('WEBHOOK_DEDUP_TTL', '86400'))
+    cache = MemoryDedupStore(ttl, int(os.getenv('WEBHOOK_DEDUP_CACHE_SIZE', '100000')))
+    backend = os.getenv('WEBHOOK_DEDUP_BACKEND', 'memory').lower()
+    if backend == "sqlite":
+        shared: Optional[DedupStore] = SqliteDedupStore(
+            os.getenv('WEBHOOK_DEDUP_SQLITE_PATH', os.path.join(get_data_dir(), "dedup.db")), ttl
+        )
+    elif backend == "memory":
+        shared = None
+    else:
+        raise ValueError(f"不支援的事件去重後端：{backend}（可用：memory, sqlite）")
+    return EventDeduplicator(cache, shared)
@@ -0,0 +1,110 @@
+import logging
+import queue
+import threading
+from typing import Any, Callable, Dict, List
+from .metrics import WEBHOOK_ERRORS
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+class EventQueue:
+    """有界工作佇列 + 工作執行緒池
+
+    /callback 驗證簽章後將 webhook 交給佇列即回應 200，由背景執行緒處理命令、
+    寫檔與回覆訊息。佇列已滿時由呼叫端執行緒直接處理（backpressure），
+    不會丟棄事件。
+    """
+
+    def __init__(self, handler: Callable[[Any], None], workers: int = 4, maxsize: int = 1000):
+        self.handler = handler
+        self.workers = workers
+        self.maxsize = maxsize
+        self._queue: "queue.Queue[Any]" = queue.Queue(maxsize)
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+        self._accepting = False
+        self._counters = {
+            "submitted": 0,   # 放入佇列的工作數
+            "processed": 0,   # 處理完成的工作數
+            "failed": 0,      # 處理時拋出例外的工作數
+            "overflow": 0,    # 佇列已滿改由呼叫端直接處理的工作數
+            "max_depth": 0    # 佇列深度最高值
+        }
+
+    def start(self):
+        """啟動工作執行緒"""
+        with self._lock:
+            if self._accepting:
+                return
+            self._accepting = True
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f"event-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def submit(self, job: Any) -> bool:
+        """提交工作，返回是否進入佇列（否則已在目前執行緒處理完畢）"""
+        if self._accepting:
+            try:
+                self._queue.put_nowait(job)
+            except queue.Full:
+                pass
+            else:
+                with self._lock:
+                    self._counters["submitted"] += 1
+                    depth = self._queue.qsize()
+                    if depth > self._counters["max_depth"]:
+                        self._counters["max_depth"] = depth
+                return True
+        with self._lock:
+            self._counters["overflow"] += 1
+        self._process(job)
+        return False
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is _STOP:
+                    return
+                self._process(job)
+            finally:
+                self._queue.task_done()
+
+    def _process(self, job: Any):
+        try:
+            self.handler(job)
+        except Exception as e:
+            logger.error('背景處理事件時發生錯誤', extra={'error': str(e)})
+            WEBHOOK_ERRORS.inc()
+            with self._lock:
+                self._counters["failed"] += 1
+        else:
+            with self._lock:
+                self._counters["processed"] += 1
+
+    def drain(self):
+        """等待佇列中的工作全部處理完畢"""
+        self._queue.join()
+
+    def shutdown(self, timeout: float = 30.0):
+        """停止接受新工作，處理完佇列中剩餘的工作後結束執行緒"""
+        with self._lock:
+            if not self._accepting:
+                return
+            self._accepting = False
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._queue.put(_STOP)
+        for thread in threads:
+            thread.join(timeout)
+
+    def stats(self) -> Dict[str, int]:
+        """取得佇列統計（backpressure 指標）"""
+        with self._lock:
+            stats = dict(self._counters)
+        stats["depth"] = self._queue.qsize()
+        stats["capacity"] = self.maxsize
+        stats["workers"] = len(self._threads)
+        return stats
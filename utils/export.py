@@ -0,0 +1,107 @@
+import csv
+import hashlib
+import hmac
+import io
+import json
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Iterator, Mapping, Optional, Tuple
+from urllib.parse import urlencode
+from .records import Order, to_iso
+
+# 匯出格式 -> Content-Type
+EXPORT_FORMATS = {
+    "csv": "text/csv; charset=utf-8",
+    "jsonl": "application/x-ndjson; charset=utf-8",
+}
+
+CSV_FIELDS = ("id", "user_id", "status", "total", "created_at", "updated_at", "items")
+
+# 簽章涵蓋的查詢參數
+SIGNED_PARAMS = ("format", "status", "from", "to", "expires")
+
+def parse_date(value: str) -> datetime:
+    """解析 YYYY-MM-DD 日期"""
+    try:
+        return datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        raise ValueError(f"日期格式必須為 YYYY-MM-DD：{value}")
+
+def date_range(start: Optional[str], end: Optional[str]) -> Tuple[Optional[float], Optional[float]]:
+    """將起訖日期（皆含當日）轉為 epoch 秒的 [since, until) 區間"""
+    since = parse_date(start).timestamp() if start else None
+    until = (parse_date(end) + timedelta(days=1)).timestamp() if end else None
+    if since is not None and until is not None and since >= until:
+        raise ValueError("起始日期不能晚於結束日期")
+    return since, until
+
+def _csv_row(order: Order) -> Tuple:
+    items = "; ".join(f"{item.name} x {item.quantity}" for item in order.items)
+    return (order.id, order.user_id, order.status, order.total,
+            to_iso(order.created_at), to_iso(order.updated_at), items)
+
+def export_orders(orders: Iterable[Order], fmt: str = "csv", chunk_size: int = 65536) -> Iterator[str]:
+    """將訂單逐批轉為 CSV 或 JSONL 文字
+
+    輸出累積到 chunk_size 字元就交出，記憶體用量與訂單總數無關。
+    """
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"不支援的匯出格式：{fmt}（可用：{', '.join(EXPORT_FORMATS)}）")
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    if fmt == "csv":
+        # 加上 BOM，Excel 開啟時才能正確顯示中文
+        buffer.write("\ufeff")
+        writer.writerow(CSV_FIELDS)
+    for order in orders:
+        if fmt == "csv":
+            writer.writerow(_csv_row(order))
+        else:
+            buffer.write(json.dumps(order.to_dict(), ensure_ascii=False, separators=(',', ':')) + "\n")
+        if buffer.tell() >= chunk_size:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def _secret() -> bytes:
+    return (os.getenv('EXPORT_SECRET') or os.getenv('LINE_CHANNEL_SECRET', '')).encode()
+
+def _signature(params: Mapping[str, str]) -> str:
+    message = "&".join(f"{key}={params.get(key) or ''}" for key in SIGNED_PARAMS)
+    return hmac.new(_secret(), message.encode(), hashlib.sha256).hexdigest()
+
+def create_export_link(fmt: str = "csv", status: Optional[str] = None, start: Optional[str] = None,
+                       end: Optional[str] = None, now: Optional[float] = None) -> str:
+    """產生有時效的簽章匯出連結（EXPORT_LINK_TTL 秒內有效）"""
+    ttl = int(os.getenv('EXPORT_LINK_TTL', '600'))
+    params: Dict[str, str] = {"format": fmt}
+    if status:
+        params["status"] = status
+    if start:
+        params["from"] = start
+    if end:
+        params["to"] = end
+    params["expires"] = str(int((time.time() if now is None else now) + ttl))
+    params["sig"] = _signature(params)
+    base_url = os.getenv('PUBLIC_BASE_URL', '').rstrip('/')
+    return f"{base_url}/export/orders?{urlencode(params)}"
+
+def verify_export_request(params: Mapping[str, str], authorization: str = "",
+                          now: Optional[float] = None) -> bool:
+    """驗證匯出請求：EXPORT_TOKEN（Bearer）或未過期的簽章連結"""
+    token = os.getenv('EXPORT_TOKEN')
+    if token and hmac.compare_digest(authorization.encode(), f"Bearer {token}".encode()):
+        return True
+    signature = params.get("sig", "")
+    if not signature or not _secret():
+        return False
+    try:
+        expires = int(params.get("expires", ""))
+    except ValueError:
+        return False
+    if (time.time() if now is None else now) > expires:
+        return False
+    return hmac.compare_digest(signature.encode(), _signature(params).encode())
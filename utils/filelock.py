@@ -0,0 +1,55 @@
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:  # Windows 沒有 fcntl，只能排除同行程內的執行緒
+    fcntl = None
+
+class FileLock:
+    """跨行程的互斥鎖
+
+    以 fcntl.flock 鎖定 lock 檔排除其他行程（例如其他 gunicorn worker），
+    並以 threading.Lock 排除同一行程內的其他執行緒。
+    shared=True 時以共享鎖（LOCK_SH）鎖定：多個行程可同時持有，只排除獨占鎖。
+    """
+
+    def __init__(self, path: str, shared: bool = False):
+        self.path = path
+        self.shared = shared
+        self._thread_lock = threading.Lock()
+        self._fd = None
+
+    def acquire(self):
+        """取得鎖（阻塞直到成功）"""
+        self._thread_lock.acquire()
+        try:
+            if fcntl is not None:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX)
+                except BaseException:
+                    os.close(fd)
+                    raise
+                self._fd = fd
+        except BaseException:
+            self._thread_lock.release()
+            raise
+
+    def release(self):
+        """釋放鎖"""
+        try:
+            if self._fd is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+                os.close(self._fd)
+                self._fd = None
+        finally:
+            self._thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
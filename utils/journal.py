@@ -0,0 +1,162 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator
+from .filelock import FileLock
+from .records import encode_record
+
+class OrderJournal:
+    """訂單異動日誌（append-only）
+
+    每筆訂單建立或狀態變更寫入一行 JSON，寫入成本與歷史訂單數量無關。
+    fsync 以批次進行：累積 fsync_batch 筆或超過 fsync_interval 秒才同步到磁碟。
+    batch() 期間的紀錄只寫入緩衝區，離開時才一次 flush。
+
+    多個 worker 附加寫入同一個檔案：寫入時持有 lock 檔的共享鎖，壓縮時持有
+    獨占鎖，其他 worker 的紀錄不會在讀取快照內容與清空日誌之間寫入。
+    """
+
+    def __init__(self, path: str, fsync_batch: int = 32, fsync_interval: float = 1.0):
+        self.path = path
+        self.fsync_batch = fsync_batch
+        self.fsync_interval = fsync_interval
+        self.records = 0  # 自上次壓縮後的紀錄筆數
+        self._file = None
+        self._pending = 0
+        self._last_sync = time.monotonic()
+        self._timer = None
+        self._batch = threading.local()  # 各執行緒進行中的批次層數
+        self._lock = threading.Lock()
+        self._create_file_locks()
+
+    def _create_file_locks(self):
+        self._append_lock = FileLock(self.path + ".lock", shared=True)
+        self._compact_lock = FileLock(self.path + ".lock")
+
+    def _open(self):
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._file = open(self.path, 'a', encoding='utf-8')
+        return self._file
+
+    def append(self, record: Dict[str, Any]):
+        """寫入一筆紀錄"""
+        line = json.dumps(record, ensure_ascii=False, separators=(',', ':'), default=encode_record)
+        with self._lock, self._append_lock:
+            f = self._open()
+            f.write(line + "\n")
+            self.records += 1
+            self._pending += 1
+            if not getattr(self._batch, "depth", 0):
+                self._flush_locked()
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        """批次寫入，離開時一次 flush（並視需要 fsync）"""
+        depth = getattr(self._batch, "depth", 0)
+        self._batch.depth = depth + 1
+        try:
+            yield
+        finally:
+            self._batch.depth = depth
+            if not depth:
+                with self._lock:
+                    if self._file is not None:
+                        with self._append_lock:
+                            self._flush_locked()
+
+    def _flush_locked(self):
+        self._file.flush()
+        if (self._pending >= self.fsync_batch
+                or time.monotonic() - self._last_sync >= self.fsync_interval):
+            self._sync_locked()
+        elif self._timer is None:
+            # 流量停止時也要在 fsync_interval 內落盤
+            self._timer = threading.Timer(self.fsync_interval, self.sync)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _sync_locked(self):
+        if self._file is not None and self._pending:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._pending = 0
+        self._last_sync = time.monotonic()
+
+    def sync(self):
+        """將尚未同步的紀錄寫入磁碟"""
+        with self._lock, self._append_lock:
+            self._timer = None
+            self._sync_locked()
+
+    def replay(self) -> Iterator[Dict[str, Any]]:
+        """依序讀出日誌中的紀錄"""
+        self.records = 0
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # 寫入途中當機可能留下不完整的最後一行
+                    print(f"略過損毀的訂單日誌紀錄：{line[:80]}")
+                    continue
+                self.records += 1
+                yield record
+
+    def reset(self):
+        """快照完成後清空日誌"""
+        with self._lock, self._compact_lock:
+            self._reset_locked()
+
+    def compact(self, write_snapshot: Callable[[], None]):
+        """暫停所有 worker 的寫入，呼叫 write_snapshot 寫入快照後清空日誌
+
+        期間其他執行緒與行程的 append 會等待，快照與清空之間寫入的紀錄不會遺失；
+        write_snapshot 應從磁碟讀取日誌，才會包含其他 worker 的紀錄。
+        write_snapshot 拋出例外時日誌保持不變。
+        """
+        with self._lock, self._compact_lock:
+            # 批次中尚在緩衝區的紀錄先寫入日誌，才會被讀進快照
+            if self._file is not None:
+                self._file.flush()
+            write_snapshot()
+            self._reset_locked()
+
+    def _reset_locked(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        with open(self.path, 'w', encoding='utf-8') as f:
+            f.flush()
+            os.fsync(f.fileno())
+        self.records = 0
+        self._pending = 0
+        self._last_sync = time.monotonic()
+
+    def after_fork(self):
+        """fork 後重建鎖並重新開啟日誌檔（不沿用父行程的計時器與檔案物件）"""
+        self._lock = threading.Lock()
+        self._create_file_locks()
+        self._batch = threading.local()
+        self._timer = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def close(self):
+        """同步並關閉日誌檔"""
+        self.sync()
+        with self._lock, self._append_lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
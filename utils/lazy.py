@@ -0,0 +1,51 @@
+import threading
+from typing import Any, Callable
+
+class LazyInstance:
+    """第一次使用時才建立的全域實例
+
+    模組載入時只登記建立函式，不讀取資料檔；第一次存取屬性（或呼叫 warm_up）
+    時才在鎖內建立實例，之後的屬性存取與設定都直接轉給實例。
+    """
+
+    __slots__ = ("_factory", "_instance", "_lock")
+
+    def __init__(self, factory: Callable[[], Any]):
+        object.__setattr__(self, "_factory", factory)
+        object.__setattr__(self, "_instance", None)
+        object.__setattr__(self, "_lock", threading.Lock())
+
+    def _get(self) -> Any:
+        instance = self._instance
+        if instance is None:
+            with self._lock:
+                instance = self._instance
+                if instance is None:
+                    instance = self._factory()
+                    object.__setattr__(self, "_instance", instance)
+        return instance
+
+    def __getattr__(self, name: str) -> Any:
+        if name in LazyInstance.__slots__:
+            raise AttributeError(name)
+        return getattr(self._get(), name)
+
+    def __setattr__(self, name: str, value: Any):
+        setattr(self._get(), name, value)
+
+    def __repr__(self) -> str:
+        if self._instance is None:
+            return f"<LazyInstance {getattr(self._factory, '__name__', self._factory)} (未建立)>"
+        return repr(self._instance)
+
+def is_initialized(instance: Any) -> bool:
+    """實例是否已建立（一般物件一律視為已建立）"""
+    if isinstance(instance, LazyInstance):
+        return instance._instance is not None
+    return True
+
+def warm_up(*instances: Any):
+    """預先建立實例（載入資料），避免第一個請求負擔載入成本"""
+    for instance in instances:
+        if isinstance(instance, LazyInstance):
+            instance._get()
@@ -0,0 +1,254 @@
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import Executor
+from typing import List, Optional
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from linebot import LineBotApi
+from linebot.exceptions import LineBotApiError
+from linebot.http_client import HttpClient, RequestsHttpResponse
+from linebot.v3.messaging import ApiException, AsyncApiClient, AsyncMessagingApi, Configuration, ReplyMessageRequest
+from linebot.v3.messaging import TextMessage
+from .metrics import REPLY_DURATION, REPLY_ERRORS
+
+logger = logging.getLogger(__name__)
+
+# 可重試的狀態碼：速率限制與伺服器錯誤
+RETRY_STATUSES = frozenset([429, 500, 502, 503, 504])
+# POST（reply / push 等）只在確定 LINE 未處理請求時重試：5xx 或讀取逾時時請求可能已被
+# 接受，重送會造成重複訊息，reply token 也只能使用一次
+POST_RETRY_STATUSES = frozenset([429])
+
+# 單則文字訊息的字數上限
+MAX_TEXT_LENGTH = 5000
+
+def split_text(text: str, limit: int = MAX_TEXT_LENGTH) -> List[str]:
+    """將過長的文字切成多則訊息，優先在空行（訂單區塊之間）切開"""
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind("\n\n", 0, limit)
+        if cut <= 0:
+            cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        chunks.append(text[:cut].rstrip())
+        text = text[cut:].lstrip("\n")
+    if text:
+        chunks.append(text)
+    return chunks
+
+def retry_delay(attempt: int, backoff: float, retry_after: Optional[str] = None) -> float:
+    """重試前的等待秒數：優先採用 Retry-After，否則為指數退避加隨機抖動（full jitter）"""
+    if retry_after and retry_after.isdigit():
+        return float(retry_after)
+    return random.uniform(0, backoff * (2 ** attempt))
+
+def connect_failed(error: requests.RequestException) -> bool:
+    """請求是否在連上伺服器前就失敗（請求未送出，重送不會重複處理）"""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = error.args[0] if error.args else None
+    return isinstance(getattr(reason, "reason", reason), NewConnectionError)
+
+class PooledHttpClient(HttpClient):
+    """共用連線池（keep-alive）的 LINE API HTTP client
+
+    所有外送請求共用同一個 requests.Session；失敗時以指數退避加隨機抖動
+    （full jitter）重試，429 會優先採用 Retry-After。GET/PUT/DELETE 遇到
+    429/5xx 或連線失敗時重試；POST 只在 429 或連線建立失敗時重試。
+    """
+
+    def __init__(self, timeout=HttpClient.DEFAULT_TIMEOUT, pool_size: Optional[int] = None,
+                 retries: Optional[int] = None, backoff: Optional[float] = None):
+        super().__init__(timeout)
+        self.pool_size = pool_size or int(os.getenv('LINE_HTTP_POOL_SIZE', '10'))
+        self.retries = retries if retries is not None else int(os.getenv('LINE_HTTP_RETRIES', '3'))
+        self.backoff = backoff if backoff is not None else float(os.getenv('LINE_HTTP_BACKOFF', '0.2'))
+        self.session = self._create_session()
+
+    def _create_session(self) -> requests.Session:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=0)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def reset(self):
+        """重建連線池（fork 後的子行程不可沿用父行程的連線）"""
+        self.session = self._create_session()
+
+    def _delay(self, attempt: int, response: Optional[requests.Response] = None) -> float:
+        retry_after = None
+        if response is not None and response.status_code == 429:
+            retry_after = response.headers.get("Retry-After")
+        return retry_delay(attempt, self.backoff, retry_after)
+
+    def _request(self, method: str, url: str, timeout=None, **kwargs) -> RequestsHttpResponse:
+        if timeout is None:
+            timeout = self.timeout
+        post = method == "POST"
+        statuses = POST_RETRY_STATUSES if post else RETRY_STATUSES
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session.request(method, url, timeout=timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= self.retries or (post and not connect_failed(e)):
+                    raise
+                delay = self._delay(attempt)
+                logger.warning('LINE API 連線失敗，稍後重試', extra={'url': url, 'error': str(e), 'delay': delay})
+                time.sleep(delay)
+                continue
+            if response.status_code in statuses and attempt < self.retries:
+                delay = self._delay(attempt, response)
+                logger.warning('LINE API 暫時錯誤，稍後重試', extra={
+                    'url': url, 'status_code': response.status_code, 'delay': delay
+                })
+                time.sleep(delay)
+                continue
+            return RequestsHttpResponse(response)
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        return self._request("GET", url, headers=headers, params=params, stream=stream, timeout=timeout)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        return self._request("POST", url, headers=headers, data=data, timeout=timeout)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        return self._request("DELETE", url, headers=headers, data=data, timeout=timeout)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        return self._request("PUT", url, headers=headers, data=data, timeout=timeout)
+
+def create_line_bot_api(channel_access_token: str) -> LineBotApi:
+    """建立使用共用連線池的 LineBotApi
+
+    LINE_API_ENDPOINT 可指向本機 stub server 進行測試。
+    """
+    return LineBotApi(
+        channel_access_token,
+        endpoint=os.getenv('LINE_API_ENDPOINT', LineBotApi.DEFAULT_API_ENDPOINT),
+        timeout=float(os.getenv('LINE_HTTP_TIMEOUT', str(HttpClient.DEFAULT_TIMEOUT))),
+        http_client=PooledHttpClient
+    )
+
+class ReplyBatch:
+    """收集同一個 reply token 的訊息，合併成一次 reply API 呼叫
+
+    reply token 只能使用一次，單次最多 5 則訊息，超過的訊息會被捨棄並記錄警告。
+    """
+
+    MAX_MESSAGES = 5
+
+    def __init__(self, api: LineBotApi, reply_token: str):
+        self.api = api
+        self.reply_token = reply_token
+        self.messages: List = []
+        self.sent = False
+        self._lock = threading.Lock()
+
+    def add(self, *messages):
+        """加入待回覆的訊息"""
+        with self._lock:
+            self.messages.extend(messages)
+
+    def clear(self):
+        """捨棄尚未送出的訊息（例如改為回覆錯誤訊息）"""
+        with self._lock:
+            self.messages = []
+
+    def send(self) -> bool:
+        """送出所有訊息，返回是否成功"""
+        with self._lock:
+            if self.sent or not self.messages:
+                return False
+            self.sent = True
+            messages, self.messages = self.messages, []
+        if len(messages) > self.MAX_MESSAGES:
+            logger.warning('回覆訊息超過上限，已捨棄多餘訊息', extra={
+                'count': len(messages), 'limit': self.MAX_MESSAGES
+            })
+            messages = messages[:self.MAX_MESSAGES]
+        start = time.perf_counter()
+        try:
+            self.api.reply_message(self.reply_token, messages)
+        except LineBotApiError as e:
+            REPLY_ERRORS.inc(str(e.status_code))
+            logger.error('回覆訊息失敗', extra={'status_code': e.status_code, 'error': str(e)})
+            return False
+        except requests.RequestException as e:
+            REPLY_ERRORS.inc("connection")
+            logger.error('回覆訊息失敗', extra={'error': str(e)})
+            return False
+        finally:
+            REPLY_DURATION.observe(time.perf_counter() - start)
+        return True
+
+def send_replies(batches: List[ReplyBatch], executor: Optional[Executor] = None) -> int:
+    """送出多個 reply token 的回覆，有 executor 時同時送出，返回成功數"""
+    if executor is None or len(batches) <= 1:
+        return sum(1 for batch in batches if batch.send())
+    return sum(1 for sent in executor.map(lambda batch: batch.send(), batches) if sent)
+
+class AsyncReplyClient:
+    """以 line-bot-sdk v3 非同步 API 送出回覆（asyncio 入口使用）
+
+    所有回覆共用同一個 aiohttp 連線池，連線數上限即同時進行中的回覆數；
+    重試規則與 PooledHttpClient 的 POST 相同（只重試 429 與連線建立失敗）。必須在事件迴圈中建立。
+    """
+
+    def __init__(self, channel_access_token: str, concurrency: Optional[int] = None,
+                 retries: Optional[int] = None, backoff: Optional[float] = None):
+        configuration = Configuration(
+            host=os.getenv('LINE_API_ENDPOINT', 'https://api.line.me'),
+            access_token=channel_access_token
+        )
+        configuration.connection_pool_maxsize = concurrency or int(os.getenv('ASYNC_REPLY_CONCURRENCY', '100'))
+        self.timeout = aiohttp.ClientTimeout(total=float(os.getenv('LINE_HTTP_TIMEOUT', str(HttpClient.DEFAULT_TIMEOUT))))
+        self.retries = retries if retries is not None else int(os.getenv('LINE_HTTP_RETRIES', '3'))
+        self.backoff = backoff if backoff is not None else float(os.getenv('LINE_HTTP_BACKOFF', '0.2'))
+        self.api_client = AsyncApiClient(configuration)
+        self.api = AsyncMessagingApi(self.api_client)
+
+    async def close(self):
+        await self.api_client.close()
+
+    async def reply(self, reply_token: str, texts: List[str]) -> bool:
+        """以一次 reply API 呼叫送出多則文字訊息，返回是否成功"""
+        if len(texts) > ReplyBatch.MAX_MESSAGES:
+            logger.warning('回覆訊息超過上限，已捨棄多餘訊息', extra={
+                'count': len(texts), 'limit': ReplyBatch.MAX_MESSAGES
+            })
+            texts = texts[:ReplyBatch.MAX_MESSAGES]
+        request = ReplyMessageRequest(reply_token=reply_token, messages=[TextMessage(text=text) for text in texts])
+        start = time.perf_counter()
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    await self.api.reply_message(request, _request_timeout=self.timeout)
+                    return True
+                except ApiException as e:
+                    if e.status not in POST_RETRY_STATUSES or attempt >= self.retries:
+                        REPLY_ERRORS.inc(str(e.status))
+                        logger.error('回覆訊息失敗', extra={'status_code': e.status, 'error': str(e.reason)})
+                        return False
+                    retry_after = e.headers.get("Retry-After") if e.status == 429 and e.headers else None
+                    delay = retry_delay(attempt, self.backoff, retry_after)
+                    logger.warning('LINE API 暫時錯誤，稍後重試', extra={'status_code': e.status, 'delay': delay})
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    if attempt >= self.retries or not isinstance(e, aiohttp.ClientConnectorError):
+                        REPLY_ERRORS.inc("connection")
+                        logger.error('回覆訊息失敗', extra={'error': str(e)})
+                        return False
+                    delay = retry_delay(attempt, self.backoff)
+                    logger.warning('LINE API 連線失敗，稍後重試', extra={'error': str(e), 'delay': delay})
+                await asyncio.sleep(delay)
+            return False
+        finally:
+            REPLY_DURATION.observe(time.perf_counter() - start)
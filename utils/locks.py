@@ -0,0 +1,86 @@
+import threading
+from contextlib import contextmanager
+from typing import Hashable, Iterator
+
+class RWLock:
+    """讀寫鎖：多個讀取者可同時持有，寫入者獨占
+
+    有寫入者等待時，新的讀取者會排在寫入者之後（避免寫入者飢餓）。
+    同一執行緒可重複取得讀取鎖；持有寫入鎖的執行緒可再取得讀取或寫入鎖。
+    持有讀取鎖時不可升級為寫入鎖（必定 deadlock），會直接拋出 RuntimeError。
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = None  # 持有寫入鎖的執行緒
+        self._write_depth = 0
+        self._writers_waiting = 0
+        self._local = threading.local()  # 各執行緒持有的讀取鎖層數
+
+    @contextmanager
+    def read(self) -> Iterator[None]:
+        """取得讀取鎖"""
+        depth = getattr(self._local, "reads", 0)
+        if depth or self._writer == threading.get_ident():
+            self._local.reads = depth + 1
+            try:
+                yield
+            finally:
+                self._local.reads = depth
+            return
+        with self._cond:
+            while self._writer is not None or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        self._local.reads = 1
+        try:
+            yield
+        finally:
+            self._local.reads = 0
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self) -> Iterator[None]:
+        """取得寫入鎖"""
+        me = threading.get_ident()
+        if self._writer == me:
+            self._write_depth += 1
+            try:
+                yield
+            finally:
+                self._write_depth -= 1
+            return
+        if getattr(self._local, "reads", 0):
+            raise RuntimeError("持有讀取鎖時不可取得寫入鎖")
+        with self._cond:
+            self._writers_waiting += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._cond.wait()
+            finally:
+                self._writers_waiting -= 1
+            self._writer = me
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = None
+                self._cond.notify_all()
+
+class KeyedLocks:
+    """依鍵（例如使用者 ID）區分的互斥鎖
+
+    鍵以 hash 對應到固定數量的 RLock（lock striping）：不同鍵大多可同時進行，
+    也不需要為每個鍵建立與清除鎖物件。
+    """
+
+    def __init__(self, stripes: int = 64):
+        self._locks = [threading.RLock() for _ in range(stripes)]
+
+    def __call__(self, key: Hashable) -> threading.RLock:
+        return self._locks[hash(key) % len(self._locks)]
+
@@ -1,78 +1,161 @@
-import json
 import os
-from typing import Dict, Optional, List, Any
+import time
+from typing import Dict, Optional, List, Any, Tuple
 from datetime import datetime
 from .auth import require_admin
+from .storage import MenuRepository, create_menu_repository
+from .records import MenuItem
+from .metrics import STORAGE_DURATION
+from .lazy import LazyInstance
+from .locks import RWLock
 
 class MenuManager:
-    def __init__(self):
-        self.menu_file = "data/menu.json"
-        self.menu: Dict[str, Dict[str, Any]] = {}
+    """商品目錄管理
+    
+    self.menu 與渲染快取由讀寫鎖保護：查詢可同時進行，變更獨占且只包含記憶體操作，
+    寫入儲存在鎖外進行。商品紀錄不在原地修改，變更時以複本替換，
+    get_item 返回的紀錄不會在讀取途中被其他執行緒改動。
+    """
+    
+    def __init__(self, repository: Optional[MenuRepository] = None):
+        self.repository = repository or create_menu_repository()
+        self._lock = RWLock()
+        self.menu: Dict[str, MenuItem] = {}
         self.stock_warning_threshold = 5  # 庫存警告閾值
+        # 商品目錄渲染快取：version 在每次異動時遞增，單項商品的區塊依內容快取
+        self.version = 0
+        self._rendered: Tuple[int, str] = (-1, "")
+        self._fragments: Dict[str, Tuple[Tuple[Any, ...], str]] = {}
+        # 其他 worker 的變更最多延遲 reload_interval 秒可見（0 表示每次查詢都檢查）
+        self.reload_interval = float(os.getenv('MENU_RELOAD_INTERVAL', '1.0'))
+        self._next_check = 0.0
+        self._reloads = 0  # refresh() 替換目錄的次數
+        self._stale = False  # 記憶體中的目錄可能與儲存不一致，下次 refresh 必定重新載入
         self.load_menu()
     
     def load_menu(self):
-        """從檔案載入商品目錄"""
+        """從儲存載入商品目錄"""
         try:
-            if os.path.exists(self.menu_file):
-                with open(self.menu_file, 'r', encoding='utf-8') as f:
-                    self.menu = json.load(f)
+            menu = self.repository.load()
         except Exception as e:
             print(f"載入商品目錄時發生錯誤：{e}")
-            self.menu = {}
+            menu = {}
+        with self._lock.write():
+            self.menu = menu
+            self._fragments = {}
+            self._bump_version()
     
-    def save_menu(self):
-        """儲存商品目錄到檔案"""
+    def refresh(self, force: bool = False) -> bool:
+        """其他 worker 變更過商品目錄時重新載入
+        
+        平時最多每 reload_interval 秒檢查一次（stat 或 PRAGMA data_version），
+        force=True 時立即檢查。只有內容確實不同時才使目錄快取失效。
+        
+        返回: 是否重新載入
+        """
+        now = time.monotonic()
+        if not force and now < self._next_check:
+            return False
+        self._next_check = now + self.reload_interval
         try:
-            os.makedirs(os.path.dirname(self.menu_file), exist_ok=True)
-            with open(self.menu_file, 'w', encoding='utf-8') as f:
-                json.dump(self.menu, f, ensure_ascii=False, indent=2)
+            if not self._stale and not self.repository.changed():
+                return False
+            self._stale = False
+            with STORAGE_DURATION.time("menu", "reload"):
+                latest = self.repository.load()
         except Exception as e:
-            print(f"儲存商品目錄時發生錯誤：{e}")
+            print(f"重新載入商品目錄時發生錯誤：{e}")
+            self._stale = True
+            return False
+        with self._lock.write():
+            current, self.menu = self.menu, latest
+            self._reloads += 1
+            if latest != current:
+                self._bump_version()
+        return True
+    
+    def _bump_version(self):
+        """商品目錄已異動，下次查詢時重新組合目錄"""
+        self.version += 1
+    
+    def save_menu(self):
+        """儲存整份商品目錄"""
+        with STORAGE_DURATION.time("menu", "save_all"):
+            self.repository.save_all(self.menu)
     
     def get_menu(self) -> str:
         """取得商品目錄"""
-        if not self.menu:
-            return "目前沒有任何商品"
+        self.refresh()
+        with self._lock.read():
+            version, rendered = self._rendered
+            if version == self.version:
+                return rendered
         
-        message = "🛍️ 商品目錄：\n\n"
-        for name, item in sorted(self.menu.items()):
-            stock_status = self._get_stock_status_emoji(item["stock"])
-            message += (
-                f"📦 {name}\n"
-                f"💰 價格：${item['price']}\n"
-                f"📊 庫存：{stock_status} {item['stock']}\n"
-            )
-            if item.get("description"):
-                message += f"📝 說明：{item['description']}\n"
-            message += "\n"
+        # 重新組合時會更新快取，需要獨占
+        with self._lock.write():
+            return self._render_menu()
+    
+    def _render_menu(self) -> str:
+        """組合整份商品目錄並更新快取（呼叫端持有寫入鎖）"""
+        version, rendered = self._rendered
+        if version == self.version:
+            return rendered
         
-        return message.strip()
+        version = self.version
+        if not self.menu:
+            rendered = "目前沒有任何商品"
+        else:
+            blocks = [self._render_item(name, self.menu[name]) for name in sorted(self.menu)]
+            rendered = ("🛍️ 商品目錄：\n\n" + "\n".join(blocks)).strip()
+            # 移除已刪除商品的區塊
+            if len(self._fragments) > len(self.menu):
+                self._fragments = {n: f for n, f in self._fragments.items() if n in self.menu}
+        self._rendered = (version, rendered)
+        return rendered
     
-    def get_item(self, name: str) -> Optional[Dict[str, Any]]:
+    def _render_item(self, name: str, item: MenuItem) -> str:
+        """渲染單一商品區塊，內容未變更時沿用快取"""
+        key = (item.price, item.stock, item.description)
+        cached = self._fragments.get(name)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        
+        stock_status = self._get_stock_status_emoji(item.stock)
+        block = (
+            f"📦 {name}\n"
+            f"💰 價格：${item.price}\n"
+            f"📊 庫存：{stock_status} {item.stock}\n"
+        )
+        if item.description:
+            block += f"📝 說明：{item.description}\n"
+        self._fragments[name] = (key, block)
+        return block
+    
+    def get_item(self, name: str) -> Optional[MenuItem]:
         """取得商品資訊"""
-        return self.menu.get(name)
+        self.refresh()
+        with self._lock.read():
+            return self.menu.get(name)
     
     def add_item(self, admin_id: str, name: str, price: int, stock: int, description: str = "") -> str:
         """新增商品"""
-        if name in self.menu:
-            return f"商品 {name} 已存在"
-        
-        if price <= 0:
-            return "商品價格必須大於 0"
-        
-        if stock < 0:
-            return "商品庫存不能小於 0"
-        
-        self.menu[name] = {
-            "price": price,
-            "stock": stock,
-            "description": description,
-            "created_at": datetime.now().isoformat(),
-            "updated_at": datetime.now().isoformat(),
-            "created_by": admin_id
-        }
-        self.save_menu()
+        self.refresh(force=True)
+        now = datetime.now().isoformat()
+        item = MenuItem(price, stock, description, now, now, admin_id)
+        with self._lock.write():
+            if name in self.menu:
+                return f"商品 {name} 已存在"
+            
+            if price <= 0:
+                return "商品價格必須大於 0"
+            
+            if stock < 0:
+                return "商品庫存不能小於 0"
+            
+            self.menu[name] = item
+            self._bump_version()
+        with STORAGE_DURATION.time("menu", "upsert"):
+            self.repository.upsert(name, item)
         
         return (
             f"✅ 商品已新增\n"
@@ -85,35 +168,42 @@ class MenuManager:
     def edit_item(self, admin_id: str, name: str, price: Optional[int] = None,
                  stock: Optional[int] = None, description: Optional[str] = None) -> str:
         """編輯商品"""
-        if name not in self.menu:
-            return f"找不到商品：{name}"
-        
-        item = self.menu[name]
-        changes = []
-        
-        if price is not None:
-            if price <= 0:
-                return "商品價格必須大於 0"
-            if price != item["price"]:
-                changes.append(f"價格：${item['price']} → ${price}")
-                item["price"] = price
-        
-        if stock is not None:
-            if stock < 0:
-                return "商品庫存不能小於 0"
-            if stock != item["stock"]:
-                changes.append(f"庫存：{item['stock']} → {stock}")
-                item["stock"] = stock
-        
-        if description is not None and description != item["description"]:
-            changes.append("說明已更新")
-            item["description"] = description
+        self.refresh(force=True)
+        # 比對與替換在同一個寫入鎖內，同時編輯同一項商品時不會互相覆蓋
+        with self._lock.write():
+            item = self.menu.get(name)
+            if item is None:
+                return f"找不到商品：{name}"
+            
+            changes = []
+            fields: Dict[str, Any] = {}
+            if price is not None:
+                if price <= 0:
+                    return "商品價格必須大於 0"
+                if price != item.price:
+                    changes.append(f"價格：${item.price} → ${price}")
+                    fields["price"] = price
+            if stock is not None:
+                if stock < 0:
+                    return "商品庫存不能小於 0"
+                if stock != item.stock:
+                    changes.append(f"庫存：{item.stock} → {stock}")
+                    fields["stock"] = stock
+            if description is not None and description != item.description:
+                changes.append("說明已更新")
+                fields["description"] = description
+            if not changes:
+                return "沒有任何變更"
+            
+            fields["updated_at"] = datetime.now().isoformat()
+            updated = item.copy()
+            updated.update(fields)
+            self.menu[name] = updated
+            self._bump_version()
         
-        if not changes:
-            return "沒有任何變更"
-        
-        item["updated_at"] = datetime.now().isoformat()
-        self.save_menu()
+        # 只寫入變更的欄位，避免覆蓋其他 worker 同時扣除的庫存
+        with STORAGE_DURATION.time("menu", "update"):
+            self.repository.update(name, fields)
         
         message = f"✅ 商品 {name} 已更新：\n"
         for change in changes:
@@ -127,11 +217,14 @@ class MenuManager:
     
     def delete_item(self, admin_id: str, name: str) -> str:
         """刪除商品"""
-        if name not in self.menu:
-            return f"找不到商品：{name}"
-        
-        item = self.menu.pop(name)
-        self.save_menu()
+        self.refresh(force=True)
+        with self._lock.write():
+            item = self.menu.pop(name, None)
+            if item is None:
+                return f"找不到商品：{name}"
+            self._bump_version()
+        with STORAGE_DURATION.time("menu", "delete"):
+            self.repository.delete(name)
         
         return (
             f"✅ 商品已刪除\n"
@@ -142,22 +235,43 @@ class MenuManager:
     
     def update_stock(self, name: str, quantity: int) -> None:
         """更新商品庫存"""
-        if name not in self.menu:
-            raise ValueError(f"找不到商品：{name}")
-        
-        item = self.menu[name]
-        new_stock = item["stock"] + quantity
-        
-        if new_stock < 0:
-            raise ValueError(f"商品 {name} 庫存不足")
+        self.adjust_stock({name: quantity})
+    
+    def adjust_stock(self, changes: Dict[str, int]) -> Dict[str, int]:
+        """原子性調整多項商品庫存（跨 worker 檢查並扣除）
         
-        item["stock"] = new_stock
-        item["updated_at"] = datetime.now().isoformat()
-        self.save_menu()
+        任一商品不存在拋出 ValueError，庫存不足拋出 InsufficientStockError，
+        兩者皆不會變更任何庫存。
+        """
+        updated_at = datetime.now().isoformat()
+        reloads = self._reloads
+        with STORAGE_DURATION.time("menu", "adjust_stock"):
+            new_stocks = self.repository.adjust_stock(changes, updated_at)
         
-        # 如果庫存低於警告閾值，返回警告訊息
-        if new_stock <= self.stock_warning_threshold:
-            print(f"⚠️ 警告：商品 {name} 庫存低於 {self.stock_warning_threshold} 件（剩餘：{new_stock}）")
+        # 儲存已原子性地檢查並扣除；記憶體中以增減量套用，多個執行緒的調整不論先後順序結果都相同
+        with self._lock.write():
+            if self._reloads != reloads:
+                # 期間重新載入過，載入的內容可能已包含這次調整：不重複套用，
+                # 改為標記過期，下次查詢時從儲存重新載入
+                self._stale = True
+                self._next_check = 0.0
+            else:
+                for name, quantity in changes.items():
+                    item = self.menu.get(name)
+                    if item is not None:
+                        item = item.copy()
+                        item.stock += quantity
+                        item.updated_at = updated_at
+                        self.menu[name] = item
+                self._bump_version()
+        return self._warn_low_stock(new_stocks)
+    
+    def _warn_low_stock(self, new_stocks: Dict[str, int]) -> Dict[str, int]:
+        """庫存低於警告閾值時印出警告，返回調整後的庫存"""
+        for name, new_stock in new_stocks.items():
+            if new_stock <= self.stock_warning_threshold:
+                print(f"⚠️ 警告：商品 {name} 庫存低於 {self.stock_warning_threshold} 件（剩餘：{new_stock}）")
+        return new_stocks
     
     def _get_stock_status_emoji(self, stock: int) -> str:
         """取得庫存狀態表情符號"""
@@ -168,5 +282,5 @@ class MenuManager:
         else:
             return "✅"  # 庫存充足
 
-# 建立全域實例
-menu_manager = MenuManager() 
\ No newline at end of file
+# 建立全域實例（第一次使用時才載入商品目錄）
+menu_manager = LazyInstance(MenuManager) 
\ No newline at end of file
@@ -0,0 +1,247 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# 延遲直方圖的預設區間（秒）
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = Tuple[str, ...]
+
+class _Metric:
+    """指標基底：每個執行緒各自累加，抓取時才合併
+
+    熱路徑只寫入目前執行緒專屬的 dict，不需要鎖；只有執行緒第一次寫入
+    （建立分片）與抓取時需要取得鎖。已結束執行緒的分片會在抓取時併入 _retired。
+    """
+
+    type = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards: List[Tuple[threading.Thread, Dict[Labels, Any]]] = []
+        self._retired: Dict[Labels, Any] = {}
+
+    def _shard(self) -> Dict[Labels, Any]:
+        try:
+            return self._local.values
+        except AttributeError:
+            values: Dict[Labels, Any] = {}
+            self._local.values = values
+            with self._lock:
+                self._shards.append((threading.current_thread(), values))
+            return values
+
+    def _merge(self, total: Dict[Labels, Any], values: Dict[Labels, Any]):
+        raise NotImplementedError
+
+    def collect(self) -> Dict[Labels, Any]:
+        """合併所有執行緒的累計值"""
+        with self._lock:
+            alive = []
+            for thread, values in self._shards:
+                if thread.is_alive():
+                    alive.append((thread, values))
+                else:
+                    self._merge(self._retired, dict(values))
+            self._shards = alive
+            total: Dict[Labels, Any] = {}
+            self._merge(total, self._retired)
+            for _, values in alive:
+                self._merge(total, dict(values))
+        return total
+
+    def render(self) -> List[str]:
+        raise NotImplementedError
+
+    def _format_labels(self, labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+        pairs = list(zip(self.labelnames, labels))
+        if extra is not None:
+            pairs.append(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+class Counter(_Metric):
+    """只增不減的計數器"""
+
+    type = "counter"
+
+    def inc(self, *labels: str, amount: float = 1):
+        """累加計數"""
+        values = self._shard()
+        values[labels] = values.get(labels, 0) + amount
+
+    def _merge(self, total, values):
+        for labels, value in values.items():
+            total[labels] = total.get(labels, 0) + value
+
+    def render(self):
+        return [f"{self.name}{self._format_labels(labels)} {_format_value(value)}"
+                for labels, value in sorted(self.collect().items())]
+
+class Histogram(_Metric):
+    """預先分好區間的直方圖"""
+
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels: str):
+        """記錄一筆觀測值"""
+        values = self._shard()
+        slots = values.get(labels)
+        if slots is None:
+            # 各區間（不累計）+ 超出最大區間 + 總和 + 筆數
+            slots = values[labels] = [0] * (len(self.buckets) + 3)
+        slots[bisect.bisect_left(self.buckets, value)] += 1
+        slots[-2] += value
+        slots[-1] += 1
+
+    @contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        """記錄區塊的執行時間（秒）"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labels)
+
+    def _merge(self, total, values):
+        for labels, slots in values.items():
+            merged = total.get(labels)
+            if merged is None:
+                total[labels] = list(slots)
+            else:
+                for i, value in enumerate(slots):
+                    merged[i] += value
+
+    def render(self):
+        lines = []
+        for labels, slots in sorted(self.collect().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), slots):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _format_value(bound)
+                lines.append(f"{self.name}_bucket{self._format_labels(labels, ('le', le))} {cumulative}")
+            lines.append(f"{self.name}_sum{self._format_labels(labels)} {_format_value(slots[-2])}")
+            lines.append(f"{self.name}_count{self._format_labels(labels)} {slots[-1]}")
+        return lines
+
+class Gauge(_Metric):
+    """抓取時才呼叫 callback 取得的即時數值
+
+    callback 返回單一數值，或 {標籤值 tuple: 數值} 的 dict。
+    """
+
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, callback: Callable[[], Any], labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self.callback = callback
+
+    def collect(self):
+        value = self.callback()
+        if isinstance(value, dict):
+            return value
+        return {(): value}
+
+    def render(self):
+        return [f"{self.name}{self._format_labels(labels)} {_format_value(value)}"
+                for labels, value in sorted(self.collect().items())]
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_value(value: float) -> str:
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+    return str(int(value))
+
+class Registry:
+    """指標登錄表，產生 Prometheus 文字格式"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: _Metric) -> _Metric:
+        """登錄指標，同名指標會被取代"""
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def unregister(self, name: str):
+        """移除指標"""
+        with self._lock:
+            self._metrics.pop(name, None)
+
+    def get(self, name: str) -> Optional[_Metric]:
+        """取得已登錄的指標"""
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        """產生 Prometheus 文字格式（text/plain; version=0.0.4）"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            try:
+                samples = metric.render()
+            except Exception as e:
+                # callback 失敗時略過該指標，不影響其他指標
+                print(f"收集指標 {metric.name} 時發生錯誤：{e}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# 建立全域實例
+registry = Registry()
+
+def counter(name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+    """建立並登錄計數器"""
+    return registry.register(Counter(name, help, labelnames))
+
+def histogram(name: str, help: str, labelnames: Sequence[str] = (),
+              buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+    """建立並登錄直方圖"""
+    return registry.register(Histogram(name, help, labelnames, buckets))
+
+def gauge(name: str, help: str, callback: Callable[[], Any], labelnames: Sequence[str] = ()) -> Gauge:
+    """建立並登錄即時數值"""
+    return registry.register(Gauge(name, help, callback, labelnames))
+
+# 各模組共用的指標
+COMMAND_DURATION = histogram(
+    "linebot_command_duration_seconds", "handle_command 各命令的處理時間", ["command"]
+)
+COMMAND_ERRORS = counter(
+    "linebot_command_errors_total", "處理命令時發生未預期錯誤的次數", ["command"]
+)
+STORAGE_DURATION = histogram(
+    "linebot_storage_duration_seconds", "各項資料寫入的時間", ["store", "operation"]
+)
+REPLY_DURATION = histogram(
+    "linebot_reply_duration_seconds", "LINE reply API 呼叫時間"
+)
+REPLY_ERRORS = counter(
+    "linebot_reply_errors_total", "LINE reply API 呼叫失敗次數", ["reason"]
+)
+WEBHOOK_ERRORS = counter(
+    "linebot_webhook_errors_total", "背景處理 webhook 時拋出例外（未送出回覆）的次數"
+)
+USER_STATE_SWEPT = counter(
+    "linebot_user_state_swept_total", "背景清理過期 session、封鎖與移除預設狀態使用者的筆數", ["kind"]
+)
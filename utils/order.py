@@ -1,198 +1,326 @@
-import json
+import atexit
+import bisect
 import os
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime
-from typing import List, Dict, Optional, Any
-from .menu import menu_manager
+from typing import List, Dict, Optional, Sequence, Set, Tuple
+from .menu import MenuManager, menu_manager
 from .auth import require_admin
+from .storage import InsufficientStockError, OrderRepository, create_order_repository
+from .metrics import STORAGE_DURATION
+from .records import Order, OrderItem
+from .lazy import LazyInstance, is_initialized
+from .locks import RWLock
+
+VALID_STATUSES = ["pending", "confirmed", "cancelled", "completed"]
+
+class _OrderIdView:
+    """以訂單編號檢視依編號排序的訂單串列，供 bisect 定位"""
+    
+    def __init__(self, orders: List[Order]):
+        self.orders = orders
+    
+    def __len__(self):
+        return len(self.orders)
+    
+    def __getitem__(self, index: int) -> int:
+        return self.orders[index].id
 
 class OrderManager:
-    def __init__(self):
-        self.orders_file = "data/orders.json"
-        self.orders: Dict[str, List[Dict[str, Any]]] = {}
+    """訂單管理
+
+    訂單與索引以讀寫鎖保護，鎖只涵蓋記憶體中的操作，不會在持有時呼叫儲存
+    （批次模式下儲存的檔案鎖會持有整個 webhook，兩者交錯取得會 deadlock）。
+    訂單以 copy-on-write 更新：讀取者拿到的訂單物件不會再被修改。
+    """
+
+    def __init__(self, repository: Optional[OrderRepository] = None,
+                 menu: Optional[MenuManager] = None):
+        self.repository = repository or create_order_repository()
+        self.menu_manager = menu or menu_manager
+        self.orders: Dict[str, List[Order]] = {}
+        self.orders_by_id: Dict[int, Order] = {}  # 訂單編號索引
+        self.order_ids: List[int] = []  # 依編號排序的所有訂單編號
+        self.status_index: Dict[str, List[int]] = {}  # 狀態 -> 依編號排序的訂單編號
+        self.max_order_id = 0
+        # 分頁設定與游標：(查詢者, 查詢範圍) -> (已顯示的最小訂單編號, 頁碼)
+        # 游標依最近使用排序，超過 max_cursors 筆時移除最久未使用的
+        self.page_size = int(os.getenv('ORDERS_PAGE_SIZE', '10'))
+        self.max_cursors = int(os.getenv('ORDERS_CURSOR_CACHE_SIZE', '10000'))
+        self._cursors: "OrderedDict[Tuple[str, str], Tuple[int, int]]" = OrderedDict()
+        self._cursor_lock = threading.Lock()  # 查詢只持有讀取鎖，游標另以此鎖保護
+        self._lock = RWLock()
+        # 正在更新狀態的訂單編號，同一筆訂單同時只有一個執行緒能變更
+        self._updating: Set[int] = set()
+        self._updating_lock = threading.Lock()
         self.load_orders()
     
     def load_orders(self):
-        """從檔案載入訂單資料"""
+        """從儲存載入訂單資料"""
         try:
-            if os.path.exists(self.orders_file):
-                with open(self.orders_file, 'r', encoding='utf-8') as f:
-                    self.orders = json.load(f)
+            orders = self.repository.load()
         except Exception as e:
             print(f"載入訂單資料時發生錯誤：{e}")
-            self.orders = {}
+            orders = {}
+        
+        orders_by_id = {}
+        for user_orders in orders.values():
+            for order in user_orders:
+                orders_by_id[order.id] = order
+        order_ids = sorted(orders_by_id)
+        status_index: Dict[str, List[int]] = {status: [] for status in VALID_STATUSES}
+        for order_id in order_ids:
+            status_index.setdefault(orders_by_id[order_id].status, []).append(order_id)
+        
+        # 建立完成後一次替換，讀取者不會看到建立到一半的索引
+        with self._lock.write():
+            self.orders = orders
+            self.orders_by_id = orders_by_id
+            self.order_ids = order_ids
+            self.status_index = status_index
+            self.max_order_id = order_ids[-1] if order_ids else 0
     
     def save_orders(self):
-        """儲存訂單資料到檔案"""
-        try:
-            os.makedirs(os.path.dirname(self.orders_file), exist_ok=True)
-            with open(self.orders_file, 'w', encoding='utf-8') as f:
-                json.dump(self.orders, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            print(f"儲存訂單資料時發生錯誤：{e}")
+        """儲存所有訂單資料"""
+        with STORAGE_DURATION.time("orders", "save_all"):
+            self.repository.save_all(self.orders)
     
     def create_order(self, user_id: str, items: List[Dict[str, int]]) -> str:
         """建立新訂單"""
+        # 檢查商品是否存在
+        for item in items:
+            if not self.menu_manager.get_item(item["name"]):
+                return f"商品 {item['name']} 不存在"
+        
+        # 以單一原子操作檢查並扣除所有商品庫存，避免多個 worker 同時下單造成超賣
+        changes: Dict[str, int] = {}
+        for item in items:
+            changes[item["name"]] = changes.get(item["name"], 0) - item["quantity"]
+        try:
+            self.menu_manager.adjust_stock(changes)
+        except ValueError as e:
+            # 庫存不足或商品已被其他 worker 刪除
+            return str(e)
+        
         try:
-            # 檢查商品是否存在且庫存足夠
-            for item in items:
-                product = menu_manager.get_item(item["name"])
-                if not product:
-                    return f"商品 {item['name']} 不存在"
-                if product["stock"] < item["quantity"]:
-                    return f"商品 {item['name']} 庫存不足（剩餘：{product['stock']}）"
-            
             # 計算訂單總金額
             total = 0
             order_items = []
             for item in items:
-                product = menu_manager.get_item(item["name"])
-                subtotal = product["price"] * item["quantity"]
-                order_items.append({
-                    "name": item["name"],
-                    "quantity": item["quantity"],
-                    "price": product["price"],
-                    "subtotal": subtotal
-                })
+                product = self.menu_manager.get_item(item["name"])
+                subtotal = product.price * item["quantity"]
+                order_items.append(OrderItem(item["name"], item["quantity"], product.price, subtotal))
                 total += subtotal
             
-            # 建立訂單
-            order = {
-                "id": len(self.get_all_orders()) + 1,
-                "user_id": user_id,
-                "items": order_items,
-                "total": total,
-                "status": "pending",  # pending, confirmed, cancelled, completed
-                "created_at": datetime.now().isoformat(),
-                "updated_at": datetime.now().isoformat()
-            }
+            # 建立訂單（狀態：pending, confirmed, cancelled, completed）
+            now = time.time()
+            order = Order(self.repository.next_order_id(self.max_order_id), user_id, order_items,
+                          total, "pending", now, now)
             
-            # 更新庫存
-            for item in items:
-                menu_manager.update_stock(item["name"], -item["quantity"])
-            
-            # 儲存訂單
-            if user_id not in self.orders:
-                self.orders[user_id] = []
-            self.orders[user_id].append(order)
-            self.save_orders()
+            # 儲存訂單（其他執行緒可能先取得較大的編號，依編號插入以保持排序）
+            # 寫入儲存前標記為更新中，狀態變更不會早於新增訂單寫入
+            with self._updating_lock:
+                self._updating.add(order.id)
+            try:
+                with self._lock.write():
+                    user_orders = self.orders.setdefault(user_id, [])
+                    user_orders.insert(bisect.bisect(_OrderIdView(user_orders), order.id), order)
+                    self.orders_by_id[order.id] = order
+                    bisect.insort(self.order_ids, order.id)
+                    bisect.insort(self.status_index.setdefault(order.status, []), order.id)
+                    self.max_order_id = max(self.max_order_id, order.id)
+                with STORAGE_DURATION.time("orders", "add"):
+                    self.repository.add(order)
+            finally:
+                with self._updating_lock:
+                    self._updating.discard(order.id)
             
             # 產生訂單確認訊息
             message = (
                 "✅ 訂單已建立！\n\n"
-                f"📦 訂單編號：{order['id']}\n"
+                f"📦 訂單編號：{order.id}\n"
                 "🛍️ 訂購商品：\n"
             )
             for item in order_items:
-                message += f"  - {item['name']} x {item['quantity']} = ${item['subtotal']}\n"
+                message += f"  - {item.name} x {item.quantity} = ${item.subtotal}\n"
             message += f"\n💰 總金額：${total}"
             
             return message
         
         except Exception as e:
-            # 發生錯誤時回復庫存
-            for item in items:
-                try:
-                    menu_manager.update_stock(item["name"], item["quantity"])
-                except:
-                    pass
+            # 發生錯誤時回復已扣除的庫存
+            try:
+                self.menu_manager.adjust_stock({name: -qty for name, qty in changes.items()})
+            except Exception:
+                pass
             return f"建立訂單時發生錯誤：{str(e)}"
     
-    def get_user_orders(self, user_id: str) -> str:
-        """取得使用者的訂單"""
-        if user_id not in self.orders or not self.orders[user_id]:
-            return "您目前沒有任何訂單"
-        
-        message = "📋 您的訂單記錄：\n\n"
-        for order in reversed(self.orders[user_id]):
-            message += (
-                f"📦 訂單 #{order['id']}\n"
-                f"📅 建立時間：{datetime.fromisoformat(order['created_at']).strftime('%Y-%m-%d %H:%M:%S')}\n"
-                f"🔄 狀態：{self._get_status_emoji(order['status'])} {order['status']}\n"
-                "🛍️ 商品：\n"
+    def get_user_orders(self, user_id: str, page: Optional[int] = None, more: bool = False) -> str:
+        """取得使用者的訂單（分頁，最新的在前）"""
+        with self._lock.read():
+            if user_id not in self.orders or not self.orders[user_id]:
+                return "您目前沒有任何訂單"
+            
+            orders, page, has_more = self._select_page(
+                user_id, "myorders", _OrderIdView(self.orders[user_id]), page, more
             )
-            for item in order["items"]:
-                message += f"  - {item['name']} x {item['quantity']} = ${item['subtotal']}\n"
-            message += f"💰 總金額：${order['total']}\n\n"
+        if not orders:
+            return "沒有更多訂單了"
         
+        message = "📋 您的訂單記錄" + self._page_label(page, has_more) + "：\n\n"
+        message += "\n".join(self._render_order(order) for order in orders)
+        if has_more:
+            message += "\n👉 輸入「myorders more」查看更早的訂單"
         return message.strip()
     
-    def get_all_orders(self) -> List[Dict[str, Any]]:
+    def get_all_orders(self) -> List[Order]:
         """取得所有訂單"""
-        all_orders = []
-        for user_orders in self.orders.values():
-            all_orders.extend(user_orders)
-        return sorted(all_orders, key=lambda x: x["id"])
-    
-    def view_orders(self, admin_id: str, status: Optional[str] = None) -> str:
-        """查看所有訂單（管理員功能）"""
-        all_orders = self.get_all_orders()
-        if not all_orders:
-            return "目前沒有任何訂單"
-        
-        if status:
-            all_orders = [o for o in all_orders if o["status"] == status]
-            if not all_orders:
+        with self._lock.read():
+            return [self.orders_by_id[order_id] for order_id in self.order_ids]
+    
+    def count_orders(self, status: Optional[str] = None) -> int:
+        """取得訂單數量（可依狀態篩選）"""
+        with self._lock.read():
+            if status is None:
+                return len(self.order_ids)
+            return len(self.status_index.get(status, ()))
+    
+    def status_counts(self) -> Dict[str, int]:
+        """取得各狀態的訂單數量"""
+        with self._lock.read():
+            return {status: len(ids) for status, ids in self.status_index.items()}
+    
+    def view_orders(self, admin_id: str, status: Optional[str] = None,
+                    page: Optional[int] = None, more: bool = False) -> str:
+        """查看所有訂單（管理員功能，分頁，最新的在前）"""
+        with self._lock.read():
+            if not self.order_ids:
+                return "目前沒有任何訂單"
+            
+            ids = self.status_index.get(status, []) if status else self.order_ids
+            if not ids:
                 return f"目前沒有狀態為 {status} 的訂單"
+            
+            orders, page, has_more = self._select_page(admin_id, f"view:{status or ''}", ids, page, more)
+        if not orders:
+            return "沒有更多訂單了"
         
-        message = "📋 所有訂單：\n\n"
-        for order in reversed(all_orders):
-            message += (
-                f"📦 訂單 #{order['id']}\n"
-                f"👤 用戶 ID：{order['user_id']}\n"
-                f"📅 建立時間：{datetime.fromisoformat(order['created_at']).strftime('%Y-%m-%d %H:%M:%S')}\n"
-                f"🔄 狀態：{self._get_status_emoji(order['status'])} {order['status']}\n"
-                "🛍️ 商品：\n"
-            )
-            for item in order["items"]:
-                message += f"  - {item['name']} x {item['quantity']} = ${item['subtotal']}\n"
-            message += f"💰 總金額：${order['total']}\n\n"
-        
+        message = "📋 所有訂單" + self._page_label(page, has_more) + "：\n\n"
+        message += "\n".join(self._render_order(order, show_user=True) for order in orders)
+        if has_more:
+            command = f"view orders {status} more" if status else "view orders more"
+            message += f"\n👉 輸入「{command}」查看更早的訂單"
         return message.strip()
     
+    def _select_page(self, viewer: str, scope: str, ids: Sequence[int],
+                     page: Optional[int], more: bool) -> Tuple[List[Order], int, bool]:
+        """從依編號排序的訂單編號中取出一頁（由新到舊），只讀取該頁的訂單（呼叫者須持有讀取鎖）
+        
+        more 為 True 時從上次查詢的游標（已顯示的最小訂單編號）繼續往後翻；
+        否則依頁碼定位。返回：(本頁訂單, 頁碼, 是否還有下一頁)
+        """
+        with self._cursor_lock:
+            cursor = self._cursors.get((viewer, scope))
+        if more and cursor:
+            end = bisect.bisect_left(ids, cursor[0])
+            page = cursor[1] + 1
+        else:
+            page = max(page or 1, 1)
+            end = len(ids) - (page - 1) * self.page_size
+        start = max(end - self.page_size, 0)
+        
+        selected = [self.orders_by_id[ids[i]] for i in range(end - 1, start - 1, -1)]
+        if selected:
+            self._save_cursor((viewer, scope), (selected[-1].id, page))
+        return selected, page, start > 0
+    
+    def _save_cursor(self, key: Tuple[str, str], cursor: Tuple[int, int]):
+        """記錄分頁游標，超過上限時移除最久未使用的游標"""
+        with self._cursor_lock:
+            self._cursors[key] = cursor
+            self._cursors.move_to_end(key)
+            while len(self._cursors) > self.max_cursors:
+                self._cursors.popitem(last=False)
+    
+    def _page_label(self, page: int, has_more: bool) -> str:
+        """頁碼標示，只有一頁時不顯示"""
+        return f"（第 {page} 頁）" if page > 1 or has_more else ""
+    
+    def _render_order(self, order: Order, show_user: bool = False) -> str:
+        """渲染單筆訂單"""
+        message = f"📦 訂單 #{order.id}\n"
+        if show_user:
+            message += f"👤 用戶 ID：{order.user_id}\n"
+        message += (
+            f"📅 建立時間：{datetime.fromtimestamp(order.created_at).strftime('%Y-%m-%d %H:%M:%S')}\n"
+            f"🔄 狀態：{self._get_status_emoji(order.status)} {order.status}\n"
+            "🛍️ 商品：\n"
+        )
+        for item in order.items:
+            message += f"  - {item.name} x {item.quantity} = ${item.subtotal}\n"
+        message += f"💰 總金額：${order.total}\n"
+        return message
+    
     def update_order_status(self, admin_id: str, order_id: int, new_status: str) -> str:
         """更新訂單狀態（管理員功能）"""
         # 驗證狀態
-        valid_statuses = ["pending", "confirmed", "cancelled", "completed"]
-        if new_status not in valid_statuses:
-            return f"無效的狀態。有效狀態：{', '.join(valid_statuses)}"
+        if new_status not in VALID_STATUSES:
+            return f"無效的狀態。有效狀態：{', '.join(VALID_STATUSES)}"
         
+        # 同一筆訂單正在由其他執行緒更新時直接返回，避免重複恢復或扣除庫存
+        with self._updating_lock:
+            if order_id in self._updating:
+                return f"訂單 #{order_id} 正在更新中，請稍後再試"
+            self._updating.add(order_id)
+        try:
+            return self._update_status(order_id, new_status)
+        finally:
+            with self._updating_lock:
+                self._updating.discard(order_id)
+    
+    def _update_status(self, order_id: int, new_status: str) -> str:
+        """更新訂單狀態（呼叫者須已將訂單標記為更新中）"""
         # 尋找訂單
-        order = None
-        user_id = None
-        for uid, orders in self.orders.items():
-            for o in orders:
-                if o["id"] == order_id:
-                    order = o
-                    user_id = uid
-                    break
-            if order:
-                break
-        
+        with self._lock.read():
+            order = self.orders_by_id.get(order_id)
         if not order:
             return f"找不到訂單 #{order_id}"
         
         # 檢查狀態變更的合法性
-        if not self._is_valid_status_transition(order["status"], new_status):
-            return f"無法將訂單從 {order['status']} 狀態變更為 {new_status}"
-        
-        # 更新狀態
-        old_status = order["status"]
-        order["status"] = new_status
-        order["updated_at"] = datetime.now().isoformat()
+        old_status = order.status
+        if not self._is_valid_status_transition(old_status, new_status):
+            return f"無法將訂單從 {old_status} 狀態變更為 {new_status}"
         
         # 特殊處理：如果取消訂單，恢復庫存
+        changes: Dict[str, int] = {}
         if new_status == "cancelled" and old_status != "cancelled":
-            for item in order["items"]:
-                menu_manager.update_stock(item["name"], item["quantity"])
-        # 如果從取消狀態恢復，扣除庫存
+            for item in order.items:
+                changes[item.name] = changes.get(item.name, 0) + item.quantity
+            self.menu_manager.adjust_stock(changes)
+        # 如果從取消狀態恢復，扣除庫存（所有商品一次原子性扣除）
         elif old_status == "cancelled" and new_status != "cancelled":
-            for item in order["items"]:
-                if menu_manager.get_item(item["name"])["stock"] < item["quantity"]:
-                    order["status"] = old_status  # 回復原狀態
-                    return f"無法恢復訂單：商品 {item['name']} 庫存不足"
-                menu_manager.update_stock(item["name"], -item["quantity"])
+            for item in order.items:
+                changes[item.name] = changes.get(item.name, 0) - item.quantity
+            try:
+                self.menu_manager.adjust_stock(changes)
+            except InsufficientStockError as e:
+                return f"無法恢復訂單：商品 {e.name} 庫存不足"
         
-        self.save_orders()
+        # 更新狀態：以複本替換，讀取者不會看到修改到一半的訂單
+        updated = order.copy()
+        updated.status = new_status
+        updated.updated_at = time.time()
+        with self._lock.write():
+            user_orders = self.orders.get(updated.user_id, [])
+            index = bisect.bisect_left(_OrderIdView(user_orders), order_id)
+            if index < len(user_orders) and user_orders[index].id == order_id:
+                user_orders[index] = updated
+            self.orders_by_id[order_id] = updated
+            self._move_status_index(order_id, old_status, new_status)
+        with STORAGE_DURATION.time("orders", "update"):
+            self.repository.update(updated)
         
         return (
             f"✅ 訂單 #{order_id} 狀態已更新\n"
@@ -200,6 +328,14 @@ class OrderManager:
             f"新狀態：{self._get_status_emoji(new_status)} {new_status}"
         )
     
+    def _move_status_index(self, order_id: int, old_status: str, new_status: str):
+        """將訂單從舊狀態索引移到新狀態索引（呼叫者須持有寫入鎖）"""
+        old_ids = self.status_index.get(old_status, [])
+        index = bisect.bisect_left(old_ids, order_id)
+        if index < len(old_ids) and old_ids[index] == order_id:
+            del old_ids[index]
+        bisect.insort(self.status_index.setdefault(new_status, []), order_id)
+    
     def _is_valid_status_transition(self, old_status: str, new_status: str) -> bool:
         """檢查狀態變更是否合法"""
         # 定義合法的狀態變更
@@ -220,5 +356,11 @@ class OrderManager:
             "completed": "🎉"
         }.get(status, "❓")
 
-# 建立全域實例
-order_manager = OrderManager() 
\ No newline at end of file
+def _close_at_exit():
+    if is_initialized(order_manager):
+        order_manager.repository.close()
+
+# 建立全域實例（第一次使用時才載入訂單）
+order_manager = LazyInstance(OrderManager)
+# 在匯入時登記（而非建立時）：atexit 後登記先執行，app 的事件佇列才會在關閉前處理完
+atexit.register(_close_at_exit) 
\ No newline at end of file
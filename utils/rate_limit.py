@@ -0,0 +1,141 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from .storage import SqliteDatabase, get_data_dir
+
+GLOBAL_KEY = "__global__"
+
+THROTTLED_MESSAGE = "⏳ 您的訊息太頻繁了，請稍後再試。"
+BUSY_MESSAGE = "⏳ 目前使用人數眾多，請稍後再試。"
+
+class BucketStore:
+    """token bucket 狀態儲存介面"""
+
+    def consume(self, buckets: List[Tuple[str, float, float]], now: float) -> Optional[str]:
+        """從多個 bucket 各取一個 token（全部成功或全部不取）
+
+        buckets: [(key, 每秒補充量, 容量), ...]
+        返回: 第一個 token 不足的 key，全部成功則返回 None
+        """
+        raise NotImplementedError
+
+def _refill(tokens: float, updated: float, rate: float, capacity: float, now: float) -> float:
+    return min(capacity, tokens + max(now - updated, 0) * rate)
+
+class MemoryBucketStore(BucketStore):
+    """行程內記憶體儲存（單一 worker 使用）
+
+    超過 max_keys 個 bucket 時移除最久未使用的 bucket。全域 bucket 每次放行
+    都會更新，不會被移除；被移除的使用者下次以補滿的 bucket 重新開始。
+    """
+
+    def __init__(self, max_keys: int = 100000):
+        self.max_keys = max_keys
+        # key -> (tokens, updated)，由最久未使用到最近使用
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def consume(self, buckets, now):
+        with self._lock:
+            refilled = []
+            for key, rate, capacity in buckets:
+                tokens, updated = self._buckets.get(key, (capacity, now))
+                tokens = _refill(tokens, updated, rate, capacity, now)
+                if tokens < 1:
+                    return key
+                refilled.append((key, tokens))
+            for key, tokens in refilled:
+                self._buckets[key] = (tokens - 1, now)
+                self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return None
+
+RATE_LIMIT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    key TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL
+);
+"""
+
+class SqliteBucketStore(BucketStore):
+    """以 SQLite 檔案共用 bucket 狀態（多個 worker 共用同一份限制）"""
+
+    def __init__(self, path: str):
+        # 限流狀態可以遺失，不需要每次交易都同步到磁碟
+        self.db = SqliteDatabase(path, schema=RATE_LIMIT_SCHEMA, synchronous="OFF")
+
+    def consume(self, buckets, now):
+        with self.db.transaction() as conn:
+            refilled = []
+            for key, rate, capacity in buckets:
+                row = conn.execute("SELECT tokens, updated FROM buckets WHERE key = ?", (key,)).fetchone()
+                tokens = capacity if row is None else _refill(row["tokens"], row["updated"], rate, capacity, now)
+                if tokens < 1:
+                    return key
+                refilled.append((tokens - 1, now, key))
+            conn.executemany(
+                "INSERT INTO buckets (tokens, updated, key) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET tokens=excluded.tokens, updated=excluded.updated",
+                refilled
+            )
+        return None
+
+class RateLimiter:
+    """每位使用者與全域的 token bucket 限流"""
+
+    def __init__(self, store: BucketStore, user_rate: float = 1.0, user_burst: float = 5,
+                 global_rate: float = 50.0, global_burst: float = 100):
+        self.store = store
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self._lock = threading.Lock()
+        self._counters = {"allowed": 0, "rejected_user": 0, "rejected_global": 0}
+
+    def check(self, user_id: str) -> Optional[str]:
+        """檢查是否放行，返回 None 表示放行，否則返回限流回覆訊息"""
+        limited = self.store.consume([
+            (f"user:{user_id}", self.user_rate, self.user_burst),
+            (GLOBAL_KEY, self.global_rate, self.global_burst)
+        ], time.time())
+        with self._lock:
+            if limited is None:
+                self._counters["allowed"] += 1
+            elif limited == GLOBAL_KEY:
+                self._counters["rejected_global"] += 1
+            else:
+                self._counters["rejected_user"] += 1
+        if limited is None:
+            return None
+        return BUSY_MESSAGE if limited == GLOBAL_KEY else THROTTLED_MESSAGE
+
+    def stats(self) -> Dict[str, int]:
+        """取得放行與拒絕次數"""
+        with self._lock:
+            return dict(self._counters)
+
+def create_rate_limiter() -> Optional[RateLimiter]:
+    """依環境變數建立限流器，RATE_LIMIT_ENABLED=false 時返回 None"""
+    if os.getenv('RATE_LIMIT_ENABLED', 'true').lower() != 'true':
+        return None
+    backend = os.getenv('RATE_LIMIT_BACKEND', 'memory').lower()
+    if backend == "sqlite":
+        store: BucketStore = SqliteBucketStore(
+            os.getenv('RATE_LIMIT_SQLITE_PATH', os.path.join(get_data_dir(), "ratelimit.db"))
+        )
+    elif backend == "memory":
+        store = MemoryBucketStore()
+    else:
+        raise ValueError(f"不支援的限流後端：{backend}（可用：memory, sqlite）")
+    return RateLimiter(
+        store,
+        user_rate=float(os.getenv('RATE_LIMIT_USER_RATE', '1')),
+        user_burst=float(os.getenv('RATE_LIMIT_USER_BURST', '5')),
+        global_rate=float(os.getenv('RATE_LIMIT_GLOBAL_RATE', '50')),
+        global_burst=float(os.getenv('RATE_LIMIT_GLOBAL_BURST', '100'))
+    )
@@ -0,0 +1,198 @@
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+def to_epoch(value: Any) -> Optional[float]:
+    """將 ISO 時間字串轉為 epoch 秒（已是數值或 None 則原樣返回）"""
+    if value is None or isinstance(value, (int, float)):
+        return value
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+def to_iso(value: Optional[float]) -> Optional[str]:
+    """將 epoch 秒轉回 ISO 時間字串"""
+    return None if value is None else datetime.fromtimestamp(value).isoformat()
+
+class Record:
+    """以 __slots__ 儲存欄位的資料紀錄
+
+    每筆紀錄不帶 __dict__，欄位值直接存在物件內。保留 dict 式存取
+    （record["status"]、get、update、in），既有程式碼不需改寫；
+    to_dict / from_dict 與既有的 JSON 格式互轉。
+    """
+
+    __slots__ = ()
+    FIELDS: Tuple[str, ...] = ()
+    _FIELD_SET: frozenset = frozenset()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._FIELD_SET = frozenset(cls.FIELDS)
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self._FIELD_SET:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key: str, value: Any):
+        if key not in self._FIELD_SET:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._FIELD_SET
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.FIELDS)
+
+    def __eq__(self, other: object) -> bool:
+        if type(other) is not type(self):
+            return NotImplemented
+        return all(getattr(self, f) == getattr(other, f) for f in self.FIELDS)
+
+    __hash__ = None  # 可變物件不可作為 dict key
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{f}={getattr(self, f)!r}" for f in self.FIELDS)
+        return f"{type(self).__name__}({fields})"
+
+    def get(self, key: str, default: Any = None) -> Any:
+        """取得欄位值，不存在的欄位返回預設值"""
+        if key not in self._FIELD_SET:
+            return default
+        return getattr(self, key)
+
+    def keys(self) -> Tuple[str, ...]:
+        """欄位名稱"""
+        return self.FIELDS
+
+    def update(self, fields: Dict[str, Any]):
+        """更新多個欄位"""
+        for key, value in fields.items():
+            self[key] = value
+
+    def to_dict(self) -> Dict[str, Any]:
+        """轉為 JSON 格式的 dict"""
+        return {f: getattr(self, f) for f in self.FIELDS}
+
+    def copy(self) -> "Record":
+        """淺層複製（欄位值共用）"""
+        return type(self)(*(getattr(self, f) for f in self.FIELDS))
+
+def encode_record(obj: Any) -> Any:
+    """json.dump 的 default：將紀錄轉為 dict"""
+    if isinstance(obj, Record):
+        return obj.to_dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+class MenuItem(Record):
+    """商品"""
+
+    __slots__ = ("price", "stock", "description", "created_at", "updated_at", "created_by")
+    FIELDS = __slots__
+
+    def __init__(self, price: int, stock: int, description: str = "", created_at: Optional[str] = None,
+                 updated_at: Optional[str] = None, created_by: Optional[str] = None):
+        self.price = price
+        self.stock = stock
+        self.description = description
+        self.created_at = created_at
+        self.updated_at = updated_at
+        self.created_by = created_by
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "MenuItem":
+        return cls(data["price"], data["stock"], data.get("description", ""), data.get("created_at"),
+                   data.get("updated_at"), data.get("created_by"))
+
+class OrderItem(Record):
+    """訂單中的一項商品"""
+
+    __slots__ = ("name", "quantity", "price", "subtotal")
+    FIELDS = __slots__
+
+    def __init__(self, name: str, quantity: int, price: int, subtotal: int):
+        self.name = name
+        self.quantity = quantity
+        self.price = price
+        self.subtotal = subtotal
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "OrderItem":
+        return cls(data["name"], data["quantity"], data["price"], data["subtotal"])
+
+class Order(Record):
+    """訂單（時間以 epoch 秒儲存，序列化時轉回 ISO 字串）"""
+
+    __slots__ = ("id", "user_id", "items", "total", "status", "created_at", "updated_at")
+    FIELDS = __slots__
+
+    def __init__(self, id: int, user_id: str, items: List[OrderItem], total: int, status: str,
+                 created_at: float, updated_at: float):
+        self.id = id
+        self.user_id = user_id
+        self.items = items
+        self.total = total
+        self.status = status
+        self.created_at = created_at
+        self.updated_at = updated_at
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Order":
+        return cls(data["id"], data["user_id"], [OrderItem.from_dict(i) for i in data["items"]],
+                   data["total"], data["status"], to_epoch(data["created_at"]), to_epoch(data["updated_at"]))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "user_id": self.user_id,
+            "items": [item.to_dict() for item in self.items],
+            "total": self.total,
+            "status": self.status,
+            "created_at": to_iso(self.created_at),
+            "updated_at": to_iso(self.updated_at)
+        }
+
+class UserRecord(Record):
+    """使用者狀態（時間以 epoch 秒儲存，序列化時轉回 ISO 字串）"""
+
+    __slots__ = ("is_admin", "is_logged_in", "login_attempts", "last_attempt_time",
+                 "blocked_until", "session_token", "session_created")
+    FIELDS = __slots__
+
+    def __init__(self, is_admin: bool = False, is_logged_in: bool = False, login_attempts: int = 0,
+                 last_attempt_time: Optional[float] = None, blocked_until: Optional[float] = None,
+                 session_token: Optional[str] = None, session_created: Optional[float] = None):
+        self.is_admin = is_admin
+        self.is_logged_in = is_logged_in
+        self.login_attempts = login_attempts
+        self.last_attempt_time = last_attempt_time
+        self.blocked_until = blocked_until
+        self.session_token = session_token
+        self.session_created = session_created
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "UserRecord":
+        # 時間欄位以 ISO 字串儲存（與舊版資料相同）
+        return cls(data.get("is_admin", False), data.get("is_logged_in", False),
+                   data.get("login_attempts", 0), to_epoch(data.get("last_attempt_time")),
+                   to_epoch(data.get("blocked_until")), data.get("session_token"),
+                   to_epoch(data.get("session_created")))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "is_admin": self.is_admin,
+            "is_logged_in": self.is_logged_in,
+            "login_attempts": self.login_attempts,
+            "last_attempt_time": to_iso(self.last_attempt_time),
+            "blocked_until": to_iso(self.blocked_until),
+            "session_token": self.session_token,
+            "session_created": to_iso(self.session_created)
+        }
+
+    def is_default(self) -> bool:
+        """是否與新使用者的預設狀態相同"""
+        return (not self.is_admin and not self.is_logged_in and not self.login_attempts
+                and self.last_attempt_time is None and self.blocked_until is None
+                and self.session_token is None and self.session_created is None)
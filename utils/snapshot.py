@@ -0,0 +1,104 @@
+import gzip
+import json
+import os
+import threading
+from typing import Any, Callable, Optional
+
+GZIP_MAGIC = b"\x1f\x8b"
+# 快照每次寫入都要重新壓縮，以速度為優先（JSON 在 level 1 已可壓到約 1/5）
+GZIP_LEVEL = 1
+
+class SnapshotError(ValueError):
+    """快照檔案損毀或格式不符"""
+
+def backup_path(path: str) -> str:
+    """上一份完整快照的路徑"""
+    return path + ".bak"
+
+def _compress_default() -> bool:
+    return os.getenv('SNAPSHOT_COMPRESS', 'none').lower() == 'gzip'
+
+def _fsync_default() -> bool:
+    return os.getenv('SNAPSHOT_FSYNC', 'true').lower() == 'true'
+
+def _fsync_dir(path: str):
+    """同步目錄，確保改名本身也寫入磁碟"""
+    try:
+        fd = os.open(os.path.dirname(path) or ".", os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def write_snapshot(path: str, data: Any, compress: Optional[bool] = None, fsync: Optional[bool] = None,
+                   default: Optional[Callable[[Any], Any]] = None):
+    """寫入快照：緊湊 JSON（可選 gzip），寫入暫存檔後原子改名
+
+    舊快照會先以 hard link 保留為 .bak，改名前後任何時間點當機，
+    path 都是一份完整的快照。
+    """
+    if compress is None:
+        compress = _compress_default()
+    if fsync is None:
+        fsync = _fsync_default()
+    payload = json.dumps(data, ensure_ascii=False, separators=(',', ':'), default=default).encode('utf-8')
+    if compress:
+        payload = gzip.compress(payload, compresslevel=GZIP_LEVEL, mtime=0)
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_file = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_file, 'wb') as f:
+        f.write(payload)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    if os.path.exists(path):
+        backup = backup_path(path)
+        try:
+            if os.path.exists(backup):
+                os.remove(backup)
+            os.link(path, backup)
+        except OSError as e:
+            # 不支援 hard link 的檔案系統：沒有備份，但仍可原子改名
+            print(f"建立快照備份時發生錯誤：{e}")
+    os.replace(tmp_file, path)
+    if fsync:
+        _fsync_dir(path)
+
+def _read(path: str, expect: Optional[type]) -> Any:
+    with open(path, 'rb') as f:
+        payload = f.read()
+    try:
+        if payload.startswith(GZIP_MAGIC):
+            payload = gzip.decompress(payload)
+        data = json.loads(payload)
+    except (OSError, EOFError, ValueError) as e:
+        raise SnapshotError(f"快照 {path} 已損毀：{e}")
+    if expect is not None and not isinstance(data, expect):
+        raise SnapshotError(f"快照 {path} 格式不符：預期 {expect.__name__}，實際為 {type(data).__name__}")
+    return data
+
+def read_snapshot(path: str, default: Any, expect: Optional[type] = dict) -> Any:
+    """讀取快照（自動辨識 gzip），損毀時改用 .bak 中的上一份快照
+
+    兩者都不存在時返回 default；都損毀時拋出 SnapshotError。
+    """
+    candidates = [p for p in (path, backup_path(path)) if os.path.exists(p)]
+    if not candidates:
+        return default
+    error: Optional[SnapshotError] = None
+    for candidate in candidates:
+        try:
+            data = _read(candidate, expect)
+        except SnapshotError as e:
+            print(e)
+            error = error or e
+            continue
+        if candidate != path:
+            print(f"已從備份 {candidate} 載入資料")
+        return data
+    raise error
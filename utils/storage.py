@@ -0,0 +1,988 @@
+import heapq
+import json
+import os
+import sqlite3
+import threading
+from contextlib import ExitStack, contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+from dotenv import load_dotenv
+from .filelock import FileLock
+from .journal import OrderJournal
+from .snapshot import read_snapshot, write_snapshot
+from .records import MenuItem, Order, UserRecord, encode_record, to_epoch, to_iso
+
+# 載入環境變數
+load_dotenv()
+
+# 儲存後端：json（預設）或 sqlite
+STORAGE_BACKENDS = ("json", "sqlite")
+
+def get_data_dir() -> str:
+    """取得資料目錄"""
+    return os.getenv('DATA_DIR', 'data')
+
+def get_storage_backend() -> str:
+    """取得目前設定的儲存後端"""
+    backend = os.getenv('STORAGE_BACKEND', 'json').lower()
+    if backend not in STORAGE_BACKENDS:
+        raise ValueError(f"不支援的儲存後端：{backend}（可用：{', '.join(STORAGE_BACKENDS)}）")
+    return backend
+
+class InsufficientStockError(ValueError):
+    """商品庫存不足"""
+
+    def __init__(self, name: str, remaining: int):
+        super().__init__(f"商品 {name} 庫存不足（剩餘：{remaining}）")
+        self.name = name
+        self.remaining = remaining
+
+# ---------------------------------------------------------------------------
+# 儲存介面
+# ---------------------------------------------------------------------------
+
+class MenuRepository:
+    """商品目錄儲存介面"""
+
+    def load(self) -> Dict[str, MenuItem]:
+        """載入所有商品"""
+        raise NotImplementedError
+
+    def save_all(self, menu: Dict[str, MenuItem]):
+        """寫入所有商品"""
+        raise NotImplementedError
+
+    def upsert(self, name: str, item: MenuItem):
+        """新增或更新單一商品"""
+        raise NotImplementedError
+
+    def update(self, name: str, fields: Dict[str, Any]):
+        """只更新單一商品的指定欄位"""
+        raise NotImplementedError
+
+    def delete(self, name: str):
+        """刪除單一商品"""
+        raise NotImplementedError
+
+    def adjust_stock(self, changes: Dict[str, int], updated_at: str) -> Dict[str, int]:
+        """以單一交易調整多項商品庫存，任一項不足則全部不變並拋出 InsufficientStockError
+
+        返回: 各商品調整後的庫存
+        """
+        raise NotImplementedError
+
+    def changed(self) -> bool:
+        """上次載入後是否有其他行程寫入（只做低成本的檢查，預設視為未變更）"""
+        return False
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        """批次寫入：期間的變更延後到離開時一次寫入（預設不做任何事）"""
+        yield
+
+    def close(self):
+        """釋放資源"""
+
+class OrderRepository:
+    """訂單儲存介面"""
+
+    def load(self) -> Dict[str, List[Order]]:
+        """載入所有訂單（依使用者分組）"""
+        raise NotImplementedError
+
+    def save_all(self, orders: Dict[str, List[Order]]):
+        """寫入所有訂單"""
+        raise NotImplementedError
+
+    def add(self, order: Order):
+        """新增訂單"""
+        raise NotImplementedError
+
+    def update(self, order: Order):
+        """更新訂單狀態"""
+        raise NotImplementedError
+
+    def next_order_id(self, floor: int = 0) -> int:
+        """配置下一個訂單編號（持久化的單調遞增序號，跨 worker 不重複）
+
+        floor 為呼叫端已知的最大編號，序號尚未建立時以此為起點。
+        """
+        raise NotImplementedError
+
+    def get(self, order_id: int) -> Optional[Order]:
+        """依訂單編號查詢"""
+        raise NotImplementedError
+
+    def iter_orders(self, status: Optional[str] = None, since: Optional[float] = None,
+                    until: Optional[float] = None) -> Iterator[Order]:
+        """依編號逐筆產生訂單，不一次載入全部（可依狀態與建立時間 [since, until) 篩選）"""
+        raise NotImplementedError
+
+    def find(self, user_id: Optional[str] = None, status: Optional[str] = None) -> List[Order]:
+        """依使用者及狀態查詢訂單（依編號排序）"""
+        raise NotImplementedError
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        """批次寫入：期間的變更延後到離開時一次寫入（預設不做任何事）"""
+        yield
+
+    def after_fork(self):
+        """fork 後重建行程專屬的資源（預設不做任何事）"""
+
+    def close(self):
+        """釋放資源"""
+
+class StateRepository:
+    """使用者狀態儲存介面"""
+
+    def load(self) -> Dict[str, UserRecord]:
+        """載入所有使用者狀態"""
+        raise NotImplementedError
+
+    def save_all(self, states: Dict[str, UserRecord]):
+        """寫入所有使用者狀態"""
+        raise NotImplementedError
+
+    def upsert(self, user_id: str, state: UserRecord):
+        """新增或更新單一使用者狀態"""
+        raise NotImplementedError
+
+    def upsert_many(self, states: Dict[str, UserRecord]):
+        """一次新增或更新多位使用者狀態"""
+        raise NotImplementedError
+
+    def delete_many(self, user_ids: List[str]):
+        """一次刪除多位使用者狀態"""
+        raise NotImplementedError
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        """批次寫入：期間的變更延後到離開時一次寫入（預設不做任何事）"""
+        yield
+
+    def close(self):
+        """釋放資源"""
+
+@contextmanager
+def unit_of_work(*participants) -> Iterator[None]:
+    """在同一個批次中處理多項變更（例如同一個 webhook 的所有事件）
+
+    participants 為具有 batch() 的儲存或管理器；離開時各自一次寫入。
+    """
+    with ExitStack() as stack:
+        for participant in participants:
+            stack.enter_context(participant.batch())
+        yield
+
+# ---------------------------------------------------------------------------
+# JSON 檔案後端
+# ---------------------------------------------------------------------------
+
+def _load_json(path: str, default: Any) -> Any:
+    # 損毀時改用上一份快照（.bak）
+    return read_snapshot(path, default)
+
+def _dump_json(path: str, data: Any):
+    # 先寫入暫存檔再改名，其他行程讀檔時不會看到寫到一半的內容
+    write_snapshot(path, data, default=encode_record)
+
+class JsonMenuRepository(MenuRepository):
+    """以 menu.json 儲存商品目錄
+
+    多個 worker 共用同一個檔案，因此每次變更都在檔案鎖內重新讀取檔案、
+    套用變更後整檔寫回，避免覆蓋其他行程的寫入。批次模式下第一次變更時
+    才取得鎖並持有到批次結束，整個批次只讀取與寫回一次；只有讀取的批次
+    不會持有鎖。
+
+    檔案的 (mtime, inode, size) 記錄在 _stamp，changed() 只需一次 stat
+    即可得知其他 worker 是否寫入過（寫入一律以改名取代，inode 會變）。
+
+    self.menu 只在檔案鎖內變更；load() 返回複本，管理器持有的商品目錄
+    不會在其他執行緒讀取或序列化時被修改。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.menu: Dict[str, MenuItem] = {}
+        self.lock = FileLock(path + ".lock")
+        self._batch = threading.local()
+        self._stamp: Optional[tuple] = None  # self.menu 對應的檔案版本
+        self._served: Optional[tuple] = None  # 上次 load() 返回的檔案版本
+
+    def _stat(self) -> Optional[tuple]:
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_ino, st.st_size)
+
+    def changed(self):
+        # 本行程的寫入也算：寫入時可能一併讀入了其他 worker 的變更
+        return self._stat() != self._served
+
+    def load(self):
+        with self._locked(write=False):
+            self._served = self._stamp
+            return {name: item.copy() for name, item in self.menu.items()}
+
+    def _refresh(self):
+        """在鎖內以檔案內容更新記憶體中的商品目錄（檔案未變更時不讀取，只替換有變更的商品）"""
+        try:
+            stamp = self._stat()
+            if stamp == self._stamp:
+                return
+            latest = _load_json(self.path, {})
+        except Exception as e:
+            print(f"載入商品目錄時發生錯誤：{e}")
+            return
+        for name in [name for name in self.menu if name not in latest]:
+            del self.menu[name]
+        for name, data in latest.items():
+            item = MenuItem.from_dict(data)
+            if self.menu.get(name) != item:
+                self.menu[name] = item
+        self._stamp = stamp
+
+    def _dump(self):
+        _dump_json(self.path, self.menu)
+        self._stamp = self._stat()
+
+    def _in_batch(self) -> bool:
+        return getattr(self._batch, "depth", 0) > 0
+
+    @contextmanager
+    def _locked(self, write: bool = True) -> Iterator[None]:
+        """在鎖內以最新的檔案內容執行操作
+
+        批次中第一次變更時取得鎖並讀取檔案，之後持有到批次結束；
+        批次中尚未變更時的讀取只暫時取得鎖。
+        """
+        if self._in_batch():
+            if self._batch.held:
+                yield
+                return
+            if write:
+                self.lock.acquire()
+                self._batch.held = True
+                self._refresh()
+                yield
+                return
+        with self.lock:
+            self._refresh()
+            yield
+
+    def _write(self):
+        """寫回檔案；批次中只標記待寫入"""
+        if self._in_batch():
+            self._batch.dirty = True
+        else:
+            self._dump()
+
+    @contextmanager
+    def batch(self):
+        depth = getattr(self._batch, "depth", 0)
+        if depth:
+            self._batch.depth += 1
+            try:
+                yield
+            finally:
+                self._batch.depth -= 1
+            return
+        self._batch.depth = 1
+        self._batch.dirty = False
+        self._batch.held = False
+        try:
+            yield
+        finally:
+            self._batch.depth = 0
+            if self._batch.held:
+                self._batch.held = False
+                try:
+                    # 記憶體中的變更已套用，不論成功與否都寫回
+                    if self._batch.dirty:
+                        self._dump()
+                except Exception as e:
+                    print(f"儲存商品目錄時發生錯誤：{e}")
+                finally:
+                    self.lock.release()
+
+    def save_all(self, menu):
+        menu = {name: item.copy() for name, item in menu.items()}
+        try:
+            with self._locked():
+                self.menu = menu
+                self._write()
+        except Exception as e:
+            print(f"儲存商品目錄時發生錯誤：{e}")
+
+    def upsert(self, name, item):
+        try:
+            with self._locked():
+                self.menu[name] = item.copy()
+                self._write()
+        except Exception as e:
+            print(f"儲存商品目錄時發生錯誤：{e}")
+
+    def update(self, name, fields):
+        try:
+            with self._locked():
+                if name in self.menu:
+                    self.menu[name].update(fields)
+                    self._write()
+        except Exception as e:
+            print(f"儲存商品目錄時發生錯誤：{e}")
+
+    def delete(self, name):
+        try:
+            with self._locked():
+                self.menu.pop(name, None)
+                self._write()
+        except Exception as e:
+            print(f"儲存商品目錄時發生錯誤：{e}")
+
+    def adjust_stock(self, changes, updated_at):
+        with self._locked():
+            for name, quantity in changes.items():
+                if name not in self.menu:
+                    raise ValueError(f"找不到商品：{name}")
+                if self.menu[name]["stock"] + quantity < 0:
+                    raise InsufficientStockError(name, self.menu[name]["stock"])
+            for name, quantity in changes.items():
+                self.menu[name]["stock"] += quantity
+                self.menu[name]["updated_at"] = updated_at
+            self._write()
+        return {name: self.menu[name]["stock"] for name in changes}
+
+class JsonOrderRepository(OrderRepository):
+    """以 orders.json 快照加上 append-only 日誌儲存訂單
+
+    多個 worker 共用同一份快照與日誌；日誌達到 compact_threshold 筆時，由觸發的
+    worker 在日誌的獨占鎖內從磁碟重建全部訂單（快照 + 日誌）後寫成新快照，
+    不會只寫入自己記憶體中的訂單而遺失其他 worker 的紀錄。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.orders: Dict[str, List[Order]] = {}
+        self.journal = OrderJournal(
+            os.path.splitext(path)[0] + ".journal",
+            fsync_batch=int(os.getenv('ORDER_JOURNAL_FSYNC_BATCH', '32')),
+            fsync_interval=float(os.getenv('ORDER_JOURNAL_FSYNC_INTERVAL', '1.0'))
+        )
+        # 日誌累積到此筆數時壓縮成快照
+        self.compact_threshold = int(os.getenv('ORDER_JOURNAL_COMPACT_EVERY', '1000'))
+        self.seq_file = os.path.splitext(path)[0] + ".seq"
+        self.seq_lock = FileLock(self.seq_file + ".lock")
+
+    def load(self):
+        self.orders = self._read()
+        return self.orders
+
+    def _read(self) -> Dict[str, List[Order]]:
+        """讀取快照並重播日誌（包含其他 worker 寫入的紀錄）"""
+        try:
+            snapshot = _load_json(self.path, {})
+            orders = {
+                user_id: [Order.from_dict(o) for o in user_orders] for user_id, user_orders in snapshot.items()
+            }
+        except Exception as e:
+            print(f"載入訂單資料時發生錯誤：{e}")
+            orders = {}
+
+        by_id = {o["id"]: o for user_orders in orders.values() for o in user_orders}
+        try:
+            for record in self.journal.replay():
+                self._apply(orders, record, by_id)
+        except Exception as e:
+            print(f"重播訂單日誌時發生錯誤：{e}")
+        # 多個 worker 的紀錄在日誌中可能交錯，各使用者的訂單依編號排序
+        for user_orders in orders.values():
+            user_orders.sort(key=lambda o: o.id)
+        return orders
+
+    def _apply(self, orders: Dict[str, List[Order]], record: Dict[str, Any], by_id: Dict[int, Order]):
+        """將一筆日誌紀錄套用到訂單"""
+        if record["op"] == "create":
+            data = record["order"]
+            # 快照寫入後、日誌清空前當機時，紀錄可能已包含在快照中
+            if data["id"] in by_id:
+                return
+            order = Order.from_dict(data)
+            orders.setdefault(order.user_id, []).append(order)
+            by_id[order.id] = order
+        elif record["op"] == "status":
+            order = by_id.get(record["id"])
+            if order:
+                order.status = record["status"]
+                order.updated_at = to_epoch(record["updated_at"])
+
+    def _record(self, record: Dict[str, Any]):
+        """寫入訂單日誌，必要時壓縮成快照"""
+        try:
+            self.journal.append(record)
+        except Exception as e:
+            print(f"寫入訂單日誌時發生錯誤：{e}")
+            return
+        if self.journal.records >= self.compact_threshold:
+            self.compact()
+
+    def compact(self):
+        """以磁碟上的快照與日誌重建全部訂單，寫成新快照並清空日誌"""
+        def write():
+            # 快照必須先落盤才能清空日誌
+            write_snapshot(self.path, self._read(), fsync=True, default=encode_record)
+
+        try:
+            self.journal.compact(write)
+        except Exception as e:
+            print(f"壓縮訂單日誌時發生錯誤：{e}")
+
+    def save_all(self, orders):
+        """以指定的訂單覆寫快照並清空日誌（不在其中的訂單會被移除）"""
+        self.orders = orders
+
+        def write():
+            # 暫停日誌寫入期間取得複本（dict.copy / list() 不會與其他執行緒的新增交錯），
+            # 之後的新訂單與狀態變更都會寫入清空後的日誌；快照必須先落盤才能清空日誌
+            snapshot = {user_id: list(user_orders) for user_id, user_orders in orders.copy().items()}
+            write_snapshot(self.path, snapshot, fsync=True, default=encode_record)
+
+        try:
+            self.journal.compact(write)
+        except Exception as e:
+            print(f"儲存訂單資料時發生錯誤：{e}")
+
+    def batch(self):
+        return self.journal.batch()
+
+    def after_fork(self):
+        self.journal.after_fork()
+
+    def add(self, order):
+        # self.orders 與管理器共用同一份資料，這裡只需寫入日誌
+        self._record({"op": "create", "order": order})
+
+    def update(self, order):
+        self._record({
+            "op": "status",
+            "id": order["id"],
+            "status": order["status"],
+            "updated_at": to_iso(to_epoch(order["updated_at"]))
+        })
+
+    def next_order_id(self, floor=0):
+        with self.seq_lock:
+            current = 0
+            if os.path.exists(self.seq_file):
+                with open(self.seq_file, 'r', encoding='utf-8') as f:
+                    current = int(f.read().strip() or 0)
+            order_id = max(current, floor) + 1
+            tmp_file = f"{self.seq_file}.{os.getpid()}.tmp"
+            with open(tmp_file, 'w', encoding='utf-8') as f:
+                f.write(str(order_id))
+            os.replace(tmp_file, self.seq_file)
+        return order_id
+
+    def get(self, order_id):
+        for user_orders in list(self.orders.values()):
+            for order in user_orders:
+                if order["id"] == order_id:
+                    return order
+        return None
+
+    def find(self, user_id=None, status=None):
+        if user_id is not None:
+            candidates = list(self.orders.get(user_id, []))
+        else:
+            candidates = [o for user_orders in list(self.orders.values()) for o in user_orders]
+        if status is not None:
+            candidates = [o for o in candidates if o["status"] == status]
+        return sorted(candidates, key=lambda o: o["id"])
+
+    def iter_orders(self, status=None, since=None, until=None):
+        # 各使用者的訂單依建立順序（即編號）排列，合併即可依編號產生，不需複製整份訂單
+        for order in heapq.merge(*list(self.orders.values()), key=lambda o: o.id):
+            if status is not None and order.status != status:
+                continue
+            if (since is not None and order.created_at < since) or (until is not None and order.created_at >= until):
+                continue
+            yield order
+
+    def close(self):
+        self.journal.close()
+
+class JsonStateRepository(StateRepository):
+    """以 user_state.json 儲存使用者狀態，每次變更整檔寫入
+
+    寫入的是自己持有的 dict（load() 返回複本），變更與序列化在同一個鎖內進行，
+    其他執行緒新增使用者時不會影響寫入中的快照，較舊的內容也不會覆蓋較新的。
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.states: Dict[str, UserRecord] = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        with self._lock:
+            self.states = {uid: UserRecord.from_dict(state) for uid, state in _load_json(self.path, {}).items()}
+            return dict(self.states)
+
+    def _save(self):
+        try:
+            _dump_json(self.path, self.states)
+        except Exception as e:
+            print(f"儲存使用者狀態時發生錯誤：{e}")
+
+    def save_all(self, states):
+        with self._lock:
+            self.states = dict(states)
+            self._save()
+
+    def upsert(self, user_id, state):
+        self.upsert_many({user_id: state})
+
+    def upsert_many(self, states):
+        with self._lock:
+            self.states.update(states)
+            self._save()
+
+    def delete_many(self, user_ids):
+        with self._lock:
+            for user_id in user_ids:
+                self.states.pop(user_id, None)
+            self._save()
+
+# ---------------------------------------------------------------------------
+# SQLite 後端
+# ---------------------------------------------------------------------------
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS menu (
+    name TEXT PRIMARY KEY,
+    price INTEGER NOT NULL,
+    stock INTEGER NOT NULL CHECK (stock >= 0),
+    description TEXT NOT NULL DEFAULT '',
+    created_at TEXT,
+    updated_at TEXT,
+    created_by TEXT
+);
+CREATE TABLE IF NOT EXISTS orders (
+    id INTEGER PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    items TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_orders_user_id ON orders (user_id, id);
+CREATE INDEX IF NOT EXISTS idx_orders_status ON orders (status, id);
+CREATE TABLE IF NOT EXISTS sequences (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS user_state (
+    user_id TEXT PRIMARY KEY,
+    data TEXT NOT NULL
+);
+"""
+
+class SqliteDatabase:
+    """SQLite 連線管理（WAL 模式，每個執行緒/行程一條連線）"""
+
+    def __init__(self, path: str, schema: str = SCHEMA, synchronous: str = "NORMAL"):
+        self.path = path
+        self.schema = schema
+        self.synchronous = synchronous
+        self._local = threading.local()
+        self._schema_ready = False
+
+    def data_version(self) -> int:
+        """目前執行緒連線的 PRAGMA data_version，其他連線提交寫入後會改變"""
+        return self.connection().execute("PRAGMA data_version").fetchone()[0]
+
+    def connection(self) -> sqlite3.Connection:
+        """取得目前執行緒的連線"""
+        conn = getattr(self._local, "conn", None)
+        # fork 後不可沿用父行程的連線
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(f"PRAGMA synchronous={self.synchronous}")
+            conn.execute("PRAGMA busy_timeout=30000")
+            if not self._schema_ready:
+                conn.executescript(self.schema)
+                self._schema_ready = True
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def writer(self) -> sqlite3.Connection:
+        """取得寫入用的連線；批次中第一次寫入時才開始交易（取得寫入鎖）"""
+        conn = self.connection()
+        if getattr(self._local, "batch", 0) and not self._local.began:
+            conn.execute("BEGIN IMMEDIATE")
+            self._local.began = True
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """以 BEGIN IMMEDIATE 開始寫入交易，離開時提交或回滾
+
+        批次中改用 savepoint，失敗時只回滾這次操作。
+        """
+        if getattr(self._local, "batch", 0):
+            conn = self.writer()
+            conn.execute("SAVEPOINT op")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK TO op")
+                conn.execute("RELEASE op")
+                raise
+            else:
+                conn.execute("RELEASE op")
+            return
+        conn = self.connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+
+    @contextmanager
+    def batch(self):
+        """以單一交易包住整個批次（巢狀呼叫共用同一個交易），只在提交時同步一次
+
+        交易在第一次寫入時才開始：只有讀取的批次（例如查詢商品、被限流的事件）
+        不會取得寫入鎖，也不會與其他執行緒或 worker 的批次互相等待。
+        """
+        depth = getattr(self._local, "batch", 0)
+        self._local.batch = depth + 1
+        if depth:
+            try:
+                yield
+            finally:
+                self._local.batch = depth
+            return
+        self._local.began = False
+        try:
+            yield
+        finally:
+            # 記憶體中的變更與已記錄的事件 ID 都已套用，不論成功與否都提交（與 JSON 後端相同）；
+            # 個別失敗的寫入已由 savepoint 回滾
+            self._end_batch()
+
+    def _end_batch(self):
+        self._local.batch = 0
+        if self._local.began:
+            self._local.began = False
+            conn = self.connection()
+            try:
+                conn.execute("COMMIT")
+            except sqlite3.Error:
+                # 提交失敗時結束交易，不讓這條連線一直持有寫入鎖
+                if conn.in_transaction:
+                    conn.execute("ROLLBACK")
+                raise
+
+    def close(self):
+        """關閉目前執行緒的連線"""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == os.getpid():
+            conn.close()
+        self._local.conn = None
+
+def _menu_row_to_item(row: sqlite3.Row) -> MenuItem:
+    return MenuItem(row["price"], row["stock"], row["description"], row["created_at"],
+                    row["updated_at"], row["created_by"])
+
+def _order_row_to_order(row: sqlite3.Row) -> Order:
+    return Order.from_dict({
+        "id": row["id"],
+        "user_id": row["user_id"],
+        "items": json.loads(row["items"]),
+        "total": row["total"],
+        "status": row["status"],
+        "created_at": row["created_at"],
+        "updated_at": row["updated_at"]
+    })
+
+class SqliteMenuRepository(MenuRepository):
+    """以 SQLite 儲存商品目錄，逐列 upsert"""
+
+    UPSERT = (
+        "INSERT INTO menu (name, price, stock, description, created_at, updated_at, created_by) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT(name) DO UPDATE SET price=excluded.price, stock=excluded.stock, "
+        "description=excluded.description, updated_at=excluded.updated_at"
+    )
+
+    def __init__(self, db: SqliteDatabase):
+        self.db = db
+        self._seen = threading.local()  # 各執行緒連線上次看到的 data_version
+
+    def batch(self):
+        return self.db.batch()
+
+    def changed(self):
+        # data_version 以連線為單位，第一次在此執行緒檢查時無從比較，視為已變更
+        version = self.db.data_version()
+        last = getattr(self._seen, "version", None)
+        self._seen.version = version
+        return version != last
+
+    def _params(self, name, item):
+        return (name, item["price"], item["stock"], item.get("description", ""),
+                item.get("created_at"), item.get("updated_at"), item.get("created_by"))
+
+    def load(self):
+        self._seen.version = self.db.data_version()
+        rows = self.db.connection().execute("SELECT * FROM menu ORDER BY name")
+        return {row["name"]: _menu_row_to_item(row) for row in rows}
+
+    def save_all(self, menu):
+        try:
+            with self.db.transaction() as conn:
+                conn.executemany(self.UPSERT, [self._params(n, i) for n, i in menu.items()])
+                names = list(menu)
+                placeholders = ",".join("?" * len(names))
+                conn.execute(f"DELETE FROM menu WHERE name NOT IN ({placeholders})", names)
+        except Exception as e:
+            print(f"儲存商品目錄時發生錯誤：{e}")
+
+    def upsert(self, name, item):
+        try:
+            self.db.writer().execute(self.UPSERT, self._params(name, item))
+        except Exception as e:
+            print(f"儲存商品目錄時發生錯誤：{e}")
+
+    def update(self, name, fields):
+        columns = [c for c in ("price", "stock", "description", "updated_at") if c in fields]
+        if not columns:
+            return
+        try:
+            self.db.writer().execute(
+                f"UPDATE menu SET {', '.join(c + ' = ?' for c in columns)} WHERE name = ?",
+                [fields[c] for c in columns] + [name]
+            )
+        except Exception as e:
+            print(f"儲存商品目錄時發生錯誤：{e}")
+
+    def delete(self, name):
+        try:
+            self.db.writer().execute("DELETE FROM menu WHERE name = ?", (name,))
+        except Exception as e:
+            print(f"儲存商品目錄時發生錯誤：{e}")
+
+    def adjust_stock(self, changes, updated_at):
+        result = {}
+        with self.db.transaction() as conn:
+            for name, quantity in changes.items():
+                row = conn.execute("SELECT stock FROM menu WHERE name = ?", (name,)).fetchone()
+                if row is None:
+                    raise ValueError(f"找不到商品：{name}")
+                if row["stock"] + quantity < 0:
+                    raise InsufficientStockError(name, row["stock"])
+                conn.execute(
+                    "UPDATE menu SET stock = stock + ?, updated_at = ? WHERE name = ?",
+                    (quantity, updated_at, name)
+                )
+                result[name] = row["stock"] + quantity
+        return result
+
+    def close(self):
+        self.db.close()
+
+class SqliteOrderRepository(OrderRepository):
+    """以 SQLite 儲存訂單，依編號 / 使用者 / 狀態建立索引"""
+
+    UPSERT = (
+        "INSERT INTO orders (id, user_id, items, total, status, created_at, updated_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT(id) DO UPDATE SET status=excluded.status, updated_at=excluded.updated_at"
+    )
+
+    def __init__(self, db: SqliteDatabase):
+        self.db = db
+
+    def batch(self):
+        return self.db.batch()
+
+    def _params(self, order):
+        return (order["id"], order["user_id"],
+                json.dumps(order["items"], ensure_ascii=False, separators=(',', ':'), default=encode_record),
+                order["total"], order["status"], to_iso(to_epoch(order["created_at"])),
+                to_iso(to_epoch(order["updated_at"])))
+
+    def load(self):
+        orders: Dict[str, List[Order]] = {}
+        for row in self.db.connection().execute("SELECT * FROM orders ORDER BY id"):
+            orders.setdefault(row["user_id"], []).append(_order_row_to_order(row))
+        return orders
+
+    def save_all(self, orders):
+        try:
+            with self.db.transaction() as conn:
+                conn.executemany(self.UPSERT, [
+                    self._params(o) for user_orders in orders.values() for o in user_orders
+                ])
+        except Exception as e:
+            print(f"儲存訂單資料時發生錯誤：{e}")
+
+    def add(self, order):
+        try:
+            self.db.writer().execute(self.UPSERT, self._params(order))
+        except Exception as e:
+            print(f"儲存訂單資料時發生錯誤：{e}")
+
+    def update(self, order):
+        try:
+            self.db.writer().execute(
+                "UPDATE orders SET status = ?, updated_at = ? WHERE id = ?",
+                (order["status"], to_iso(to_epoch(order["updated_at"])), order["id"])
+            )
+        except Exception as e:
+            print(f"儲存訂單資料時發生錯誤：{e}")
+
+    def next_order_id(self, floor=0):
+        with self.db.transaction() as conn:
+            row = conn.execute("SELECT value FROM sequences WHERE name = 'order_id'").fetchone()
+            if row is None:
+                current = conn.execute("SELECT COALESCE(MAX(id), 0) FROM orders").fetchone()[0]
+            else:
+                current = row["value"]
+            order_id = max(current, floor) + 1
+            conn.execute(
+                "INSERT INTO sequences (name, value) VALUES ('order_id', ?) "
+                "ON CONFLICT(name) DO UPDATE SET value=excluded.value",
+                (order_id,)
+            )
+        return order_id
+
+    def get(self, order_id):
+        row = self.db.connection().execute(
+            "SELECT * FROM orders WHERE id = ?", (order_id,)
+        ).fetchone()
+        return _order_row_to_order(row) if row else None
+
+    def find(self, user_id=None, status=None):
+        clauses, params = [], []
+        if user_id is not None:
+            clauses.append("user_id = ?")
+            params.append(user_id)
+        if status is not None:
+            clauses.append("status = ?")
+            params.append(status)
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        rows = self.db.connection().execute(f"SELECT * FROM orders{where} ORDER BY id", params)
+        return [_order_row_to_order(row) for row in rows]
+
+    def iter_orders(self, status=None, since=None, until=None, chunk_size=500):
+        # 以編號分段查詢（keyset），不在串流期間持有讀取交易
+        clauses, params = ["id > ?"], []
+        if status is not None:
+            clauses.append("status = ?")
+            params.append(status)
+        # created_at 為 ISO 字串，可直接以字串比較
+        if since is not None:
+            clauses.append("created_at >= ?")
+            params.append(to_iso(since))
+        if until is not None:
+            clauses.append("created_at < ?")
+            params.append(to_iso(until))
+        query = f"SELECT * FROM orders WHERE {' AND '.join(clauses)} ORDER BY id LIMIT ?"
+        last_id = 0
+        while True:
+            rows = self.db.connection().execute(query, [last_id] + params + [chunk_size]).fetchall()
+            for row in rows:
+                yield _order_row_to_order(row)
+            if len(rows) < chunk_size:
+                return
+            last_id = rows[-1]["id"]
+
+    def close(self):
+        self.db.close()
+
+class SqliteStateRepository(StateRepository):
+    """以 SQLite 儲存使用者狀態，逐列 upsert"""
+
+    UPSERT = (
+        "INSERT INTO user_state (user_id, data) VALUES (?, ?) "
+        "ON CONFLICT(user_id) DO UPDATE SET data=excluded.data"
+    )
+
+    def __init__(self, db: SqliteDatabase):
+        self.db = db
+
+    def batch(self):
+        return self.db.batch()
+
+    def load(self):
+        rows = self.db.connection().execute("SELECT user_id, data FROM user_state")
+        return {row["user_id"]: UserRecord.from_dict(json.loads(row["data"])) for row in rows}
+
+    def save_all(self, states):
+        try:
+            with self.db.transaction() as conn:
+                conn.executemany(self.UPSERT, [
+                    (uid, json.dumps(state, ensure_ascii=False, default=encode_record)) for uid, state in states.items()
+                ])
+        except Exception as e:
+            print(f"儲存使用者狀態時發生錯誤：{e}")
+
+    def upsert(self, user_id, state):
+        try:
+            self.db.writer().execute(self.UPSERT, (user_id, json.dumps(state, ensure_ascii=False, default=encode_record)))
+        except Exception as e:
+            print(f"儲存使用者狀態時發生錯誤：{e}")
+
+    def upsert_many(self, states):
+        self.save_all(states)
+
+    def delete_many(self, user_ids):
+        try:
+            with self.db.transaction() as conn:
+                conn.executemany("DELETE FROM user_state WHERE user_id = ?", [(uid,) for uid in user_ids])
+        except Exception as e:
+            print(f"儲存使用者狀態時發生錯誤：{e}")
+
+    def close(self):
+        self.db.close()
+
+# ---------------------------------------------------------------------------
+# 依環境變數建立儲存後端
+# ---------------------------------------------------------------------------
+
+_databases: Dict[str, SqliteDatabase] = {}
+
+def get_sqlite_database(path: Optional[str] = None) -> SqliteDatabase:
+    """取得共用的 SQLite 資料庫（同一路徑共用連線管理）"""
+    path = path or os.getenv('SQLITE_PATH', os.path.join(get_data_dir(), "store.db"))
+    if path not in _databases:
+        _databases[path] = SqliteDatabase(path)
+    return _databases[path]
+
+def create_menu_repository() -> MenuRepository:
+    """依 STORAGE_BACKEND 建立商品目錄儲存"""
+    if get_storage_backend() == "sqlite":
+        return SqliteMenuRepository(get_sqlite_database())
+    return JsonMenuRepository(os.path.join(get_data_dir(), "menu.json"))
+
+def create_order_repository() -> OrderRepository:
+    """依 STORAGE_BACKEND 建立訂單儲存"""
+    if get_storage_backend() == "sqlite":
+        return SqliteOrderRepository(get_sqlite_database())
+    return JsonOrderRepository(os.path.join(get_data_dir(), "orders.json"))
+
+def create_state_repository() -> StateRepository:
+    """依 STORAGE_BACKEND 建立使用者狀態儲存"""
+    if get_storage_backend() == "sqlite":
+        return SqliteStateRepository(get_sqlite_database())
+    return JsonStateRepository(os.path.join(get_data_dir(), "user_state.json"))
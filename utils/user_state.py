@@ -1,143 +1,314 @@
-import json
+import atexit
 import os
-from datetime import datetime, timedelta
-from typing import Optional, Dict, Any
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Optional, Dict, Iterable, Iterator, List, Set
+from .storage import StateRepository, create_state_repository
+from .metrics import STORAGE_DURATION, USER_STATE_SWEPT
+from .records import UserRecord
+from .lazy import LazyInstance, is_initialized
+from .locks import KeyedLocks
+
+# 查詢不存在的使用者時共用的預設紀錄（唯讀）
+_DEFAULT_RECORD = UserRecord()
 
 class UserState:
-    def __init__(self):
-        self.state_file = "data/user_state.json"
-        self.states: Dict[str, Dict[str, Any]] = {}
+    """使用者狀態管理
+
+    同一位使用者的變更以該使用者的鎖串行化，不同使用者可同時進行；紀錄以
+    copy-on-write 替換，讀取者不需取得鎖。寫入儲存一律在鎖外由 flush() 進行。
+    """
+
+    def __init__(self, repository: Optional[StateRepository] = None,
+                 write_behind: Optional[bool] = None, flush_delay: Optional[float] = None):
+        self.repository = repository or create_state_repository()
+        self.states: Dict[str, UserRecord] = {}
+        # write-behind：變更先記錄在 dirty set，延遲 flush_delay 秒後合併寫入
+        if write_behind is None:
+            write_behind = os.getenv('USER_STATE_WRITE_BEHIND', 'true').lower() == 'true'
+        if flush_delay is None:
+            flush_delay = float(os.getenv('USER_STATE_FLUSH_DELAY', '1.0'))
+        self.write_behind = write_behind
+        self.flush_delay = flush_delay
+        self._dirty: Set[str] = set()
+        self._flush_timer: Optional[threading.Timer] = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # 依序寫入，較舊的內容不會覆蓋較新的
+        self._user_locks = KeyedLocks()
+        self._batch = threading.local()  # 各執行緒進行中的批次層數
+        self.session_ttl = float(os.getenv('SESSION_EXPIRE_HOURS', '24')) * 3600
+        self._sweeper: Optional[threading.Thread] = None
+        self._stop_sweeper = threading.Event()
         self.load_states()
     
     def load_states(self):
-        """從檔案載入使用者狀態"""
+        """從儲存載入使用者狀態"""
         try:
-            if os.path.exists(self.state_file):
-                with open(self.state_file, 'r', encoding='utf-8') as f:
-                    self.states = json.load(f)
+            self.states = self.repository.load()
         except Exception as e:
             print(f"載入使用者狀態時發生錯誤：{e}")
             self.states = {}
     
     def save_states(self):
-        """儲存使用者狀態到檔案"""
+        """儲存所有使用者狀態"""
+        with STORAGE_DURATION.time("user_state", "save_all"):
+            self.repository.save_all(self.states)
+    
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        """批次中的變更在離開時一次寫入（write-behind 模式本來就會合併寫入）"""
+        depth = getattr(self._batch, "depth", 0)
+        self._batch.depth = depth + 1
         try:
-            os.makedirs(os.path.dirname(self.state_file), exist_ok=True)
-            with open(self.state_file, 'w', encoding='utf-8') as f:
-                json.dump(self.states, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            print(f"儲存使用者狀態時發生錯誤：{e}")
-    
-    def get_user_state(self, user_id: str) -> dict:
-        """取得使用者狀態，如果不存在則初始化"""
-        if user_id not in self.states:
-            self.states[user_id] = {
-                "is_admin": False,
-                "is_logged_in": False,
-                "login_attempts": 0,
-                "last_attempt_time": None,
-                "blocked_until": None,
-                "session_token": None,
-                "session_created": None
-            }
-            self.save_states()
-        return self.states[user_id]
+            yield
+        finally:
+            self._batch.depth = depth
+            if not depth and not self.write_behind:
+                self.flush()
+    
+    def _mark_dirty(self, user_ids: Iterable[str]):
+        """標記使用者狀態已變更，write-behind 模式下排程延遲寫入"""
+        with self._lock:
+            self._dirty.update(user_ids)
+            if self.write_behind and self._flush_timer is None:
+                self._flush_timer = threading.Timer(self.flush_delay, self.flush)
+                self._flush_timer.daemon = True
+                self._flush_timer.start()
+    
+    def _save_user(self, user_id: str):
+        """標記使用者狀態已變更；非 write-behind 且不在批次中時立即寫入"""
+        self._mark_dirty((user_id,))
+        if not self.write_behind and not getattr(self._batch, "depth", 0):
+            self.flush()
+    
+    @contextmanager
+    def _editing(self, user_id: str) -> Iterator[UserRecord]:
+        """在使用者的鎖內修改狀態複本，完成後替換原紀錄並標記變更"""
+        with self._user_locks(user_id):
+            state = self.states.get(user_id)
+            state = state.copy() if state is not None else UserRecord()
+            yield state
+            self.states[user_id] = state
+        # 寫入儲存時不持有使用者的鎖（批次中的其他執行緒可能持有儲存的鎖）
+        self._save_user(user_id)
+    
+    def flush(self):
+        """將所有已變更的使用者狀態一次寫入儲存（已移除的使用者一併刪除）"""
+        with self._flush_lock:
+            with self._lock:
+                if self._flush_timer is not None:
+                    self._flush_timer.cancel()
+                    self._flush_timer = None
+                dirty, self._dirty = self._dirty, set()
+            if not dirty:
+                return
+            # 依序寫入並讀取當下最新的紀錄（清理可能同時移除使用者，只查詢一次）
+            states = {}
+            for uid in dirty:
+                state = self.states.get(uid)
+                if state is not None:
+                    states[uid] = state
+            removed = [uid for uid in dirty if uid not in states]
+            try:
+                with STORAGE_DURATION.time("user_state", "flush"):
+                    if states:
+                        self.repository.upsert_many(states)
+                    if removed:
+                        self.repository.delete_many(removed)
+            except Exception:
+                # 寫入失敗時放回 dirty set，下次 flush 重試
+                self._mark_dirty(dirty)
+                raise
+    
+    def _peek(self, user_id: str) -> UserRecord:
+        """唯讀取得使用者狀態，不存在時返回預設值且不建立紀錄"""
+        return self.states.get(user_id, _DEFAULT_RECORD)
+    
+    def get_user_state(self, user_id: str) -> UserRecord:
+        """取得使用者狀態，如果不存在則初始化（不會寫入儲存）"""
+        state = self.states.get(user_id)
+        if state is None:
+            with self._user_locks(user_id):
+                state = self.states.setdefault(user_id, UserRecord())
+        return state
     
     def is_admin(self, user_id: str) -> bool:
         """檢查使用者是否為管理員"""
-        return self.get_user_state(user_id).get("is_admin", False)
+        return self._peek(user_id).is_admin
     
     def is_logged_in(self, user_id: str) -> bool:
         """檢查使用者是否已登入"""
-        return self.get_user_state(user_id).get("is_logged_in", False)
+        return self._peek(user_id).is_logged_in
     
     def set_admin_status(self, user_id: str, status: bool):
         """設定使用者的管理員狀態"""
-        state = self.get_user_state(user_id)
-        state["is_admin"] = status
-        self.save_states()
+        with self._editing(user_id) as state:
+            state.is_admin = status
     
     def set_login_status(self, user_id: str, status: bool):
         """設定使用者的登入狀態"""
-        state = self.get_user_state(user_id)
-        state["is_logged_in"] = status
-        if not status:
-            state["session_token"] = None
-            state["session_created"] = None
-        self.save_states()
+        with self._editing(user_id) as state:
+            state.is_logged_in = status
+            if not status:
+                state.session_token = None
+                state.session_created = None
     
     def get_login_attempts(self, user_id: str) -> int:
         """取得登入嘗試次數"""
-        return self.get_user_state(user_id).get("login_attempts", 0)
+        return self._peek(user_id).login_attempts
     
     def increment_login_attempts(self, user_id: str):
         """增加登入嘗試次數"""
-        state = self.get_user_state(user_id)
-        state["login_attempts"] = state.get("login_attempts", 0) + 1
-        state["last_attempt_time"] = datetime.now().isoformat()
-        self.save_states()
+        with self._editing(user_id) as state:
+            state.login_attempts += 1
+            state.last_attempt_time = time.time()
     
     def reset_login_attempts(self, user_id: str):
         """重置登入嘗試次數"""
-        state = self.get_user_state(user_id)
-        state["login_attempts"] = 0
-        state["last_attempt_time"] = None
-        state["blocked_until"] = None
-        self.save_states()
+        with self._editing(user_id) as state:
+            state.login_attempts = 0
+            state.last_attempt_time = None
+            state.blocked_until = None
     
     def block_user(self, user_id: str, until: datetime):
         """暫時封鎖使用者"""
-        state = self.get_user_state(user_id)
-        state["blocked_until"] = until.isoformat()
-        self.save_states()
+        with self._editing(user_id) as state:
+            state.blocked_until = until.timestamp()
     
     def unblock_user(self, user_id: str):
         """解除使用者封鎖"""
-        state = self.get_user_state(user_id)
-        state["blocked_until"] = None
-        state["login_attempts"] = 0
-        self.save_states()
+        with self._editing(user_id) as state:
+            state.blocked_until = None
+            state.login_attempts = 0
     
     def is_blocked(self, user_id: str) -> bool:
         """檢查使用者是否被封鎖"""
-        state = self.get_user_state(user_id)
-        blocked_until = state.get("blocked_until")
-        if not blocked_until:
-            return False
-        return datetime.now() < datetime.fromisoformat(blocked_until)
+        blocked_until = self._peek(user_id).blocked_until
+        return blocked_until is not None and time.time() < blocked_until
     
     def get_block_end_time(self, user_id: str) -> Optional[datetime]:
         """取得封鎖結束時間"""
-        state = self.get_user_state(user_id)
-        blocked_until = state.get("blocked_until")
-        return datetime.fromisoformat(blocked_until) if blocked_until else None
+        blocked_until = self._peek(user_id).blocked_until
+        return datetime.fromtimestamp(blocked_until) if blocked_until is not None else None
     
     def set_session_token(self, user_id: str, token: str):
         """設定 session token"""
-        state = self.get_user_state(user_id)
-        state["session_token"] = token
-        state["session_created"] = datetime.now().isoformat()
-        self.save_states()
+        with self._editing(user_id) as state:
+            state.session_token = token
+            state.session_created = time.time()
     
     def clear_session_token(self, user_id: str):
         """清除 session token"""
-        state = self.get_user_state(user_id)
-        state["session_token"] = None
-        state["session_created"] = None
-        self.save_states()
+        with self._editing(user_id) as state:
+            state.session_token = None
+            state.session_created = None
     
     def has_valid_session(self, user_id: str) -> bool:
         """檢查 session 是否有效"""
-        state = self.get_user_state(user_id)
-        token = state.get("session_token")
-        created = state.get("session_created")
+        state = self._peek(user_id)
+        token = state.session_token
+        created = state.session_created
         
         if not token or not created:
             return False
         
-        # session 有效期為 24 小時
-        created_time = datetime.fromisoformat(created)
-        return datetime.now() - created_time < timedelta(hours=24)
+        # session 有效期預設為 24 小時（SESSION_EXPIRE_HOURS）
+        return time.time() - created < self.session_ttl
+    
+    def sweep(self, now: Optional[float] = None) -> Dict[str, int]:
+        """清除過期的 session 與封鎖，並移除回到預設狀態的使用者
+        
+        返回: 各類清除的筆數
+        """
+        now = time.time() if now is None else now
+        result = {"sessions": 0, "blocks": 0, "evicted": 0}
+        changed: List[str] = []
+        for user_id in list(self.states):
+            with self._user_locks(user_id):
+                state = self.states.get(user_id)
+                if state is None:
+                    continue
+                created = state.session_created
+                session_expired = created is not None and now - created >= self.session_ttl
+                blocked_until = state.blocked_until
+                block_expired = blocked_until is not None and now >= blocked_until
+                if not (session_expired or block_expired or state.is_default()):
+                    continue
+                
+                state = state.copy()
+                if session_expired:
+                    state.is_logged_in = False
+                    state.session_token = None
+                    state.session_created = None
+                    result["sessions"] += 1
+                if block_expired:
+                    state.blocked_until = None
+                    state.login_attempts = 0
+                    result["blocks"] += 1
+                if state.is_default():
+                    # 與不存在的使用者等價，直接移除（flush 時自儲存刪除）
+                    del self.states[user_id]
+                    result["evicted"] += 1
+                else:
+                    self.states[user_id] = state
+                changed.append(user_id)
+        
+        if changed:
+            self._mark_dirty(changed)
+            self.flush()
+        for kind, count in result.items():
+            if count:
+                USER_STATE_SWEPT.inc(kind, amount=count)
+        return result
+    
+    def start_sweeper(self, interval: Optional[float] = None):
+        """啟動背景清理執行緒（USER_STATE_SWEEP_INTERVAL 秒一次，0 表示停用）"""
+        if interval is None:
+            interval = float(os.getenv('USER_STATE_SWEEP_INTERVAL', '300'))
+        if interval <= 0 or (self._sweeper is not None and self._sweeper.is_alive()):
+            return
+        self._stop_sweeper.clear()
+        self._sweeper = threading.Thread(target=self._sweep_loop, args=(interval,),
+                                         name="user-state-sweeper", daemon=True)
+        self._sweeper.start()
+    
+    def stop_sweeper(self):
+        """停止背景清理執行緒"""
+        self._stop_sweeper.set()
+        if self._sweeper is not None:
+            self._sweeper.join()
+            self._sweeper = None
+    
+    def after_fork(self):
+        """fork 後重建鎖、計時器與清理執行緒（父行程的執行緒不會帶到子行程）"""
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._user_locks = KeyedLocks()
+        self._batch = threading.local()
+        self._flush_timer = None
+        self._sweeper = None
+        self._stop_sweeper = threading.Event()
+        self.start_sweeper()
+    
+    def _sweep_loop(self, interval: float):
+        while not self._stop_sweeper.wait(interval):
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"清理使用者狀態時發生錯誤：{e}")
+
+def _create_user_state() -> UserState:
+    state = UserState()
+    state.start_sweeper()
+    return state
+
+def _flush_at_exit():
+    if is_initialized(user_state):
+        user_state.flush()
 
-# 建立全域實例
-user_state = UserState() 
\ No newline at end of file
+# 建立全域實例（第一次使用時才載入使用者狀態）
+user_state = LazyInstance(_create_user_state)
+# 在匯入時登記（而非建立時）：atexit 後登記先執行，app 的事件佇列才會在寫入前處理完
+atexit.register(_flush_at_exit) 
\ No newline at end of file
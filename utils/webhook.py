@@ -0,0 +1,51 @@
+import logging
+from typing import List, Optional
+from .command_handler import handle_command
+from .dedup import EventDeduplicator
+from .line_client import split_text
+from .rate_limit import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+ERROR_MESSAGE = "抱歉，處理您的請求時發生錯誤。請稍後再試。"
+
+def respond(user_id: str, text: str, event_id: Optional[str], redelivery: bool,
+            deduplicator: Optional[EventDeduplicator] = None,
+            rate_limiter: Optional[RateLimiter] = None) -> Optional[List[str]]:
+    """處理一則文字訊息（Flask 與 asyncio 入口共用）：去重 → 限流 → 命令處理
+
+    返回: 要回覆的文字（已依字數上限拆分），None 表示不回覆
+    """
+    # 已處理過的重送事件直接略過，避免重複建立訂單與扣庫存
+    if deduplicator is not None and deduplicator.is_duplicate(event_id, redelivery):
+        logger.info('略過重送的事件', extra={
+            'user_id': user_id,
+            'webhook_event_id': event_id
+        })
+        return None
+
+    # 記錄收到的訊息
+    logger.info('收到訊息', extra={
+        'user_id': user_id,
+        'user_message': text
+    })
+
+    # 超過限流時直接回覆，不進入命令處理
+    if rate_limiter is not None:
+        throttled = rate_limiter.check(user_id)
+        if throttled is not None:
+            logger.warning('訊息已被限流', extra=dict(rate_limiter.stats(), user_id=user_id))
+            return [throttled]
+
+    try:
+        # 處理命令並取得回應
+        response = handle_command(text, user_id)
+    except Exception as e:
+        logger.error('處理訊息時發生錯誤', extra={
+            'error': str(e),
+            'user_id': user_id,
+            'user_message': text
+        })
+        return [ERROR_MESSAGE]
+    # 超過單則字數上限時拆成多則訊息
+    return split_text(response) if response else None
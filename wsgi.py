@@ -1,4 +1,7 @@
-from app import app
+from app import app, start_warm_up
+
+# worker 啟動後立即可接受請求，資料在背景載入（WARM_UP=eager 則先載入完成）
+start_warm_up()
 
 if __name__ == "__main__":
     app.run() 
\ No newline at end of file